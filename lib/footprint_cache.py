@@ -0,0 +1,182 @@
+"""
+Persistent cache of raster properties and footprints for the mosaic scripts.  Image dimensions, projection,
+band count, data type and resolution, and the bounding box, trimmed data and RPC footprints, are stored in an
+SQLite database keyed by image path.  Each row carries the image mtime and size and is ignored once the image
+changes, so the cache fills lazily and can be shared by reruns of the same or overlapping mosaics.
+"""
+
+import os, sqlite3, threading, logging
+
+import ogr
+
+logger = logging.getLogger("logger")
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS images (
+        path TEXT PRIMARY KEY,
+        mtime REAL NOT NULL,
+        size INTEGER NOT NULL,
+        xsize INTEGER,
+        ysize INTEGER,
+        proj TEXT,
+        bands INTEGER,
+        datatype INTEGER,
+        datatype_readable TEXT,
+        xres REAL,
+        yres REAL
+    )""",
+    """CREATE TABLE IF NOT EXISTS footprints (
+        path TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        params TEXT NOT NULL,
+        mtime REAL NOT NULL,
+        size INTEGER NOT NULL,
+        geom BLOB,
+        PRIMARY KEY (path, kind, params)
+    )""",
+]
+
+IMAGE_FIELDS = ["xsize","ysize","proj","bands","datatype","datatype_readable","xres","yres"]
+
+#### Footprint kinds
+BBOX = "bbox"
+TRIMMED = "trimmed"
+RPC = "rpc"
+
+#### Number of writes between commits
+COMMIT_INTERVAL = 200
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class FootprintCache(object):
+    """
+    Connection to a footprint cache.  A single connection is shared by all threads of a process and guarded
+    by a lock.  Writes are committed in batches; call close() when done.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.conn = sqlite3.connect(path, timeout=300, check_same_thread=False)
+        self.conn.text_factory = str
+        for stmt in SCHEMA:
+            self.conn.execute(stmt)
+        self.conn.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+        with _caches_lock:
+            if _caches.get(self.path) is self:
+                del _caches[self.path]
+
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= COMMIT_INTERVAL:
+            self.conn.commit()
+            self.pending = 0
+
+
+    def getImageInfo(self, srcfp):
+        """
+        Return a dict of cached raster properties for an image, or None if not cached or the image has changed
+        """
+
+        stamp = getStamp(srcfp)
+        if stamp is None:
+            return None
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT %s FROM images WHERE path = ? AND mtime = ? AND size = ?" %", ".join(IMAGE_FIELDS),
+                (os.path.abspath(srcfp),) + stamp
+                ).fetchone()
+
+        if row is None:
+            return None
+        return dict(zip(IMAGE_FIELDS, row))
+
+
+    def putImageInfo(self, srcfp, info):
+        """
+        Store raster properties for an image from a dict (or object) with the IMAGE_FIELDS keys
+        """
+
+        stamp = getStamp(srcfp)
+        if stamp is None:
+            return
+
+        if not isinstance(info, dict):
+            info = dict((f, getattr(info, f)) for f in IMAGE_FIELDS)
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO images VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                (os.path.abspath(srcfp),) + stamp + tuple(info[f] for f in IMAGE_FIELDS)
+                )
+            self._written()
+
+
+    def getFootprint(self, srcfp, kind, params=""):
+        """
+        Return the cached footprint geometry of an image, or None if not cached or the image has changed.
+        params distinguishes footprints computed with different settings.
+        """
+
+        stamp = getStamp(srcfp)
+        if stamp is None:
+            return None
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT geom FROM footprints WHERE path = ? AND kind = ? AND params = ? AND mtime = ? AND size = ?",
+                (os.path.abspath(srcfp), kind, params) + stamp
+                ).fetchone()
+
+        if row is None or row[0] is None:
+            return None
+        return ogr.CreateGeometryFromWkb(str(row[0]))
+
+
+    def putFootprint(self, srcfp, kind, params, geom):
+        stamp = getStamp(srcfp)
+        if stamp is None or geom is None:
+            return
+
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO footprints VALUES (?,?,?,?,?,?)",
+                (os.path.abspath(srcfp), kind, params) + stamp + (sqlite3.Binary(geom.ExportToWkb()),)
+                )
+            self._written()
+
+
+def getStamp(srcfp):
+    try:
+        st = os.stat(srcfp)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def openFootprintCache(path):
+    """
+    Return a shared FootprintCache for a cache path, or None if path is None
+    """
+
+    if path is None:
+        return None
+
+    path = os.path.abspath(path)
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = FootprintCache(path)
+            _caches[path] = cache
+    return cache
@@ -0,0 +1,260 @@
+"""
+Work queue shared by the submitting scripts and pgc_worker.py.  Jobs are rows of an SQLite database that
+submitters add and workers claim one at a time, run and mark done or failed.  Claims are made in an immediate
+transaction, so any number of workers can pull from the same queue.  The database must be on a file system
+with working locks (a local disk, or a shared file system that supports POSIX locking).
+
+Workers are named host:pid and refresh a heartbeat on their running job while it runs.  A running job whose
+worker process is gone from this host, or whose heartbeat is older than HEARTBEAT_TIMEOUT, was lost with its
+worker and goes back to pending the next time the queue is added to or claimed from.
+
+A worker with a walltime also records its deadline with each claim.  Jobs still running past the deadline of
+their worker were lost with it (killed at its walltime) and go back to pending the next time the queue is
+added to or claimed from.
+"""
+
+import os, errno, sqlite3, json, socket, time, threading, logging
+
+logger = logging.getLogger("logger")
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        script TEXT NOT NULL,
+        args TEXT NOT NULL,
+        env TEXT,
+        output TEXT,
+        log TEXT,
+        cost_key TEXT,
+        units REAL,
+        state TEXT NOT NULL,
+        worker TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        claimed REAL,
+        deadline REAL,
+        heartbeat REAL,
+        seconds REAL,
+        rc INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)",
+    "CREATE INDEX IF NOT EXISTS jobs_output ON jobs (output)",
+]
+
+#### Job states
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+FIELDS = ["id","name","script","args","env","output","log","cost_key","units","attempts"]
+
+#### Seconds between heartbeats of a running job, and without one before its worker is taken to be gone
+HEARTBEAT_INTERVAL = 60
+HEARTBEAT_TIMEOUT = 1800
+
+
+class QueuedJob(object):
+    """
+    A job claimed from the queue.  args is the argument string of the script and env a dict.
+    """
+
+    def __init__(self, row):
+        for field, val in zip(FIELDS, row):
+            setattr(self, field, val)
+        self.env = json.loads(self.env) if self.env else {}
+
+
+    def commandLine(self):
+        return " ".join([self.script, self.args]) if self.args else self.script
+
+
+class JobQueue(object):
+    """
+    Connection to a job queue.  The connection is in autocommit mode and every change is its own
+    transaction; a lock guards it against concurrent use by threads of one process.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=300, isolation_level=None, check_same_thread=False)
+        self.conn.text_factory = str
+        for stmt in SCHEMA:
+            self.conn.execute(stmt)
+
+        #### Queues created before heartbeats were recorded
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")]
+        if "heartbeat" not in columns:
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN heartbeat REAL")
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+    def add(self, jobs):
+        """
+        Add scheduler.JobSpec jobs as pending.  A job whose output is already pending or running in the queue
+        is skipped.  Returns the number of jobs added.
+        """
+
+        added = 0
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeueExpired()
+                self._requeueLost()
+                for job in jobs:
+                    if job.output is not None:
+                        row = self.conn.execute("SELECT id FROM jobs WHERE output = ? AND state IN (?,?)",
+                                                (job.output, PENDING, RUNNING)).fetchone()
+                        if row is not None:
+                            continue
+                    self.conn.execute(
+                        "INSERT INTO jobs (name, script, args, env, output, log, cost_key, units, state) VALUES (?,?,?,?,?,?,?,?,?)",
+                        (job.name, job.script, " ".join(job.args), json.dumps(job.env), job.output, job.log,
+                         job.cost_key, job.units, PENDING)
+                        )
+                    added += 1
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+        return added
+
+
+    def claim(self, worker, deadline=None):
+        """
+        Mark the oldest pending job as running by worker, which will be gone after deadline (a time.time()
+        value, None if unlimited), and return it as a QueuedJob, or None if the queue has no pending jobs.  A job
+        claimed without a deadline is still returned to the queue if its worker dies.
+        """
+
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._requeueExpired()
+                self._requeueLost()
+                row = self.conn.execute("SELECT %s FROM jobs WHERE state = ? ORDER BY id LIMIT 1" %", ".join(FIELDS),
+                                        (PENDING,)).fetchone()
+                if row is not None:
+                    now = time.time()
+                    self.conn.execute("UPDATE jobs SET state = ?, worker = ?, claimed = ?, deadline = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?",
+                                      (RUNNING, worker, now, deadline, now, row[0]))
+            except:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+        return QueuedJob(row) if row is not None else None
+
+
+    def release(self, job):
+        """
+        Return a claimed job to the queue without counting the attempt
+        """
+
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET state = ?, worker = NULL, claimed = NULL, deadline = NULL, heartbeat = NULL, attempts = attempts - 1 WHERE id = ?",
+                              (PENDING, job.id))
+
+
+    def beat(self, worker):
+        """
+        Refresh the heartbeat of the jobs running on worker
+        """
+
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET heartbeat = ? WHERE state = ? AND worker = ?",
+                              (time.time(), RUNNING, worker))
+
+
+    def finish(self, job, rc, seconds, success):
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET state = ?, rc = ?, seconds = ? WHERE id = ?",
+                              (DONE if success else FAILED, rc, seconds, job.id))
+
+
+    def _requeueExpired(self):
+        n = self.conn.execute("UPDATE jobs SET state = ?, worker = NULL, claimed = NULL, deadline = NULL WHERE state = ? AND deadline < ?",
+                              (PENDING, RUNNING, time.time())).rowcount
+        if n > 0:
+            logger.warning("Returned %i jobs of workers past their walltime to the queue" %n)
+
+
+    def _requeueLost(self):
+        host = socket.gethostname()
+        oldest = time.time() - HEARTBEAT_TIMEOUT
+        lost = []
+        for jobid, worker, heartbeat in self.conn.execute("SELECT id, worker, heartbeat FROM jobs WHERE state = ?", (RUNNING,)).fetchall():
+            if heartbeat is None or heartbeat < oldest or not isWorkerAlive(worker, host):
+                lost.append(jobid)
+        for jobid in lost:
+            self.conn.execute("UPDATE jobs SET state = ?, worker = NULL, claimed = NULL, deadline = NULL, heartbeat = NULL WHERE id = ?",
+                              (PENDING, jobid))
+        if len(lost) > 0:
+            logger.warning("Returned %i jobs of workers that are gone to the queue" %len(lost))
+
+
+    def counts(self):
+        """
+        Return a dict of the number of jobs in each state
+        """
+
+        with self.lock:
+            rows = self.conn.execute("SELECT state, count(*) FROM jobs GROUP BY state").fetchall()
+        return dict(rows)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Thread refreshing the heartbeat of the jobs of a worker every HEARTBEAT_INTERVAL seconds until stop() is
+    called
+    """
+
+    def __init__(self, queue, worker, interval=HEARTBEAT_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.worker = worker
+        self.interval = interval
+        self.stopped = threading.Event()
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.queue.beat(self.worker)
+            except sqlite3.Error, e:
+                logger.warning("Cannot record heartbeat of worker %s: %s" %(self.worker,e))
+
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def getWorkerName():
+    return "%s:%i" %(socket.gethostname(), os.getpid())
+
+
+def isWorkerAlive(worker, host):
+    """
+    Return False if worker (a getWorkerName() value) is a process of this host that no longer exists.  Workers
+    of other hosts are taken to be alive.
+    """
+
+    try:
+        whost, pid = worker.rsplit(":", 1)
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return True
+    if whost != host:
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
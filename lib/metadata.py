@@ -0,0 +1,485 @@
+"""
+Image metadata readers.  Each vendor sidecar (DigitalGlobe XML, GeoEye and IKONOS text) is parsed once
+into a SceneMetadata record that holds the parsed tree, a tag lookup and the normalised values used by
+calibration, scoring and output metadata writing.  Records are cached per file path and invalidated when
+the file changes.
+"""
+
+import os, re, copy, logging, threading
+from xml.etree import cElementTree as ET
+
+logger = logging.getLogger("logger")
+
+DGbandList = ['BAND_P','BAND_C','BAND_B','BAND_G','BAND_Y','BAND_R','BAND_RE','BAND_N','BAND_N2']
+
+#### Top level groups of a DigitalGlobe isd document that are kept.  The ephemeris, attitude, tile and
+#### geometry groups are large and are dropped while streaming.
+DG_KEEP_GROUPS = ("IMD","RPB")
+
+#### Metadata file extensions in search order
+METADATA_EXTS = [".xml",".XML",".txt"]
+
+#### Patterns to extract GeoEye tag/value pairs and BEGIN/END group tags
+GE_PAT_PAIR = re.compile(r'(?P<tag>\w+) = "?(?P<data>.*?)"?;', re.I)
+GE_PAT_MLSTR = re.compile(r"(?P<tag>\w+) = ", re.I)
+
+#### Number of non-blank lines of a text metadata file checked for GeoEye tag/value pairs
+SNIFF_LINES = 20
+
+#### Maximum number of records held in the cache
+CACHE_SIZE = 2000
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class SceneMetadata(object):
+    """
+    Parsed metadata for one image.
+
+    tree:  ElementTree of the metadata (DG documents hold only the IMD and RPB groups).  None for records
+           loaded from a scene table.
+    tags:  dict of tag -> list of element texts in document order, like tree.findall(".//tag")
+
+    Normalised values (None if not present):
+    satid, catid, firstlinetime (string as written by the vendor), caltime (acquisition time used for
+    calibration, the original first line time for GeoEye), sunel (degrees), cc (cloud cover fraction),
+    ona (off nadir angle in degrees), tdi (list of TDI levels in document order), heightoffset (RPC
+    height offset), bands (DG band name -> dict of ABSCALFACTOR and EFFECTIVEBANDWIDTH), gains and
+    offsets (GE band number -> value)
+    """
+
+    def __init__(self, path, tree=None):
+        self.path = path
+        self.tree = tree
+        self.tags = {}
+        if tree is not None:
+            for elem in tree.getiterator():
+                self.tags.setdefault(elem.tag, []).append(elem.text)
+
+        self.satid = None
+        self.catid = None
+        self.firstlinetime = None
+        self.caltime = None
+        self.sunel = None
+        self.cc = None
+        self.ona = None
+        self.tdi = []
+        self.heightoffset = None
+        self.bands = {}
+        self.gains = {}
+        self.offsets = {}
+
+        if self.first("SATID") is not None or self.first("FIRSTLINETIME") is not None:
+            self._normaliseDG()
+        elif self.first("firstLineAcquisitionDateTime") is not None or self.first("originalFirstLineAcquisitionDateTime") is not None:
+            self._normaliseGE()
+
+
+    def values(self, tag):
+        """
+        Return the texts of all elements with the given tag, in document order
+        """
+        return self.tags.get(tag, [])
+
+
+    def first(self, tag):
+        """
+        Return the text of the first element with the given tag, or None
+        """
+        vals = self.tags.get(tag)
+        if vals:
+            return vals[0]
+        return None
+
+
+    def firstFloat(self, tag):
+        """
+        Return the first element text with the given tag as a float, or None
+        """
+        return _toFloat(self.first(tag))
+
+
+    def _normaliseDG(self):
+        self.satid = self.first("SATID")
+        self.catid = self.first("CATID")
+        self.firstlinetime = self.first("FIRSTLINETIME")
+        self.caltime = self.firstlinetime
+        self.sunel = self.firstFloat("MEANSUNEL")
+        if self.sunel is None:
+            self.sunel = self.firstFloat("SUNEL")
+        self.cc = self.firstFloat("CLOUDCOVER")
+        self.ona = self.firstFloat("MEANOFFNADIRVIEWANGLE")
+        self.tdi = [v for v in [_toFloat(t) for t in self.values("TDILEVEL")] if v is not None]
+
+        rpb = self.tree.find(".//RPB")
+        if rpb is not None:
+            self.heightoffset = rpb.findtext("IMAGE/HEIGHTOFFSET")
+
+        imd = self.tree.find(".//IMD")
+        if imd is not None:
+            for band in DGbandList:
+                node = imd.find(band)
+                if node is not None:
+                    self.bands[band] = {
+                        "ABSCALFACTOR":_toFloat(node.findtext("ABSCALFACTOR")),
+                        "EFFECTIVEBANDWIDTH":_toFloat(node.findtext("EFFECTIVEBANDWIDTH"))
+                    }
+
+
+    def _normaliseGE(self):
+        self.firstlinetime = self.first("firstLineAcquisitionDateTime")
+        self.caltime = self.first("originalFirstLineAcquisitionDateTime")
+        self.sunel = self.firstFloat("firstLineSunElevationAngle")
+        cc = self.firstFloat("percentCloudCover")
+        self.cc = cc / 100 if cc is not None else None
+        el = self.firstFloat("firstLineElevationAngle")
+        self.ona = 90 - el if el is not None else None
+        self.tdi = [v for v in [_toFloat(t) for t in self.values("tdiMode")] if v is not None]
+        self.heightoffset = self.first("heightOffset")
+
+        for node in self.tree.findall(".//bandSpecificInformation"):
+            try:
+                band = int(node.attrib["bandNumber"])
+            except (KeyError, ValueError):
+                logger.info("Unable to retrieve band number in GE metadata")
+            else:
+                gain = _toFloat(node.findtext(".//gain"))
+                if gain is not None:
+                    self.gains[band] = gain
+                offset = _toFloat(node.findtext(".//offset"))
+                if offset is not None:
+                    self.offsets[band] = offset
+
+
+def _toFloat(text):
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def getMetadataPath(srcfp):
+    """
+    Return the metadata sidecar of an image (.xml, .XML or .txt beside it), or None
+    """
+
+    base = os.path.splitext(srcfp)[0]
+    for ext in METADATA_EXTS:
+        if os.path.isfile(base + ext):
+            return base + ext
+    return None
+
+
+def getMetadata(metapath):
+    """
+    Return the SceneMetadata record for a metadata file, parsing it only if it is not already cached or
+    has changed on disk.  Parse errors (ET.ParseError, IOError) are raised to the caller.
+    """
+
+    st = os.stat(metapath)
+    key = os.path.abspath(metapath)
+    stamp = (st.st_mtime, st.st_size)
+
+    with _cache_lock:
+        entry = _cache.get(key)
+    if entry is not None and entry[0] == stamp:
+        return entry[1]
+
+    if os.path.splitext(metapath)[1].lower() == ".xml":
+        tree = parseDGXml(metapath)
+    elif isGEText(metapath):
+        tree = getGEMetadataAsXml(metapath)
+    else:
+        tree = getIKMetadataAsXml(metapath)
+
+    md = SceneMetadata(metapath, tree)
+
+    with _cache_lock:
+        if len(_cache) >= CACHE_SIZE:
+            _cache.clear()
+        _cache[key] = (stamp, md)
+
+    return md
+
+
+def isGEText(metapath):
+    """
+    Return True if a text metadata file is in the GeoEye "tag = value;" format rather than the IKONOS
+    "Tag: value" format.  The file contents are checked, since IKONOS files may still have their raw
+    po_* names.
+    """
+
+    f = open(metapath, "r")
+    try:
+        n = 0
+        for line in f:
+            if not line.strip():
+                continue
+            if GE_PAT_PAIR.search(line):
+                return True
+            n += 1
+            if n >= SNIFF_LINES:
+                break
+    finally:
+        f.close()
+    return False
+
+
+def clearCache():
+    with _cache_lock:
+        _cache.clear()
+
+
+def parseDGXml(xmlpath):
+    """
+    Stream a DigitalGlobe XML file into an ElementTree.  For isd documents only the IMD and RPB groups are
+    kept; elements of the other groups are cleared as soon as they are read.  Other documents (e.g. the
+    PGC ortho output metadata) are kept whole.
+    """
+
+    root = None
+    depth = 0
+    keep = True
+
+    for event, elem in ET.iterparse(xmlpath, events=("start","end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            elif depth == 1:
+                keep = root.tag != "isd" or elem.tag in DG_KEEP_GROUPS
+            depth += 1
+        else:
+            depth -= 1
+            if depth == 1 and not keep:
+                root.remove(elem)
+            elif depth > 1 and not keep:
+                elem.clear()
+
+    return ET.ElementTree(root)
+
+
+def getGEImd(md):
+    """
+    Build an IMD element for output metadata from a GeoEye record.  The cached tree is not modified.
+    """
+
+    imd = ET.Element("IMD")
+    include_tags = ["sensorInfo","inputImageInfo","correctionParams","bandSpecificInformation"]
+
+    elem = md.tree.find("productInfo")
+    if elem is not None:
+        elem = copy.deepcopy(elem)
+        rpc = elem.find("rationalFunctions")
+        if rpc is not None:
+            elem.remove(rpc)
+        imd.append(elem)
+
+    for tag in include_tags:
+        elems = md.tree.findall(tag)
+        imd.extend(elems)
+
+    return imd
+
+
+def getIKMetadataAsXml(metafile):
+    """
+    Given the text of an IKONOS metadata file, returns all the key/pair values as a
+    searchable XML tree
+    """
+    if not metafile:
+        return ET.Element("root")  # No metadata provided, return an empty tree
+
+    # If metafile is a file, open it and read from it, otherwise assume a list of strings
+    if os.path.isfile(metafile) and os.path.getsize(metafile) > 0:
+        try:
+            metaf = open(metafile, "r")
+        except IOError, err:
+            print "Could not open metadata file %s because %s" % (metafile, err)
+            raise
+    else:
+        metaf = metafile
+
+    # Patterns to identify tag/value pairs and group tags
+    ikpat1 = re.compile(r"(?P<tag>.+?): (?P<data>.+)?", re.I)
+    ikpat2 = re.compile(r"(?P<tag>[a-zA-Z ()]+)", re.I)
+
+    # Lists of tags known to be at a certain depth of the tree, to be used as
+    # attributes rather than nodes or ignored altogether
+    tags_1L = ["Product_Order_Metadata", "Source_Image_Metadata", "Product_Space_Metadata",
+               "Product_Component_Metadata"]
+    tags_2L = ["Source_Image_ID", "Component_ID"]
+    tags_coords = ["Latitude", "Longitude", "Map_X_(Easting)", "Map_Y_(Northing)",
+                   "UL_Map_X_(Easting)", "UL_Map_Y_(Northing)"]
+    ignores = ["Company Information", "Address", "GeoEye", "12076 Grant Street",
+              "Thornton, Colorado 80241", "U.S.A.", "Contact Information",
+              "On the Web: http://www.geoeye.com", "Customer Service Phone (U.S.A.): 1.800.232.9037",
+              "Customer Service Phone (World Wide): 1.703.480.5670",
+              "Customer Service Fax (World Wide): 1.703.450.9570", "Customer Service Email: info@geoeye.com",
+              "Customer Service Center hours of operation:", "Monday - Friday, 8:00 - 20:00 Eastern Standard Time"
+              ]
+
+    # Start processing
+    root = ET.Element("root")
+    parent = None
+    current = root
+    node_stack = []
+
+    for line in metaf:
+        item = line.strip()
+        if item in ignores:
+            continue  # Skip this stuff
+
+        # Can't have spaces or slashes in node tags
+        item = item.replace(" ", "_").replace("/", "_")
+
+        # If we've found a top-level group name, handle it here
+        if item in tags_1L:
+            child = ET.SubElement(root, item)
+            node_stack = []  # top-level nodes are children of root so reset
+            parent = root
+            current = child
+
+        # Everything else
+        else:
+            mat1 = ikpat1.search(line)
+            mat2 = ikpat2.search(line) if not mat1 else None
+
+            # Tag/value pair
+            if mat1:
+                tag = mat1.group("tag").strip().replace(" ", "_").replace("/", "_")
+                if mat1.group("data"):
+                    data = mat1.group("data").strip()
+                else:
+                    data = ""
+
+                # Second-level groups define major blocks
+                if tag in tags_2L:
+                    # We may have been working on a different second-level tag, so
+                    # reset the stack and pointers as needed
+                    while current.tag not in tags_1L and current.tag != "root":
+                        current = parent
+                        parent = node_stack.pop()
+
+                    # Now add the new child node
+                    child = ET.SubElement(current, tag)
+                    child.set("id", data)  # Currently, all 2L tags are IDs
+                    node_stack.append(parent)
+                    parent = current
+                    current = child
+
+                # Handle 'Coordinate' tags as a special case
+                elif tag == "Coordinate":
+                    # If we were working on a Coordinate, back up a level
+                    if current.tag == "Coordinate":
+                        child = ET.SubElement(parent, tag)
+                        child.set("id", data)
+                        current = child
+                    else:
+                        child = ET.SubElement(current, tag)
+                        child.set("id", data)
+                        node_stack.append(parent)
+                        parent = current
+                        current = child
+
+                # Vanilla tag/value pair
+                else:
+                    # Adjust depth if we just finished a Coordinate block
+                    if tag not in tags_coords and current.tag == "Coordinate":
+                        while current.tag not in tags_2L and current.tag not in tags_1L and current.tag != "root":
+                            current = parent
+                            parent = node_stack.pop()
+
+                    # Add a standard node
+                    child = ET.SubElement(current, tag)
+                    child.text = data
+
+            # Handle new group names
+            elif mat2:
+                tag = mat2.group("tag").strip()
+
+                # Except for Coordinates there aren't really any 4th level tags we care about, so we always
+                # back up until current points at a second or top-level node
+                while current.tag not in tags_2L and current.tag not in tags_1L and current.tag != "root":
+                    current = parent
+                    parent = node_stack.pop()
+
+                # Now add the new group node
+                child = ET.SubElement(current, tag)
+                node_stack.append(parent)
+                parent = current
+                current = child
+
+    return ET.ElementTree(root)
+
+
+def getGEMetadataAsXml(metafile):
+    if os.path.isfile(metafile):
+        try:
+            metaf = open(metafile, "r")
+        except IOError, err:
+            logger.error("Could not open metadata file %s because %s" % (metafile, err))
+            raise
+    else:
+        logger.error("Metadata file %s not found" % metafile)
+        return None
+
+    # These tags use the following tag/value as an attribute of the group rather than
+    # a standalone node
+    group_tags = {"aoiGeoCoordinate":"coordinateNumber",
+                  "aoiMapCoordinate":"coordinateNumber",
+                  "bandSpecificInformation":"bandNumber"}
+
+    # Start processing
+    root = ET.Element("root")
+    parent = None
+    current = root
+    node_stack = []
+    mlstr = False  # multi-line string flag
+
+    for line in metaf:
+        # mlstr will be true when working on a multi-line string
+        if mlstr:
+            if not line.strip() == ");":
+                data += line.strip()
+            else:
+                data += line.strip()
+                child = ET.SubElement(current, tag)
+                child.text = data
+                mlstr = False
+
+        # Handle tag/value pairs and groups
+        mat1 = GE_PAT_PAIR.search(line)
+        if mat1:
+            tag = mat1.group("tag").strip()
+            data = mat1.group("data").strip()
+
+            if tag == "BEGIN_GROUP":
+                if data is None or data == "":
+                    child = ET.SubElement(current, "group")
+                else:
+                    child = ET.SubElement(current, data)
+                if parent:
+                    node_stack.append(parent)
+                parent = current
+                current = child
+            elif tag == "END_GROUP":
+                current = parent if parent else root
+                parent = node_stack.pop() if node_stack else None
+            else:
+                if current.tag in group_tags and tag == group_tags[current.tag]:
+                    current.set(tag, data)
+                else:
+                    child = ET.SubElement(current, tag)
+                    child.text = data
+        else:
+            mat2 = GE_PAT_MLSTR.search(line)
+            if mat2:
+                tag = mat2.group("tag").strip()
+                data = ""
+                mlstr = True
+
+    metaf.close()
+    return ET.ElementTree(root)
@@ -1,12 +1,15 @@
-import os, string, sys, shutil, glob, re, tarfile, logging, argparse
+import os, string, sys, shutil, glob, re, tarfile, logging, argparse, threading, json, struct
 from datetime import *
 from subprocess import *
+from multiprocessing.pool import ThreadPool
 from math import *
 from xml.etree import cElementTree as ET
 
 import gdal, ogr,osr, gdalconst
 import numpy
 
+from lib import metadata, scene_table, footprint_cache, resources, scoring
+
 logger = logging.getLogger("logger")
 logger.setLevel(logging.DEBUG) 
 
@@ -14,6 +17,34 @@ MODES = ["ALL","MOSAIC","SHP","TEST"]
 EXTS = [".tif"]
 GTIFF_COMPRESSIONS = ["jpeg95","lzw"]
 
+#### Threads per core used to read image headers (the reads wait on storage rather than the CPU)
+IO_THREADS_PER_CPU = 4
+MAX_IO_THREADS = 32
+
+#### Maximum grid cells per side of an ImageIndex
+MAX_INDEX_CELLS = 1024
+
+#### Lines and pixels per read when tracing image outlines
+TRIM_READ_ROWS = 256
+TRIM_READ_PIXELS = 64 * 1024 * 1024
+
+#### Footprint modes and the polygonized footprint sidecar (saved as <image><ext>)
+FOOTPRINT_MODES = ["default","polygonize"]
+FOOTPRINT_SIDECAR_EXT = ".footprint"
+FOOTPRINT_SIDECAR_VERSION = "FOOTPRINT 1"
+
+#### Largest mask (pixels on a side) polygonized unless full resolution is requested, the --footprint_overview
+#### value requesting full resolution, and the size of the specks and holes removed from the mask
+POLYGONIZE_MAX_SIZE = 4096
+FOOTPRINT_FULL_RESOLUTION = -1
+POLYGONIZE_SIEVE_PIXELS = 4
+
+#### Fraction of the extent area that may stay uncovered when the overlay stops early
+OVERLAY_COVERAGE_TOLERANCE = 1e-6
+
+_shared_strings = {}
+_shared_strings_lock = threading.Lock()
+
 #class Attribs:
 #    def __init__(self,dAttribs):
 #        self.cc = dAttribs["cc"]
@@ -50,19 +81,38 @@ def buildMosaicParentArgumentParser():
                         help="do not sort images by metadata. script uses the order of the input textfile or directory (first image is first drawn).  Not recommended if input is a directory; order will be random")
     parser.add_argument("--use_exposure", action="store_true", default=False,
                         help="use exposure settings in metadata to inform score")
+    parser.add_argument("--score_weights", nargs=4, type=float, metavar=("CC","SUNEL","ONA","DATEDIFF"),
+                        help="score weights for cloud cover, sun elevation, off-nadir angle and target day proximity (default is 48 28 24 0, or 30 10 5 55 with --tday)")
     parser.add_argument("--exclude",
                         help="file of SCENE_IDs to exclude")
+    parser.add_argument("--scene_table",
+                        help="scene metadata table built by pgc_build_scene_table.py to look up scoring values")
+    parser.add_argument("--footprint_cache",
+                        help="SQLite file caching image properties and footprints between runs (created if it does not exist)")
+    parser.add_argument("--footprint_mode", choices=FOOTPRINT_MODES, default="default",
+                        help="image footprints: default- bounding box (RPC corners for raw images) for tile selection and an edge trace for cutlines, polygonize- polygons of the image data mask, saved beside each image for reuse (default=default)")
+    parser.add_argument("--footprint_overview", type=int,
+                        help="read image data masks for footprints from this overview level (0 is the first overview), or at full resolution with %i.  By default, and for images without the level, polygonized masks are read from the first overview no larger than %i pixels on a side, or decimated to that size" %(FOOTPRINT_FULL_RESOLUTION,POLYGONIZE_MAX_SIZE))
 
     return parser
 
 
-class ImageInfo:
-    def __init__(self,srcfp,frmt,logger):
+class ImageInfo(object):
+    
+    #### Slots keep per-image memory small when planning very large mosaics
+    __slots__ = ("srcfp","srcdir","srcfn","frmt","geom","sensor","acqdate","xsize","ysize","proj","bands",
+                 "datatype","datatype_readable","xres","yres","gtf","score","attribs","factors")
+    
+    def __init__(self,srcfp,frmt,logger,cache=None):
                 
         self.srcfp = srcfp
         self.srcdir, self.srcfn = os.path.split(srcfp)
         self.frmt = frmt  #image format (raw, warped)
         self.geom = None
+        self.gtf = None
+        self.score = None
+        self.attribs = None
+        self.factors = None
         self.sensor = None
         for s in ['WV01','WV02','QB02','GE01','IK01']:
             if s in self.srcfn:
@@ -75,22 +125,36 @@ class ImageInfo:
         else:
             self.acqdate = ""
         
+        #### Use cached raster properties if the image has not changed
+        cached = cache.getImageInfo(self.srcfp) if cache is not None else None
+        if cached is not None:
+            for k,v in cached.iteritems():
+                setattr(self,k,v)
+            self.proj = shareString(self.proj)
+            return
+        
+        #### Read all header values from one open
         ds = gdal.Open(self.srcfp)
         if ds is not None:
             self.xsize = ds.RasterXSize
             self.ysize = ds.RasterYSize
-            self.proj = ds.GetProjectionRef() if ds.GetProjectionRef() != '' else ds.GetGCPProjection()
+            self.proj = shareString(ds.GetProjectionRef() if ds.GetProjectionRef() != '' else ds.GetGCPProjection())
             self.bands = ds.RasterCount
             self.datatype = ds.GetRasterBand(1).DataType
             self.datatype_readable = gdal.GetDataTypeName(self.datatype)
 
             if self.frmt == "warped":
-                gtf = ds.GetGeoTransform()
-                self.xres = abs(gtf[1])
-                self.yres = abs(gtf[5])
+                self.gtf = ds.GetGeoTransform()
+                self.xres = abs(self.gtf[1])
+                self.yres = abs(self.gtf[5])
             else:
                 self.xres = None
                 self.yres = None
+            
+            if cache is not None:
+                cache.putImageInfo(self.srcfp,self)
+                if self.gtf is not None:
+                    cache.putFootprint(self.srcfp,footprint_cache.BBOX,"",self.getBBox()[0])
         else:
             logger.warning("Cannot open image: %s" %self.srcfp)
             self.xsize = None
@@ -105,208 +169,90 @@ class ImageInfo:
         ds = None
     
     
-    def getScore(self,params,logger):
+    def getBBox(self,cache=None):
+        """
+        Return the bounding box geometry and x and y bounds of a warped image.  The geotransform read when the
+        object was built is used if available, so the image is not opened again.
+        """
+        
+        if self.gtf is not None:
+            return bboxFromGeoTransform(self.gtf,self.xsize,self.ysize)
+        return getGeom(self.srcfp,cache)
+    
+    
+    def getScoreAttributes(self,params,logger):
+        """
+        Return the dict of metadata values used for scoring (cc, sunel, ona, date, tdi), or None if the
+        metadata cannot be read.  Values not found in the metadata are None.
+        """
         
-        score = 0
         metad = None
-        dAttribs = None
+        metapath = None
         
         if self.frmt == "warped":
-            
             metapath = os.path.splitext(self.srcfp)[0]+'.xml'
-            if os.path.isfile(metapath):
-                try:
-                    metad = ET.parse(metapath)
-                except ET.ParseError, err:
-                    logger.warning("ERROR parsing metadata: %s, %s" %(err,metapath))
-            else:
-                logger.warning("No metadata xml exists for %s" %self.srcfp)
-            
             
         elif self.frmt == "raw":
             
             if self.sensor in ['WV01','QB02','WV02']:
                 metapath = os.path.splitext(self.srcfp)[0]+'.xml'
-                if os.path.isfile(metapath):
-                    try:
-                        metad = ET.parse(metapath)
-                    except ET.ParseError, err:
-                        logger.warning("ERROR parsing metadata: %s, %s" %(err,metapath))
-                else:
-                    logger.warning("No metadata xml exists for %s" %self.srcfp)
-                    
                   
             ####  If GE
             elif self.sensor in ['GE01']:
                 metapath = os.path.splitext(self.srcfp)[0]+'.txt'
-                if os.path.isfile(metapath):
-                    try:
-                        metad = getGEMetadataAsXml(metapath)
-                    except ET.ParseError, err:
-                        logger.warning("ERROR parsing metadata: %s, %s" %(err,metapath))
-                else:
-                    logger.warning("No metadata xml exists for %s" %self.srcfp)
             
             #### Write IK01 code        
             #elif self.sensor in ['IK01']:
+        
+        if metapath is not None:
+            if os.path.isfile(metapath):
+                try:
+                    metad = scene_table.getSceneAttributes(metapath,params.scene_table)
+                except (ET.ParseError, IOError), err:
+                    logger.warning("ERROR parsing metadata: %s, %s" %(err,metapath))
+            else:
+                logger.warning("No metadata xml exists for %s" %self.srcfp)
+        
+        if metad is None:
+            return None
                     
         dAttribs = {
-            "cc":None,
-            "sunel":None,
-            "ona":None,
-            "date":None,
+            "cc":metad.cc,
+            "sunel":metad.sunel,
+            "ona":metad.ona,
+            "date":metad.firstlinetime,
             "tdi":None
         }
-    
-        dTags = {
-            "CLOUDCOVER":"cc",
-            "MEANSUNEL":"sunel",
-            "MEANOFFNADIRVIEWANGLE":"ona",
-            "FIRSTLINETIME":"date",
-            "TDILEVEL":"tdi",
-            "percentCloudCover":"cc",
-            "firstLineSunElevationAngle":"sunel",
-            "firstLineElevationAngle":"ona",
-            "firstLineAcquisitionDateTime":"date",
-            "tdiMode":"tdi"
-        }
         
-        if metad is not None:
-            
-            for tag in dTags:
-                taglist = metad.findall(".//%s"%tag)
-                vallist = []
-                for elem in taglist:
-                    
-                    text = elem.text
-                
-                    if text is not None:
-                        try:
-                            if tag == "firstLineElevationAngle":
-                                val = 90 - float(text)
-                            elif tag == "FIRSTLINETIME" or tag == "firstLineAcquisitionDateTime":
-                                val = text
-                            elif tag == "percentCloudCover":
-                                val = float(text)/100
-                            else:
-                                val = float(text)
-                                
-                            vallist.append(val)
-                            
-                        except Exception, e:
-                            logger.warning("Error reading metadata values: %s, %s" %(metapath,e))
-                            
-                if dTags[tag] == 'tdi' and len(taglist) > 1:    
-                    #### use pan or green band TDI for exposure calculation
-                    if len(vallist) == 4:
-                        dAttribs['tdi'] = vallist[1]
-                    elif len(vallist) == 5 and self.bands == 1: #pan image
-                        dAttribs['tdi'] = vallist[4]
-                    elif len(vallist) == 5 and self.bands in [3,4]: #multi image
-                        dAttribs['tdi'] = vallist[1]
-                    elif len(vallist) == 8:
-                        dAttribs['tdi'] = vallist[3]
-                    else:
-                        logger.warning("Unexpected number of TDI values and band count ( TDI: expected 1, 4, 5, or 8 - found %d ; Band cound, expected 1, 4, or 8 - found %d) %s" %(len(vallist), self.bands, metapath))
-                        
-                elif len(taglist) == 1:
-                    val = vallist[0]
-                    dAttribs[dTags[tag]] = val
-                    
-                elif len(taglist) <> 0:
-                    logger.warning("Unexpected number of %s values, %s" %(tag,metapath))
-            
-            #### Test if all required values were found in metadata search
-            status = [val is None for val in dAttribs.values()]
-            
-            if sum(status) != 0:
-                logger.warning("Cannot determine score for image %s: %s" %(self.srcfp,str(dAttribs)))
-                score = -1
-            
-            #### Assign panfactor if pan images are to be included in a multispectral mosaic   
+        vallist = metad.tdi
+        if len(vallist) > 1:    
+            #### use pan or green band TDI for exposure calculation
+            if len(vallist) == 4:
+                dAttribs['tdi'] = vallist[1]
+            elif len(vallist) == 5 and self.bands == 1: #pan image
+                dAttribs['tdi'] = vallist[4]
+            elif len(vallist) == 5 and self.bands in [3,4]: #multi image
+                dAttribs['tdi'] = vallist[1]
+            elif len(vallist) == 8:
+                dAttribs['tdi'] = vallist[3]
             else:
-                if self.bands == 1 and params.force_pan_to_multi is True:
-                    panfactor = 0.5
-                else:
-                    panfactor = 1
-                
-                dAttribs["panfact"] = panfactor
-                
-                
-                #### Parse target day and assign weights
-                if params.m == 0:
-                    date_diff = -9999
-                    ccwt = 48
-                    sunelwt = 28
-                    onawt = 24
-                    datediffwt = 0
-                    
-                else:
-                    cd = datetime.strptime(dAttribs["date"],"%Y-%m-%dT%H:%M:%S.%fZ")
-                    
-                    #### Find nearest year for target day
-                    tdeltas = []
-                    for y in range(cd.year-1,cd.year+2):
-                        tdeltas.append(abs((datetime(y,params.m,params.d) - cd).days))
-                    
-                    date_diff = min(tdeltas)
-                    ccwt = 30
-                    sunelwt = 10
-                    onawt = 5
-                    datediffwt = 55
-                
-                dAttribs["datediff"] = date_diff
+                logger.warning("Unexpected number of TDI values and band count ( TDI: expected 1, 4, 5, or 8 - found %d ; Band cound, expected 1, 4, or 8 - found %d) %s" %(len(vallist), self.bands, metapath))
                 
-                
-                #### Remove images with high exposure settings (tdi_pan (or tdi_grn) * sunel)
-                exfact = float(dAttribs["tdi"]) * float(dAttribs["sunel"])
-                dAttribs["exfact"] = exfact
-                
-                if params.useExposure is True:
-                    
-                    pan_exposure_thresholds = {
-                        "WV01":1400,
-                        "WV02":1400,
-                        "QB02":500,
-                        #"GE01":,
-                    }
-                    
-                    multi_exposure_thresholds = {
-                        "WV02":400,
-                        "GE01":170,
-                        "QB02":25,
-                    }
-                    
-                    if params.bands == 1:
-                        if self.sensor in pan_exposure_thresholds:
-                            if exfact > pan_exposure_thresholds[self.sensor]:
-                                logger.warning("Image overexposed: %s --> %i" %(self.srcfp,exfact))
-                                score = -1
-                    
-                    else:
-                        if self.sensor in multi_exposure_thresholds:
-                            if exfact > multi_exposure_thresholds[self.sensor]:
-                                logger.warning("Image overexposed: %s --> %i" %(self.srcfp,exfact))
-                                score = -1
-                        
-                #### Handle nonesense or nodata cloud cover values
-                if float(dAttribs["cc"]) < 0 or float(dAttribs["cc"]) > 1:
-                    dAttribs["cc"] = 0.5
-                
-                if float(dAttribs["cc"]) > 0.5:
-                    logger.warning("Image too cloudy: %s --> %f" %(self.srcfp,float(dAttribs["cc"])))
-                    score = -1
-                        
-                #try:
-                #
-                #except TypeError, err:
-                #    logger.warning("Error calculating score for image %s: %e" %(self.srcfp,err))
-                #    score = -1
-                
-                if not score == -1:
-                    rawscore = ccwt * (1-float(dAttribs["cc"])) + sunelwt * (float(dAttribs["sunel"])/90) + onawt * ((90-float(dAttribs["ona"]))/90.0) + datediffwt * ((183 - date_diff)/183.0)
-                    score = rawscore * panfactor  
-            
+        elif len(vallist) == 1:
+            dAttribs['tdi'] = vallist[0]
+        
+        return dAttribs
+    
+    
+    def getScore(self,params,logger):
+        
+        score = 0
+        dAttribs = self.getScoreAttributes(params,logger)
+        
+        if dAttribs is None:
+            dAttribs = dict((k,None) for k in ("cc","sunel","ona","date","tdi"))
+        else:
+            score = scoreImageAttributes([self],[dAttribs],params,logger)[0]
               
         return score, dAttribs
     
@@ -328,17 +274,323 @@ class TileParams:
         self.geom = ogr.CreateGeometryFromWkt(poly_wkt)
         
 
+class ImageIndex(object):
+    """
+    Uniform grid index of geometry bounding boxes.  Envelopes are held in numpy arrays and each grid cell lists
+    the geometries whose envelope touches it, so a query returns candidate indices without testing every
+    geometry.  Candidates still need an exact geometry test.
+    """
+    
+    def __init__(self, geoms, cellsize=None):
+        
+        n = len(geoms)
+        env = numpy.array([g.GetEnvelope() for g in geoms], dtype=numpy.float64).reshape(n,4)
+        self.minx = env[:,0].copy()
+        self.maxx = env[:,1].copy()
+        self.miny = env[:,2].copy()
+        self.maxy = env[:,3].copy()
+        self.cells = {}
+        
+        if n == 0:
+            self.cellsize = 1
+            self.x0 = self.y0 = 0
+            self.ncols = self.nrows = 0
+            return
+        
+        self.x0 = self.minx.min()
+        self.y0 = self.miny.min()
+        
+        #### Default cell is the median footprint size, limited to MAX_INDEX_CELLS per side
+        if cellsize is None:
+            cellsize = max(numpy.median(self.maxx - self.minx), numpy.median(self.maxy - self.miny))
+            cellsize = max(cellsize, (self.maxx.max() - self.x0) / MAX_INDEX_CELLS, (self.maxy.max() - self.y0) / MAX_INDEX_CELLS)
+            if cellsize <= 0:
+                cellsize = 1
+        self.cellsize = cellsize
+        
+        c0, c1, r0, r1 = self._cellRange(self.minx, self.maxx, self.miny, self.maxy)
+        self.ncols = int(c1.max()) + 1
+        self.nrows = int(r1.max()) + 1
+        cells = {}
+        for k in xrange(n):
+            for c in xrange(c0[k], c1[k]+1):
+                for r in xrange(r0[k], r1[k]+1):
+                    cells.setdefault((c,r),[]).append(k)
+        for key, members in cells.iteritems():
+            self.cells[key] = numpy.array(members, dtype=numpy.int64)
+    
+    
+    def _cellRange(self, minx, maxx, miny, maxy):
+        c0 = numpy.floor((numpy.asarray(minx) - self.x0) / self.cellsize).astype(numpy.int64)
+        c1 = numpy.floor((numpy.asarray(maxx) - self.x0) / self.cellsize).astype(numpy.int64)
+        r0 = numpy.floor((numpy.asarray(miny) - self.y0) / self.cellsize).astype(numpy.int64)
+        r1 = numpy.floor((numpy.asarray(maxy) - self.y0) / self.cellsize).astype(numpy.int64)
+        return c0, c1, r0, r1
+    
+    
+    def query(self, minx, maxx, miny, maxy):
+        """
+        Return the sorted indices of geometries whose envelope intersects the given extent
+        """
+        
+        c0, c1, r0, r1 = self._cellRange(minx, maxx, miny, maxy)
+        members = []
+        for c in xrange(max(int(c0),0), min(int(c1),self.ncols-1)+1):
+            for r in xrange(max(int(r0),0), min(int(r1),self.nrows-1)+1):
+                if (c,r) in self.cells:
+                    members.append(self.cells[(c,r)])
+        if len(members) == 0:
+            return []
+        
+        cands = numpy.unique(numpy.concatenate(members))
+        hits = (self.minx[cands] <= maxx) & (self.maxx[cands] >= minx) & (self.miny[cands] <= maxy) & (self.maxy[cands] >= miny)
+        return cands[hits].tolist()
+    
+
+def getTileIntersects(tiles, imginfo_list):
+    """
+    Return, for each tile, the list of images whose geometry intersects the tile, in the order of imginfo_list.
+    An ImageIndex limits the exact geometry tests to images whose bounding box overlaps the tile.
+    """
+    
+    index = ImageIndex([iinfo.geom for iinfo in imginfo_list])
+    tile_intersects = []
+    for t in tiles:
+        intersects = []
+        for k in index.query(t.minx, t.maxx, t.miny, t.maxy):
+            if t.geom.Intersect(imginfo_list[k].geom) is True:
+                intersects.append(imginfo_list[k])
+        tile_intersects.append(intersects)
+    return tile_intersects
+
+
+def writeTileIntersects(path, imginfo_list, tiles, tile_intersects):
+    """
+    Write the tile to image mapping to a json file: the ordered list of image paths and, for each tile name,
+    the positions of its images in that list.
+    """
+    
+    positions = dict((iinfo.srcfp, k) for k, iinfo in enumerate(imginfo_list))
+    mapping = {
+        "images": [iinfo.srcfp for iinfo in imginfo_list],
+        "tiles": dict((os.path.basename(t.name), [positions[iinfo.srcfp] for iinfo in intersects])
+                      for t, intersects in zip(tiles, tile_intersects) if len(intersects) > 0),
+    }
+    
+    data = json.dumps(mapping, sort_keys=True)
+    
+    #### Leave an unchanged file alone, so the cutlines built from it are still newer than it
+    if os.path.isfile(path):
+        f = open(path, "r")
+        old = f.read()
+        f.close()
+        if old == data:
+            return
+    
+    tmp = path + ".tmp"
+    f = open(tmp, "w")
+    f.write(data)
+    f.close()
+    os.rename(tmp, path)
+
+
+def readIntersectsFile(path, tile=None):
+    """
+    Return the list of image paths in an intersects file.  Text files list one image per line.  For a tile
+    intersects json file, the images of the named tile are returned, or all images if tile is None.
+    """
+    
+    if os.path.splitext(path)[1].lower() == ".json":
+        f = open(path, "r")
+        mapping = json.load(f)
+        f.close()
+        images = [str(image) for image in mapping["images"]]
+        if tile is None:
+            return images
+        return [images[k] for k in mapping["tiles"].get(os.path.basename(tile), [])]
+    
+    intersects = []
+    t = open(path, "r")
+    for line in t.readlines():
+        line = line.rstrip('\n').rstrip('\r')
+        if line:
+            intersects.append(line)
+    t.close()
+    return intersects
+    
+
+def shareString(s):
+    
+    #### Return a shared copy of a repeated string (e.g. projection wkt) so each image does not hold its own
+    if s is None:
+        return None
+    with _shared_strings_lock:
+        return _shared_strings.setdefault(s,s)
+
+
+def buildImageInfoList(image_list,frmt,logger,cache=None,threads=None):
+    """
+    Build ImageInfo objects for a list of images with a thread pool so the header reads of many images on
+    network storage overlap.  The returned list is in the order of image_list.
+    """
+    
+    if threads is None:
+        threads = min(MAX_IO_THREADS, resources.getAvailableCpus() * IO_THREADS_PER_CPU)
+    
+    if threads <= 1 or len(image_list) <= 1:
+        return [ImageInfo(image,frmt,logger,cache) for image in image_list]
+    
+    pool = ThreadPool(threads)
+    try:
+        imginfo_list = pool.map(lambda image: ImageInfo(image,frmt,logger,cache), image_list, 64)
+    finally:
+        pool.close()
+        pool.join()
+    
+    return imginfo_list
+
+
+def scoreImageAttributes(imginfo_list,attribs_list,params,logger):
+    """
+    Score images from their scoring attribute dicts in one batch.  The dicts are updated with the values
+    derived while scoring (panfact, datediff, exfact, adjusted cc) and the list of scores is returned.
+    """
+    
+    scenes = scoring.SceneArrays(attribs_list,[iinfo.sensor for iinfo in imginfo_list],[iinfo.bands for iinfo in imginfo_list])
+    result = scoring.scoreScenes(scenes,params)
+    
+    scores = []
+    for i,iinfo in enumerate(imginfo_list):
+        dAttribs = attribs_list[i]
+        reject = result["reject"][i]
+        
+        #### Test if all required values were found in metadata search
+        if reject & scoring.REJECT_MISSING:
+            logger.warning("Cannot determine score for image %s: %s" %(iinfo.srcfp,str(dAttribs)))
+            scores.append(-1)
+            continue
+        
+        dAttribs["panfact"] = float(result["panfact"][i])
+        dAttribs["datediff"] = int(result["datediff"][i])
+        dAttribs["exfact"] = float(result["exfact"][i])
+        dAttribs["cc"] = float(result["cc"][i])
+        
+        if reject & scoring.REJECT_OVEREXPOSED:
+            logger.warning("Image overexposed: %s --> %i" %(iinfo.srcfp,dAttribs["exfact"]))
+        if reject & scoring.REJECT_CLOUDY:
+            logger.warning("Image too cloudy: %s --> %f" %(iinfo.srcfp,dAttribs["cc"]))
+        
+        scores.append(float(result["score"][i]))
+    
+    return scores
+
+
+def scoreImages(imginfo_list,params,logger):
+    """
+    Read the scoring attributes of a list of images and score them in one batch, setting the score and
+    attribs of each ImageInfo.  Images without readable metadata get a score of 0.
+    """
+    
+    scored = []
+    attribs_list = []
+    for iinfo in imginfo_list:
+        dAttribs = iinfo.getScoreAttributes(params,logger)
+        if dAttribs is None:
+            iinfo.score = 0
+            iinfo.attribs = dict((k,None) for k in ("cc","sunel","ona","date","tdi"))
+        else:
+            scored.append(iinfo)
+            attribs_list.append(dAttribs)
+    
+    if len(scored) > 0:
+        scores = scoreImageAttributes(scored,attribs_list,params,logger)
+        for iinfo, dAttribs, score in zip(scored,attribs_list,scores):
+            iinfo.score = score
+            iinfo.attribs = dAttribs
+
+
+def overlayImages(imginfo_list,extent_geom,logger):
+    """
+    Find the visible part of each image within an extent.  imginfo_list is ordered from lowest to highest
+    priority (the last image is drawn on top).  Images are walked from the top down; the visible parts found so
+    far are disjoint and cover the union of the higher priority footprints, so each image needs a single
+    difference against the cascaded union of the parts its bounding box overlaps.  The walk stops once the
+    extent is covered.  Returns a list of (ImageInfo, visible geometry) for the contributing images, in the
+    order of imginfo_list.
+    """
+    
+    n = len(imginfo_list)
+    extent_area = extent_geom.GetArea()
+    covered_area = 0.0
+    parts = []
+    envs = numpy.zeros((n,4))
+    contribs = []
+    
+    for k in xrange(n-1,-1,-1):
+        iinfo = imginfo_list[k]
+        
+        if covered_area >= extent_area * (1 - OVERLAY_COVERAGE_TOLERANCE):
+            logger.info("Extent is fully covered, removing %i non-contributing images" %(k+1))
+            for iinfo in imginfo_list[:k+1]:
+                logger.debug("Removing non-contributing image: %s" %iinfo.srcfp)
+            break
+        
+        geom = iinfo.geom.Intersection(extent_geom)
+        if geom is not None and not geom.IsEmpty() and len(parts) > 0:
+            minx, maxx, miny, maxy = geom.GetEnvelope()
+            m = len(parts)
+            hits = numpy.nonzero((envs[:m,0] <= maxx) & (envs[:m,1] >= minx) & (envs[:m,2] <= maxy) & (envs[:m,3] >= miny))[0]
+            if len(hits) > 0:
+                covered = ogr.Geometry(ogr.wkbMultiPolygon)
+                for h in hits:
+                    addPolygons(covered,parts[h])
+                covered = covered.UnionCascaded()
+                if covered is None:
+                    geom = None
+                else:
+                    geom = geom.Difference(covered)
+        
+        if geom is None:
+            logger.info("Function Error: %s" %iinfo.srcfp)
+        elif geom.IsEmpty():
+            logger.info("Removing non-contributing image: %s" %iinfo.srcfp)
+        else:
+            envs[len(parts)] = geom.GetEnvelope()
+            parts.append(geom)
+            covered_area += geom.GetArea()
+            contribs.append((iinfo,geom))
+    
+    contribs.reverse()
+    return contribs
+
+
+def addPolygons(multi,geom):
+    
+    #### Add the polygons of a geometry (polygon, multipolygon or collection) to a multipolygon
+    name = geom.GetGeometryName()
+    if name == "POLYGON":
+        multi.AddGeometry(geom)
+    elif name in ("MULTIPOLYGON","GEOMETRYCOLLECTION"):
+        for i in xrange(geom.GetGeometryCount()):
+            addPolygons(multi,geom.GetGeometryRef(i))
+
+
 def filterMatchingImages(imginfo_list,params,logger):
     imginfo_list2 = []
     
+    #### Projection comparisons are cached by projection wkt
+    rp = osr.SpatialReference()
+    rp.ImportFromWkt(params.proj)
+    proj_matches = {}
+    
     for iinfo in imginfo_list:
         #print iinfo.srcfp, iinfo.proj
         isSame = True
-        p = osr.SpatialReference()
-        p.ImportFromWkt(iinfo.proj)
-        rp = osr.SpatialReference()
-        rp.ImportFromWkt(params.proj)
-        if p.IsSame(rp) is False:
+        if iinfo.proj not in proj_matches:
+            p = osr.SpatialReference()
+            p.ImportFromWkt(iinfo.proj)
+            proj_matches[iinfo.proj] = p.IsSame(rp)
+        if proj_matches[iinfo.proj] is False:
             isSame = False
         if iinfo.bands != params.bands and not (params.force_pan_to_multi is True and iinfo.bands == 1):
             isSame = False
@@ -368,6 +620,11 @@ def getMosaicParameters(iinfo,options):
     params.proj = iinfo.proj
     params.datatype = iinfo.datatype
     params.useExposure = options.use_exposure
+    params.scene_table = options.scene_table
+    if options.score_weights is not None:
+        params.score_weights = dict(zip(scoring.FACTORS,options.score_weights))
+    else:
+        params.score_weights = None
     
     if options.tday is not None:
         params.m = int(options.tday.split("-")[0])
@@ -397,11 +654,27 @@ def getMosaicParameters(iinfo,options):
     return params
 
 
-def GetExactTrimmedGeom(image, step=2, tolerance=1):
+def GetExactTrimmedGeom(image, step=2, tolerance=1, cache=None, overview=None):
+    """
+    Return the simplified outline of the valid data of an image, traced from the first and last data pixel of
+    every step-th line, with the x and y bounds of the outline.  The raster is read in native block rows and
+    only two columns are kept per sampled line.  If overview is given and the image has that overview level,
+    the mask is read from the overview (step is then in overview lines) and scaled to full resolution.
+    """
     
     geom2 = None
-    geom = None
     xs,ys = [],[]
+    
+    #### Cached footprints only hold the geometry; xs and ys are then the envelope bounds
+    cache_params = "step=%d;tolerance=%r" %(step,tolerance)
+    if overview is not None:
+        cache_params += ";overview=%d" %overview
+    if cache is not None:
+        geom2 = cache.getFootprint(image,footprint_cache.TRIMMED,cache_params)
+        if geom2 is not None:
+            minx,maxx,miny,maxy = geom2.GetEnvelope()
+            return geom2,[minx,maxx],[miny,maxy]
+    
     ds = gdal.Open(image)
     if ds is not None:
         if ds.RasterCount > 0:
@@ -412,101 +685,309 @@ def GetExactTrimmedGeom(image, step=2, tolerance=1):
             if nd is None:
                 nd = 0
             
-            #print ("Image NoData Value: %d" %nd )
-            
             gtf = ds.GetGeoTransform()
-        
-            pixelst = []
-            pixelsb = []
-            pts = []
             
-            #### For every other line, find first and last data pixel
-            lines = xrange(0, inband.YSize, step)
+            #### Pick the band to read and its scale to full resolution pixels
+            band = inband
+            if overview is not None and 0 <= overview < inband.GetOverviewCount():
+                band = inband.GetOverview(overview)
+            xsize = band.XSize
+            ysize = band.YSize
+            colscale = float(inband.XSize) / xsize
+            rowscale = float(inband.YSize) / ysize
             
-            xsize = inband.XSize
-            npflatnonzero = numpy.flatnonzero
-            bandReadAsArray = inband.ReadAsArray
+            readrows = getBlockReadRows(band)
             
-            lines_flatnonzero = [npflatnonzero(bandReadAsArray(0,l,xsize,1) != nd) for l in lines]
-            i = 0
+            #### First and last data column of each sampled line, -1 if the line has no data
+            nlines = (ysize + step - 1) // step
+            firsts = numpy.empty(nlines, dtype=numpy.int32)
+            lasts = numpy.empty(nlines, dtype=numpy.int32)
             
-            for nz in lines_flatnonzero:
-                
-                nzmin = nz[0] if nz.size > 0 else 0
-                nzmax = nz[-1] if nz.size > 0 else 0
+            for y0 in xrange(0, ysize, readrows):
+                rows = min(readrows, ysize - y0)
+                offset = (-y0) % step
+                if offset >= rows:
+                    continue
+                mask = band.ReadAsArray(0, y0, xsize, rows)[offset::step] != nd
+                valid = mask.any(axis=1)
+                k = (y0 + offset) // step
+                firsts[k:k+len(mask)] = numpy.where(valid, mask.argmax(axis=1), -1)
+                lasts[k:k+len(mask)] = numpy.where(valid, xsize - 1 - mask[:,::-1].argmax(axis=1), -1)
+                mask = None
+            
+            #### Walk down the right edge of the data and back up the left edge
+            lines = numpy.nonzero(firsts >= 0)[0]
+            if len(lines) > 0:
+                px = numpy.concatenate((lasts[lines] + 1, firsts[lines][::-1], lasts[lines[:1]] + 1)) * colscale
+                ln = (numpy.concatenate((lines, lines[::-1], lines[:1])) * step + 0.5) * rowscale
                 
-                if nz.size > 0:
-                    pixelst.append((nzmax+1,i))
-                    pixelsb.append((nzmin,i))           
-                i += step
+                #### Pixel/line to georeferenced coordinates
+                x = gtf[0] + px * gtf[1] + ln * gtf[2]
+                y = gtf[3] + px * gtf[4] + ln * gtf[5]
+                xs = [x.min(),x.max()]
+                ys = [y.min(),y.max()]
                 
-            pixelsb.reverse()
-            pixels = pixelst + pixelsb
-            
-            #print len(pixels)
-            
-            for px in pixels:
-                x,y = pl2xy(gtf,inband,px[0],px[1])
-                xs.append(x)
-                ys.append(y)
-                pts.append((x,y))
-                #print px[0],px[1],x,y
-            
-            #### create geometry
-            poly_vts = []
-            for pt in pts:
-                poly_vts.append("%.16f %.16f" %(pt[0],pt[1]))
-            if len(pts) > 0:
-                poly_vts.append("%.16f %.16f" %(pts[0][0],pts[0][1]))
-            
-            if len(poly_vts) > 0:
-                poly_wkt = 'POLYGON (( %s ))' %(string.join(poly_vts,", "))
-                #print poly_wkt
+                #### Polygon WKB: byte order, type, ring count, point count, then the vertices
+                pts = numpy.empty((len(x),2), dtype='<f8')
+                pts[:,0] = x
+                pts[:,1] = y
+                wkb = struct.pack('<BIII', 1, ogr.wkbPolygon, 1, len(pts)) + pts.tostring()
                 
-                geom = ogr.CreateGeometryFromWkt(poly_wkt)
-                #print geom
-                #### Simplify geom
-                #logger.info("Simplification tolerance: %.10f" %tolerance)
+                geom = ogr.CreateGeometryFromWkb(wkb)
                 if geom is not None:
-                    geom2  = geom.Simplify(tolerance)
-            
+                    geom2 = geom.Simplify(tolerance)
             
         ds = None
+    
+    if cache is not None:
+        cache.putFootprint(image,footprint_cache.TRIMMED,cache_params,geom2)
 
     return geom2,xs,ys 
 
 
-def getGeom(image):
+def getBlockReadRows(band):
+    
+    #### Lines per read: whole block rows, at least TRIM_READ_ROWS lines and at most TRIM_READ_PIXELS
+    blockysize = band.GetBlockSize()[1]
+    readrows = blockysize * max(1, int(ceil(float(TRIM_READ_ROWS) / blockysize)))
+    return max(blockysize, min(readrows, blockysize * (TRIM_READ_PIXELS // (band.XSize * blockysize))))
+
+
+def getFootprintTolerance(params):
+    
+    #### 2 * avg(xres, yres), should be 1 for panchromatic mosaics where res = 0.5m
+    return 2.0 * ((params.xres + params.yres) / 2.0)
+
+
+def GetPolygonizedGeom(image, tolerance=1, overview=None, pixel=False):
+    """
+    Return the footprint of the valid data of an image, polygonized from its data mask, with the x and y
+    bounds.  Unlike the edge trace of GetExactTrimmedGeom the footprint keeps interior holes and concave edges.
+    The simplified footprint is saved in a sidecar beside the image and reused while the image and the
+    parameters are unchanged.  If pixel is True the footprint is in full resolution pixel/line coordinates.
+    """
+    
+    params = "overview=%s;max=%d;tolerance=%r;pixel=%d" %(overview,POLYGONIZE_MAX_SIZE,tolerance,int(pixel))
+    sidecar_p = image + FOOTPRINT_SIDECAR_EXT
+    
+    geom = ReadFootprintSidecar(sidecar_p,image,params)
+    if geom is None:
+        geom = PolygonizeMask(image,overview,pixel)
+        if geom is not None:
+            geom = geom.SimplifyPreserveTopology(tolerance)
+            WriteFootprintSidecar(sidecar_p,image,params,geom)
+    
+    if geom is None or geom.IsEmpty():
+        return None,[],[]
+    
+    minx,maxx,miny,maxy = geom.GetEnvelope()
+    return geom,[minx,maxx],[miny,maxy]
+
+
+def PolygonizeMask(image, overview=None, pixel=False):
+    """
+    Polygonize the valid data mask of an image and dissolve the polygons into one geometry.  The GDAL mask band
+    is used if the image has one, otherwise pixels not equal to the nodata value (0 if unset).  The mask is
+    read from the given overview level, or at full resolution if overview is FOOTPRINT_FULL_RESOLUTION.
+    Otherwise it is read from the first overview no larger than POLYGONIZE_MAX_SIZE, or decimated to that size.
+    """
+    
+    ds = gdal.Open(image)
+    if ds is None or ds.RasterCount == 0:
+        return None
+    
+    inband = ds.GetRasterBand(1)
+    band = None
+    if overview is not None and 0 <= overview < inband.GetOverviewCount():
+        band = inband.GetOverview(overview)
+    elif overview == FOOTPRINT_FULL_RESOLUTION:
+        band = inband
+    else:
+        for i in range(inband.GetOverviewCount()):
+            ov = inband.GetOverview(i)
+            if ov.XSize <= POLYGONIZE_MAX_SIZE and ov.YSize <= POLYGONIZE_MAX_SIZE:
+                band = ov
+                break
+    
+    #### Without a suitable overview, decimate the full resolution mask by a whole factor
+    step = 1
+    if band is None:
+        band = inband
+        step = int(ceil(float(max(inband.XSize, inband.YSize)) / POLYGONIZE_MAX_SIZE))
+    xsize = int(ceil(float(band.XSize) / step))
+    ysize = int(ceil(float(band.YSize) / step))
+    colscale = float(inband.XSize) / xsize
+    rowscale = float(inband.YSize) / ysize
+    
+    if pixel:
+        gtf = (0, colscale, 0, 0, 0, rowscale)
+    else:
+        g = ds.GetGeoTransform()
+        gtf = (g[0], g[1]*colscale, g[2]*rowscale, g[3], g[4]*colscale, g[5]*rowscale)
+    
+    srcmask = None
+    nd = inband.GetNoDataValue()
+    if nd is None:
+        nd = 0
+    if not band.GetMaskFlags() & gdal.GMF_ALL_VALID:
+        srcmask = band.GetMaskBand()
+    
+    #### Copy the mask to an in-memory byte raster
+    mem = gdal.GetDriverByName("MEM").Create("",xsize,ysize,1,gdal.GDT_Byte)
+    mem.SetGeoTransform(gtf)
+    maskband = mem.GetRasterBand(1)
+    
+    readrows = max(1, getBlockReadRows(band) // step)
+    for y0 in xrange(0, ysize, readrows):
+        rows = min(readrows, ysize - y0)
+        srcrows = min(rows * step, band.YSize - y0 * step)
+        if srcmask is not None:
+            mask = srcmask.ReadAsArray(0, y0 * step, band.XSize, srcrows, xsize, rows) != 0
+        else:
+            mask = band.ReadAsArray(0, y0 * step, band.XSize, srcrows, xsize, rows) != nd
+        maskband.WriteArray(mask.astype(numpy.uint8), 0, y0)
+        mask = None
+    
+    #### Merge specks and pinholes (such as isolated nodata valued pixels) into their surroundings
+    gdal.SieveFilter(maskband, None, maskband, POLYGONIZE_SIEVE_PIXELS, 4)
+    
+    #### Polygonize the valid pixels (the mask band masks itself) and dissolve
+    vds = ogr.GetDriverByName("Memory").CreateDataSource("mask")
+    lyr = vds.CreateLayer("mask", None, ogr.wkbPolygon)
+    lyr.CreateField(ogr.FieldDefn("DN", ogr.OFTInteger))
+    gdal.Polygonize(maskband, maskband, lyr, 0, [])
+    
+    multi = ogr.Geometry(ogr.wkbMultiPolygon)
+    feat = lyr.GetNextFeature()
+    while feat:
+        addPolygons(multi,feat.GetGeometryRef())
+        feat = lyr.GetNextFeature()
+    
+    geom = None
+    if multi.GetGeometryCount() > 0:
+        geom = multi.UnionCascaded()
+    
+    vds = None
+    mem = None
+    ds = None
+    return geom
+
+
+def ReadFootprintSidecar(sidecar_p, image, params):
+    """
+    Read a footprint sidecar and return its geometry, or None if the sidecar is missing or unreadable, or was
+    written for a different version of the image or different parameters.
+    """
+    
+    if not os.path.isfile(sidecar_p):
+        return None
+    
+    try:
+        st = os.stat(image)
+        f = open(sidecar_p,'rb')
+        try:
+            header = f.readline().rstrip("\n").split("\t")
+            if len(header) != 4 or header[0] != FOOTPRINT_SIDECAR_VERSION or int(header[1]) != st.st_size \
+                    or abs(float(header[2]) - st.st_mtime) > 0.001 or header[3] != params:
+                return None
+            wkb = f.read()
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError), e:
+        logger.debug("Cannot read footprint sidecar %s: %s" %(sidecar_p,e))
+        return None
+    
+    return ogr.CreateGeometryFromWkb(wkb)
+
+
+def WriteFootprintSidecar(sidecar_p, image, params, geom):
+    """
+    Write a footprint sidecar.  The sidecar is written to a temp file and renamed so readers never see a
+    partial file.  Failure to write (e.g. a read-only image directory) is not an error.
+    """
+    
+    temp_p = "%s.%d" %(sidecar_p, os.getpid())
+    try:
+        st = os.stat(image)
+        f = open(temp_p,'wb')
+        f.write("%s\t%d\t%r\t%s\n" %(FOOTPRINT_SIDECAR_VERSION, st.st_size, st.st_mtime, params))
+        f.write(geom.ExportToWkb())
+        f.close()
+        os.rename(temp_p, sidecar_p)
+    except (IOError, OSError), e:
+        logger.debug("Cannot write footprint sidecar %s: %s" %(sidecar_p,e))
+        if os.path.isfile(temp_p):
+            os.remove(temp_p)
+        return 1
+    
+    return 0
+
+
+def transformPixelGeom(geom, tf):
+    
+    #### Replace the pixel/line vertices of a geometry with coordinates from a gdal.Transformer, in place
+    if geom.GetGeometryCount() > 0:
+        for i in xrange(geom.GetGeometryCount()):
+            transformPixelGeom(geom.GetGeometryRef(i), tf)
+    else:
+        for i in xrange(geom.GetPointCount()):
+            rc, t_coords = tf.TransformPoint(0, geom.GetX(i), geom.GetY(i))
+            geom.SetPoint_2D(i, t_coords[0], t_coords[1])
+
+
+def getGeom(image, cache=None):
     
     geom = None
     xs,ys = [],[]
     
+    if cache is not None:
+        geom = cache.getFootprint(image,footprint_cache.BBOX)
+        if geom is not None:
+            minx,maxx,miny,maxy = geom.GetEnvelope()
+            return geom,[minx,maxx],[miny,maxy]
+    
     ds = gdal.Open(image)
     if ds is not None:
-    
-        xsize = ds.RasterXSize
-        ysize = ds.RasterYSize
-        gtf = ds.GetGeoTransform()
-        
-        #### create geometry
-        minx = gtf[0]
-        maxx = minx + xsize * gtf[1]
-        maxy = gtf[3]
-        miny = maxy + ysize * gtf[5]
-        poly_wkt = 'POLYGON (( '+str(minx)+' '+str(miny)+', '+str(minx)+' '+str(maxy)+', '+str(maxx)+' '+str(maxy)+', '+str(maxx)+' '+str(miny)+', '+str(minx)+' '+str(miny)+' ))'
-        geom = ogr.CreateGeometryFromWkt(poly_wkt)
-        
-        xs = [minx,maxx]
-        ys = [miny,maxy]
+        geom,xs,ys = bboxFromGeoTransform(ds.GetGeoTransform(),ds.RasterXSize,ds.RasterYSize)
     ds = None
+    
+    if cache is not None:
+        cache.putFootprint(image,footprint_cache.BBOX,"",geom)
         
     return geom,xs,ys
 
 
-def getRpcGeom(iinfo,dem,t_srs):
+def bboxFromGeoTransform(gtf,xsize,ysize):
+    
+    #### create geometry
+    minx = gtf[0]
+    maxx = minx + xsize * gtf[1]
+    maxy = gtf[3]
+    miny = maxy + ysize * gtf[5]
+    poly_wkt = 'POLYGON (( '+str(minx)+' '+str(miny)+', '+str(minx)+' '+str(maxy)+', '+str(maxx)+' '+str(maxy)+', '+str(maxx)+' '+str(miny)+', '+str(minx)+' '+str(miny)+' ))'
+    geom = ogr.CreateGeometryFromWkt(poly_wkt)
+    
+    return geom,[minx,maxx],[miny,maxy]
+
+
+def getRpcGeom(iinfo,dem,t_srs,cache=None,footprint_mode="default",overview=None):
     geom = None
     image = iinfo.srcfp
     
+    cache_params = t_srs.ExportToProj4()
+    #### Footprints computed against a different DEM (or a changed one) are not reused
+    if dem is not None:
+        stamp = footprint_cache.getStamp(dem)
+        cache_params += ";dem=%s" %os.path.abspath(dem)
+        if stamp is not None:
+            cache_params += ";dem_mtime=%r" %stamp[0]
+    if footprint_mode == "polygonize":
+        cache_params += ";polygonize;overview=%s;max=%d" %(overview,POLYGONIZE_MAX_SIZE)
+    if cache is not None:
+        geom = cache.getFootprint(image,footprint_cache.RPC,cache_params)
+        if geom is not None:
+            return geom
+    
     #### Create coordiante system transformation
     img_srs = osr.SpatialReference(iinfo.proj)
     imgct = osr.CoordinateTransformation(img_srs, t_srs)
@@ -550,6 +1031,19 @@ def getRpcGeom(iinfo,dem,t_srs):
         #to = ['METHOD=GCP_POLYNOMIAL']
         to = []
         tf = gdal.Transformer(ds, None, to)
+        
+        #### Polygonized data footprint in pixel coordinates, transformed vertex by vertex
+        if footprint_mode == "polygonize":
+            pxgeom = GetPolygonizedGeom(image,overview=overview,pixel=True)[0]
+            if pxgeom is not None:
+                geom = pxgeom.Clone()
+                transformPixelGeom(geom,tf)
+                geom.Transform(imgct)
+            
+            ds = None
+            if cache is not None:
+                cache.putFootprint(image,footprint_cache.RPC,cache_params,geom)
+            return geom
 
         #### Transform points
         pts = []
@@ -573,6 +1067,9 @@ def getRpcGeom(iinfo,dem,t_srs):
         geom = ogr.CreateGeometryFromWkt(poly_wkt)
         
     ds = None
+    
+    if cache is not None:
+        cache.putFootprint(image,footprint_cache.RPC,cache_params,geom)
         
     return geom
     
@@ -653,81 +1150,6 @@ def ExecCmd(cmd):
     print (so)
     
 
-def getGEMetadataAsXml(metafile):
-	if os.path.isfile(metafile):
-		try:
-			metaf = open(metafile, "r")
-		except IOError, err:
-			LogMsg("Could not open metadata file %s because %s" % (metafile, err))
-			raise
-	else:
-		LogMsg("Metadata file %s not found" % metafile)
-		return None
-
-	# Patterns to extract tag/value pairs and BEGIN/END group tags
-	gepat1 = re.compile(r'(?P<tag>\w+) = "?(?P<data>.*?)"?;', re.I)
-	gepat2 = re.compile(r"(?P<tag>\w+) = ", re.I)
-
-	# These tags use the following tag/value as an attribute of the group rather than
-	# a standalone node
-	group_tags = {"aoiGeoCoordinate":"coordinateNumber",
-				  "aoiMapCoordinate":"coordinateNumber",
-				  "bandSpecificInformation":"bandNumber"}
-
-	# Start processing
-	root = ET.Element("root")
-	parent = None
-	current = root
-	node_stack = []
-	mlstr = False  # multi-line string flag
-
-	for line in metaf:
-		# mlstr will be true when working on a multi-line string
-		if mlstr:
-			if not line.strip() == ");":
-				data += line.strip()
-			else:
-				data += line.strip()
-				child = ET.SubElement(current, tag)
-				child.text = data
-				mlstr = False
-
-		# Handle tag/value pairs and groups
-		mat1 = gepat1.search(line)
-		if mat1:
-			tag = mat1.group("tag").strip()
-			data = mat1.group("data").strip()
-
-			if tag == "BEGIN_GROUP":
-				if data is None or data == "":
-					child = ET.SubElement(current, "group")
-				else:
-					child = ET.SubElement(current, data)
-				if parent:
-					node_stack.append(parent)
-				parent = current
-				current = child
-			elif tag == "END_GROUP":
-				current = parent if parent else root
-				parent = node_stack.pop() if node_stack else None
-			else:
-				if current.tag in group_tags and tag == group_tags[current.tag]:
-					current.set(tag, data)
-				else:
-					child = ET.SubElement(current, tag)
-					child.text = data
-		else:
-			mat2 = gepat2.search(line)
-			if mat2:
-				tag = mat2.group("tag").strip()
-				data = ""
-				mlstr = True
-
-	metaf.close()
-	#print ET.ElementTree(root)
-	return ET.ElementTree(root)
-
-
 def getInfoFromName(filename):
     
     DG = re.compile("(?P<snsr>[A-Z]{2}[0-9]{2})_(?P<ts>[0-9]{2}[A-Z]{3}[0-9]{9})-\w+-(?P<catid>\w{16})")
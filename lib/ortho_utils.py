@@ -1,22 +1,38 @@
-import os, string, sys, shutil, math, glob, re, tarfile, logging, shlex, platform, argparse
+import os, string, sys, shutil, math, glob, re, tarfile, logging, shlex, platform, argparse, tempfile
 from datetime import datetime, timedelta
 
 from subprocess import *
-from xml.dom import minidom
 from xml.etree import cElementTree as ET
 
 import gdal, ogr,osr, gdalconst
 
-DGbandList = ['BAND_P','BAND_C','BAND_B','BAND_G','BAND_Y','BAND_R','BAND_RE','BAND_N','BAND_N2']
+from lib import resources, metadata, scene_table
+
+DGbandList = metadata.DGbandList
 formats = {'GTiff':'.tif','JP2OpenJPEG':'.jp2','ENVI':'.envi','HFA':'.img'}
 outtypes = ['Byte','UInt16','Float32']
 stretches = ["ns","rf","mr","rd"]
 resamples = ["near","bilinear","cubic","cubicspline","lanczos"]
 gtiff_compressions = ["jpeg95","lzw"]
+warp_engines = ["gdalwarp","python"]
 exts = ['.ntf','.tif']
 
 WGS84 = 4326
 
+#### DEM subset window padding and snapping grid (degrees for geographic subsets, DEM pixels otherwise)
+dem_subset_buffer_deg = 0.05
+dem_subset_grid_deg = 0.25
+dem_subset_buffer_px = 16
+dem_subset_grid_px = 1024
+
+#### DEM extents read by GetDemExtent, keyed by DEM path
+dem_extents = {}
+
+#### Spatial references built by GetSpatialRef (keyed by EPSG code) and DEMs held open by HoldDem (keyed by
+#### path).  Both last for the life of the process, so a long-lived worker builds and opens them once.
+spatial_refs = {}
+dem_datasets = {}
+
 formatVRT = "VRT"
 VRTdriver = gdal.GetDriverByName( formatVRT )
 ikMsiBands = ['blu','grn','red','nir']
@@ -61,6 +77,16 @@ class SpatialRef(object):
 		self.epsg = epsgcode
                 
 
+def GetSpatialRef(epsg):
+    """
+    Return the SpatialRef of an EPSG code, built once per process
+    """
+
+    if epsg not in spatial_refs:
+        spatial_refs[epsg] = SpatialRef(epsg)
+    return spatial_refs[epsg]
+
+
 def buildParentArgumentParser():
     
     #### Set Up Arguments 
@@ -99,20 +125,56 @@ def buildParentArgumentParser():
                       help="local working directory for cluster jobs (default is dst dir)")
     parser.add_argument("--skip_warp", action='store_true', default=False,
                       help="skip warping step")
+    parser.add_argument("--warp_engine", choices=warp_engines, default="gdalwarp",
+                      help="run the warp as a gdalwarp process or in-process with the GDAL python API (default=gdalwarp)")
+    parser.add_argument("--single_pass", action='store_true', default=False,
+                      help="stream the warp through the stretch into the output without writing an intermediate warped image")
+    parser.add_argument("--dem_subset", action='store_true', default=False,
+                      help="warp against a small DEM window cut to the working directory instead of the whole DEM")
+    parser.add_argument("--scene_table",
+                      help="scene metadata table built by pgc_build_scene_table.py to look up calibration values")
     
     return parser, pos_arg_keys
 
 
 def processImage(srcfp,dstfp,opt):
+    """
+    Orthorectify an image and return 0 on success, 1 on failure.  If the walltime of the job runs out while
+    it is processed, its temp files and partial output are removed before WalltimeExpired is passed on.
+    """
+
+    info = ImageInfo()
+
+    #### Without a run-wide DEM subset directory (see StartDemSubsets) the image gets its own
+    own_subsets = getattr(opt,"dem_subset_dir",None) is None
+    if own_subsets:
+        StartDemSubsets(opt, opt.wd if opt.wd is not None else os.path.dirname(dstfp))
+    try:
+        return processImageSteps(srcfp,dstfp,opt,info)
+    except resources.WalltimeExpired:
+        LogMsg("Walltime expired, removing temp files and partial output: %s" %os.path.basename(srcfp))
+        names = [dstfp]
+        if not opt.save_temps:
+            names.extend([getattr(info,name) for name in ("warpfile","vrtfile","localsrc") if hasattr(info,name)])
+            if opt.wd is not None and hasattr(info,"localdst"):
+                names.append(info.localdst)
+        deleteTempFiles(names)
+        raise
+    finally:
+        if own_subsets:
+            EndDemSubsets(opt)
+
+
+def processImageSteps(srcfp,dstfp,opt,info):
 
     err = 0
 
-    #### Instantiate ImageInfo object
-    info = ImageInfo()
+    #### Fill in the ImageInfo object
     info.srcfp = srcfp
     info.srcdir,info.srcfn = os.path.split(srcfp)
     info.dstfp = dstfp
     info.dstdir,info.dstfn = os.path.split(dstfp)
+    info.dem = opt.dem
 
     starttime = datetime.today()
     LogMsg('Image: %s' %(info.srcfn))
@@ -128,16 +190,20 @@ def processImage(srcfp,dstfp,opt):
         except OSError:
             pass
     LogMsg("Working Dir: %s" %wd)
+    LogMsg("Available cores: %d" %resources.getAvailableCpus())
 
     #### Derive names
     info.localsrc = os.path.join(wd,info.srcfn)
     info.localdst = os.path.join(wd,info.dstfn)
-    info.warpfile = os.path.splitext(info.localsrc)[0] + "_warp.tif"
+    if opt.single_pass:
+        info.warpfile = os.path.splitext(info.localsrc)[0] + "_warp.vrt"
+    else:
+        info.warpfile = os.path.splitext(info.localsrc)[0] + "_warp.tif"
     info.vrtfile = os.path.splitext(info.localsrc)[0] + "_vrt.vrt"
 
     #### Verify EPSG
     try:
-        spatial_ref = SpatialRef(opt.epsg)
+        spatial_ref = GetSpatialRef(opt.epsg)
     except RuntimeError, e:
 	err = 1
     else:
@@ -196,6 +262,15 @@ def processImage(srcfp,dstfp,opt):
             if overlap is False:
                 err = 1
 
+    #### Cut a DEM window for the image
+    if not err == 1 and not opt.skip_warp:
+        if opt.dem and opt.dem_subset:
+            subset = GetDemSubset(opt,info)
+            if subset is not None:
+                info.dem = subset
+            else:
+                LogMsg("Cannot create DEM subset.  Using the full DEM.")
+
     ####  Write Output Metadata
     if not err == 1:
         rc = WriteOutputMetadata(opt,info)
@@ -395,7 +470,7 @@ def calcStats(opt,info):
 
     #### Stretch
     if info.stretch != "ns":
-        CFlist = GetCalibrationFactors(info)
+        CFlist = GetCalibrationFactors(info,opt.scene_table)
         if len(CFlist) == 0:
             LogMsg("Cannot get image calibration factors from metadata")
             return 1
@@ -411,7 +486,16 @@ def calcStats(opt,info):
         xsize = wds.RasterXSize
         ysize = wds.RasterYSize
 
-        vds = VRTdriver.CreateCopy(info.vrtfile,wds,0)
+        #### A warped VRT cannot take new sources, so build a plain VRT on its grid
+        if os.path.splitext(wds_fp)[1].lower() == ".vrt":
+            vds = VRTdriver.Create(info.vrtfile,xsize,ysize,0)
+            if vds is not None:
+                vds.SetGeoTransform(wds.GetGeoTransform())
+                vds.SetProjection(wds.GetProjectionRef())
+                for band in range(1,wds.RasterCount+1):
+                    vds.AddBand(wds.GetRasterBand(band).DataType)
+        else:
+            vds = VRTdriver.CreateCopy(info.vrtfile,wds,0)
         if vds is not None:
 
             for band in range(1,vds.RasterCount+1):
@@ -455,11 +539,15 @@ def calcStats(opt,info):
     vds = None
     wds = None
 
+    threads = resources.getAvailableCpus()
+
     if opt.format == 'GTiff':
         if opt.gtiff_compression == 'lzw':
             co = '-co "PHOTOMETRIC=MINISBLACK" -co "TILED=YES" -co "COMPRESS=LZW" -co "BIGTIFF=IF_SAFER" '
         elif opt.gtiff_compression == 'jpeg95':
             co = '-co "PHOTOMETRIC=MINISBLACK" -co "TILED=YES" -co "compress=jpeg" -co "jpeg_quality=95" -co "BIGTIFF=IF_SAFER" '
+        if threads > 1:
+            co = co + '-co "NUM_THREADS=%d" ' %threads
 
     elif opt.format == 'HFA':
         co = '-co "COMPRESSED=YES" -co "STATISTICS=YES" '
@@ -476,6 +564,10 @@ def calcStats(opt,info):
     else:
         config_options = ''
 
+    #### In single pass mode the warp runs inside gdal_translate, so it needs the warp settings
+    if not opt.skip_warp and os.path.splitext(info.warpfile)[1].lower() == ".vrt":
+        config_options = config_options + ' %s--config GDAL_NUM_THREADS %d' %(info.centerlong,threads)
+
     cmd = ('gdal_translate %s -stats -ot %s -a_srs "%s" %s%s-of %s "%s" "%s"' %(
         config_options,
         opt.outtype,
@@ -494,7 +586,7 @@ def calcStats(opt,info):
     #### Calculate Pyramids
     if opt.format in ["GTiff"]:
         if os.path.isfile(info.localdst):
-            cmd = ('gdaladdo "%s" 2 4 8 16' %(info.localdst))
+            cmd = ('gdaladdo --config GDAL_NUM_THREADS %d "%s" 2 4 8 16' %(threads,info.localdst))
             (err,so,se) = ExecCmd(cmd)
             if err == 1:
                 rc = 1
@@ -628,6 +720,7 @@ def GetImageStats(opt, info):
         for pt in ul_geom, ur_geom, ll_geom, lr_geom:
             lons.append(pt.GetX())
             lats.append(pt.GetY())
+        info.geographic_bounds = (min(lons),min(lats),max(lons),max(lats))
 
         #### Transform geoms to target srs
         if not g_srs.IsSame(t_srs):
@@ -653,14 +746,17 @@ def GetImageStats(opt, info):
         #print lons
         LogMsg("Centroid: %s" %str(centroid))
 
+        info.center_long = None
         if max(lons) - min(lons) > 180:
 
             if centroid.GetX() < 0:
-                info.centerlong = '--config CENTER_LONG -180 '
+                info.center_long = "-180"
             else:
-                info.centerlong = '--config CENTER_LONG 180 '
+                info.center_long = "180"
+            info.centerlong = '--config CENTER_LONG %s ' %info.center_long
 
-        info.extent = "-te %.12f %.12f %.12f %.12f " %(min(Xs),min(Ys),max(Xs),max(Ys))
+        info.extent_bounds = (min(Xs),min(Ys),max(Xs),max(Ys))
+        info.extent = "-te %.12f %.12f %.12f %.12f " %info.extent_bounds
 
         rasterxsize_m = abs(math.sqrt((ul_geom.GetX() - ur_geom.GetX())**2 + (ul_geom.GetY() - ur_geom.GetY())**2))
         rasterysize_m = abs(math.sqrt((ul_geom.GetX() - ll_geom.GetX())**2 + (ul_geom.GetY() - ll_geom.GetY())**2))
@@ -672,8 +768,10 @@ def GetImageStats(opt, info):
         ####  Make a string for Pixel Size Specification
         if opt.resolution is not None:
             info.res = "-tr %s %s " %(opt.resolution,opt.resolution)
+            info.res_xy = (float(opt.resolution),float(opt.resolution))
         else:
             info.res = "-tr %.12f %.12f " %(resx,resy)
+            info.res_xy = (resx,resy)
         LogMsg("Original image size: %f x %f, res: %.12f x %.12f" %(rasterxsize_m, rasterysize_m, resx, resy))
 
 
@@ -715,30 +813,18 @@ def WriteOutputMetadata(opt,info):
             return 1
 
         try:
-            metad = ET.parse(metapath)
+            md = metadata.getMetadata(metapath)
         except ET.ParseError:
             LogMsg("Invalid xml formatting in metadata file: %s" %metapath)
             return 1
         else:
-            imd = metad.find("IMD")
+            imd = md.tree.find("IMD")
 
     ####  If GE
     elif info.vendor == 'GeoEye':
         metapath = os.path.splitext(info.localsrc)[0]+'.txt'
         if os.path.isfile(metapath):
-            metad = getGEMetadataAsXml(metapath)
-            imd = ET.Element("IMD")
-            include_tags = ["sensorInfo","inputImageInfo","correctionParams","bandSpecificInformation"]
-
-            elem = metad.find("productInfo")
-            if elem is not None:
-                rpc = elem.find("rationalFunctions")
-                elem.remove(rpc)
-                imd.append(elem)
-
-            for tag in include_tags:
-                elems = metad.findall(tag)
-                imd.extend(elems)
+            imd = metadata.getGEImd(metadata.getMetadata(metapath))
 
         else:
             LogMsg("Cannot find metadata file: %s" %metapath)
@@ -800,6 +886,21 @@ def WarpImage(opt,info):
     else:
         config_options = ''
 
+    #### Use all the cores allocated to the job
+    threads = resources.getAvailableCpus()
+    if threads > 1:
+        config_options = config_options + ' -multi -wo NUM_THREADS=%d' %threads
+
+    #### Single pass mode writes a warped VRT that is evaluated when the output is encoded
+    if os.path.splitext(info.warpfile)[1].lower() == ".vrt":
+        warp_format = "VRT"
+        format_options = '-of VRT '
+        creation_options = []
+    else:
+        warp_format = "GTiff"
+        format_options = '-of GTiff -co "TILED=YES" -co "BIGTIFF=IF_SAFER" '
+        creation_options = ["TILED=YES","BIGTIFF=IF_SAFER"]
+
     if not os.path.isfile(info.warpfile):
 
         LogMsg("Warping Image")
@@ -818,7 +919,7 @@ def WarpImage(opt,info):
 
             if rpb_p:
                 if not os.path.isfile(rpb_p):
-                    err = ExtractRPB(info.localsrc,rpb_p)
+                    err = ExtractRPB(info.localsrc,rpb_p,info.srcfp)
                     if err == 1:
                         rc = 1
                 if not os.path.isfile(rpb_p):
@@ -833,11 +934,20 @@ def WarpImage(opt,info):
 
         #### Add code to identify 2A, 3A images
 
+            use_warp_api = opt.warp_engine == "python"
+            if use_warp_api and not hasattr(gdal,"Warp"):
+                logger.warning("gdal.Warp is not available in GDAL %s python bindings.  Using gdalwarp instead." %gdal.__version__)
+                use_warp_api = False
+
+            ds = None
+
             if warp_rpc is True:
                 ####  Set RPC_DEM or RPC_HEIGHT transformation option
-                if opt.dem != None:
-                    LogMsg('DEM: %s' %(os.path.basename(opt.dem)))
-                    to = "RPC_DEM=%s" %opt.dem
+                if info.dem != None:
+                    LogMsg('DEM: %s' %(os.path.basename(info.dem)))
+                    to = "RPC_DEM=%s" %info.dem
+                    if use_warp_api:
+                        HoldDem(info.dem)
 
                 else:
                     #### Get Constant Elevation From XML
@@ -856,50 +966,133 @@ def WarpImage(opt,info):
                     LogMsg("Average elevation: %f meters" %(h))
                     to = "RPC_HEIGHT=%f" %h
 
+                if use_warp_api:
+                    #### Reuse the dataset opened for the RPC height if there is one
+                    if ds is None:
+                        ds = gdal.Open(info.localsrc,gdalconst.GA_ReadOnly)
+                    rc = WarpImageInProcess(opt,info,ds,True,[to],warp_format,creation_options)
 
-
-                #### GDALWARP Command
-                cmd = 'gdalwarp %s -of GTiff -ot UInt16 %s%s%s-co "TILED=YES" -co "BIGTIFF=IF_SAFER" -t_srs "%s" -r %s -et 0.01 -rpc -to "%s" "%s" "%s"' %(
-                    config_options,
-                    info.centerlong,
-                    info.extent,
-                    info.res,
-                    opt.spatial_ref.proj4,
-                    opt.resample,
-                    to,
-                    info.localsrc,
-                    info.warpfile
-                    )
-
-                (err,so,se) = ExecCmd(cmd)
-                #print err
-                if err == 1:
-                    rc = 1
+                else:
+                    #### GDALWARP Command
+                    cmd = 'gdalwarp %s %s-ot UInt16 %s%s%s-t_srs "%s" -r %s -et 0.01 -rpc -to "%s" "%s" "%s"' %(
+                        config_options,
+                        format_options,
+                        info.centerlong,
+                        info.extent,
+                        info.res,
+                        opt.spatial_ref.proj4,
+                        opt.resample,
+                        to,
+                        info.localsrc,
+                        info.warpfile
+                        )
+
+                    (err,so,se) = ExecCmd(cmd)
+                    #print err
+                    if err == 1:
+                        rc = 1
 
                 ds = None
 
             else:
 
-                cmd = 'gdalwarp %s -of GTiff -ot UInt16 %s%s%s-co "TILED=YES" -co "BIGTIFF=IF_SAFER" -t_srs "%s" -r %s "%s" "%s"' %(
-                    config_options,
-                    info.centerlong,
-                    info.extent,
-                    info.res,
-                    opt.spatial_ref.proj4,
-                    opt.resample,
-                    info.localsrc,
-                    info.warpfile
-                    )
-                
-                (err,so,se) = ExecCmd(cmd)
-                #print err
-                if err == 1:
-                    rc = 1
+                if use_warp_api:
+                    ds = gdal.Open(info.localsrc,gdalconst.GA_ReadOnly)
+                    rc = WarpImageInProcess(opt,info,ds,False,[],warp_format,creation_options)
+                    ds = None
+
+                else:
+                    cmd = 'gdalwarp %s %s-ot UInt16 %s%s%s-t_srs "%s" -r %s "%s" "%s"' %(
+                        config_options,
+                        format_options,
+                        info.centerlong,
+                        info.extent,
+                        info.res,
+                        opt.spatial_ref.proj4,
+                        opt.resample,
+                        info.localsrc,
+                        info.warpfile
+                        )
+
+                    (err,so,se) = ExecCmd(cmd)
+                    #print err
+                    if err == 1:
+                        rc = 1
 
         return rc
 
 
-def GetCalibrationFactors(info):
+class WarpProgress(object):
+    """
+    GDAL progress callback that logs warp progress in 10 percent steps
+    """
+
+    def __init__(self,name):
+        self.name = name
+        self.last = -1
+
+    def __call__(self,complete,message,user_data):
+        pct = int(complete * 10) * 10
+        if pct > self.last:
+            self.last = pct
+            logger.debug("Warping %s: %d%%" %(self.name,pct))
+        return 1
+
+
+def WarpImageInProcess(opt,info,src_ds,rpc,transformer_options,warp_format="GTiff",creation_options=["TILED=YES","BIGTIFF=IF_SAFER"]):
+
+    rc = 0
+
+    if src_ds is None:
+        LogMsg("Cannot open dataset: %s" %info.localsrc)
+        return 1
+
+    threads = resources.getAvailableCpus()
+    warp_options = gdal.WarpOptions(
+        format = warp_format,
+        outputType = gdalconst.GDT_UInt16,
+        outputBounds = info.extent_bounds,
+        xRes = info.res_xy[0],
+        yRes = info.res_xy[1],
+        dstSRS = opt.spatial_ref.proj4,
+        resampleAlg = opt.resample,
+        errorThreshold = 0.01,
+        rpc = rpc,
+        transformerOptions = transformer_options,
+        creationOptions = creation_options,
+        warpMemoryLimit = 2000,
+        multithread = threads > 1,
+        warpOptions = ["NUM_THREADS=%d" %threads],
+        callback = WarpProgress(info.srcfn)
+        )
+
+    pf = platform.platform()
+    if pf.startswith("Linux"):
+        gdal.SetCacheMax(2048 * 1024 * 1024)
+    if info.center_long is not None:
+        gdal.SetConfigOption("CENTER_LONG",info.center_long)
+
+    logger.info("Warping in process: %s -> %s (%s)" %(info.localsrc,info.warpfile," ".join(transformer_options)))
+    try:
+        dst_ds = gdal.Warp(info.warpfile,src_ds,options=warp_options)
+    except RuntimeError, e:
+        logger.error("Error found in warp: %s" %e)
+        dst_ds = None
+    finally:
+        if info.center_long is not None:
+            gdal.SetConfigOption("CENTER_LONG",None)
+
+    if dst_ds is None:
+        logger.error("Warp failed: %s" %info.localsrc)
+        rc = 1
+
+    #### Close (and flush) the output
+    dst_ds = None
+
+    return rc
+
+
+def GetCalibrationFactors(info,table_path=None):
 
     calibDict = {}
     CFlist = []
@@ -916,7 +1109,7 @@ def GetCalibrationFactors(info):
             xmlpath = os.path.splitext(sdsp)[0] + ".XML"
 
         if xmlpath:
-            calibDict = getDGXmlData(xmlpath,info.stretch)
+            calibDict = getDGXmlData(xmlpath,info.stretch,table_path)
             bandList = DGbandList
         else:
             LogMsg('xml does not exist for image: %s' %os.path.basenanme(sdsp))
@@ -927,7 +1120,7 @@ def GetCalibrationFactors(info):
         if not os.path.isfile(metapath):
             LogMsg(metapath + ' does not exist. Skipping')
         else:
-            calibDict = GetGEcalibDict(metapath,info.stretch)
+            calibDict = GetGEcalibDict(metapath,info.stretch,table_path)
         if info.bands == 1:
             bandList = [5]
         elif info.bands == 4:
@@ -958,34 +1151,66 @@ def GetCalibrationFactors(info):
     return CFlist
 
 
-def overlap_check(geometry_wkt, spatial_ref, demPath):
+def GetDemExtent(demPath):
+    """
+    Return the extent polygon wkt, projection and geotransform of a DEM.  The header is read once per DEM
+    and kept for the life of the process.
+    """
 
+    if demPath in dem_extents:
+        return dem_extents[demPath]
 
-    imageSpatialReference = spatial_ref.srs
-    imageGeometry = ogr.CreateGeometryFromWkt(geometry_wkt)
+    extent = None
     dem = gdal.Open(demPath, gdalconst.GA_ReadOnly)
 
     if dem is not None:
-            xsize = dem.RasterXSize
-            ysize = dem.RasterYSize
-            demProjection = dem.GetProjectionRef()
-            if demProjection:
+        xsize = dem.RasterXSize
+        ysize = dem.RasterYSize
+        demProjection = dem.GetProjectionRef()
+        gtf = dem.GetGeoTransform()
+        dem = None
+
+        minx = gtf[0]
+        maxx = minx + xsize * gtf[1]
+        maxy = gtf[3]
+        miny = maxy + ysize * gtf[5]
+
+        dem_geometry_wkt = 'POLYGON (( %f %f, %f %f, %f %f, %f %f, %f %f ))' %(minx,miny,minx,maxy,maxx,maxy,maxx,miny,minx,miny)
+        extent = (dem_geometry_wkt, demProjection, gtf)
+        dem_extents[demPath] = extent
 
-                gtf = dem.GetGeoTransform()
+    return extent
 
-                minx = gtf[0]
-                maxx = minx + xsize * gtf[1]
-                maxy = gtf[3]
-                miny = maxy + ysize * gtf[5]
 
-                dem_geometry_wkt = 'POLYGON (( %f %f, %f %f, %f %f, %f %f, %f %f ))' %(minx,miny,minx,maxy,maxx,maxy,maxx,miny,minx,miny)
+def HoldDem(demPath):
+    """
+    Keep a shared handle on a DEM open for the life of the process.  The RPC transformer opens its DEM as a
+    shared dataset, so in-process warps of later images (e.g. in pgc_worker.py) reuse the open DEM and its
+    cached blocks instead of opening it again.
+    """
+
+    if demPath not in dem_datasets:
+        dem_datasets[demPath] = gdal.OpenShared(demPath, gdalconst.GA_ReadOnly)
+    return dem_datasets[demPath]
+
+
+def overlap_check(geometry_wkt, spatial_ref, demPath):
+
+
+    imageSpatialReference = spatial_ref.srs
+    imageGeometry = ogr.CreateGeometryFromWkt(geometry_wkt)
+    extent = GetDemExtent(demPath)
+
+    if extent is not None:
+            dem_geometry_wkt, demProjection, gtf = extent
+            if demProjection:
+
                 demGeometry = ogr.CreateGeometryFromWkt(dem_geometry_wkt)
                 demSpatialReference = osr.SpatialReference(demProjection)
 
                 coordinateTransformer = osr.CoordinateTransformation(imageSpatialReference, demSpatialReference)
                 imageGeometry.Transform(coordinateTransformer)
 
-                dem = None
                 overlap = imageGeometry.Within(demGeometry)
 
                 if overlap is False:
@@ -1003,25 +1228,240 @@ def overlap_check(geometry_wkt, spatial_ref, demPath):
     return overlap
 
 
-def ExtractRPB(item,rpb_p):
+def StartDemSubsets(opt, wd):
+    """
+    Create a scratch directory in wd for the DEM subsets of a run of images if --dem_subset is used.  The
+    directory is unique to the run, so concurrent runs sharing a working directory never write the same
+    subset, and is removed by EndDemSubsets.
+    """
+
+    opt.dem_subset_dir = None
+    if opt.dem and opt.dem_subset:
+        if not os.path.isdir(wd):
+            try:
+                os.makedirs(wd)
+            except OSError:
+                pass
+        opt.dem_subset_dir = tempfile.mkdtemp(prefix="dem_subsets_", dir=wd)
+
+
+def EndDemSubsets(opt):
+
+    if getattr(opt,"dem_subset_dir",None) is not None:
+        shutil.rmtree(opt.dem_subset_dir, ignore_errors=True)
+    opt.dem_subset_dir = None
+
+
+def GetDemSubset(opt, info):
+    """
+    Cut a buffered window of the DEM that covers the image footprint into a tiled Float32 GeoTiff in the
+    DEM subset directory of the run and return its path (None on failure).  The window is reprojected to
+    geographic coordinates, which the RPC transformer uses, unless the image crosses 180 degrees.  Window
+    bounds are snapped to a coarse grid so neighboring images of the run can reuse the same subset.
+    """
+
+    extent = GetDemExtent(opt.dem)
+    if extent is None:
+        LogMsg("ERROR - Cannot open DEM to determine extent: %s" %opt.dem)
+        return None
+    dem_geometry_wkt, demProjection, gtf = extent
+
+    if info.center_long is None:
+        #### Geographic window from the image corner coordinates
+        minx, miny, maxx, maxy = info.geographic_bounds
+        buf, grid = dem_subset_buffer_deg, dem_subset_grid_deg
+        t_srs = '-t_srs "EPSG:%d" ' %WGS84
+    else:
+        #### Window in the DEM projection
+        imageGeometry = ogr.CreateGeometryFromWkt(info.geometry_wkt)
+        demSpatialReference = osr.SpatialReference(demProjection)
+        imageGeometry.Transform(osr.CoordinateTransformation(opt.spatial_ref.srs, demSpatialReference))
+        minx, maxx, miny, maxy = imageGeometry.GetEnvelope()
+        buf = dem_subset_buffer_px * abs(gtf[1])
+        grid = dem_subset_grid_px * abs(gtf[1])
+        t_srs = ''
+
+    minx = math.floor((minx - buf) / grid) * grid
+    miny = math.floor((miny - buf) / grid) * grid
+    maxx = math.ceil((maxx + buf) / grid) * grid
+    maxy = math.ceil((maxy + buf) / grid) * grid
+    if info.center_long is None:
+        miny = max(miny, -90.0)
+        maxy = min(maxy, 90.0)
+
+    subset = os.path.join(opt.dem_subset_dir, "%s_%s_%.4f_%.4f_%.4f_%.4f.tif" %(
+        os.path.splitext(os.path.basename(opt.dem))[0],
+        "geog" if t_srs else "native",
+        minx, miny, maxx, maxy
+        ))
+
+    #### Reuse a subset cut by an earlier image of the run.  Subsets are renamed into place when complete.
+    if os.path.isfile(subset):
+        LogMsg("Using existing DEM subset: %s" %subset)
+        return subset
+
+    LogMsg("Creating DEM subset: %s" %subset)
+    threads = resources.getAvailableCpus()
+    temp_subset = "%s_%d.tif" %(os.path.splitext(subset)[0], os.getpid())
+    cmd = 'gdalwarp --config GDAL_CACHEMAX 2048 -multi -wo NUM_THREADS=%d %s-te %.12f %.12f %.12f %.12f -ot Float32 -r bilinear -of GTiff -co "TILED=YES" -co "BIGTIFF=IF_SAFER" "%s" "%s"' %(
+        threads,
+        t_srs,
+        minx, miny, maxx, maxy,
+        opt.dem,
+        temp_subset
+        )
+
+    (err,so,se) = ExecCmd(cmd)
+    if err == 1 or not os.path.isfile(temp_subset):
+        deleteTempFiles([temp_subset])
+        return None
+
+    #### Rename into place so other processes of the run (--threads) never read a partial subset
+    try:
+        os.rename(temp_subset, subset)
+    except OSError, e:
+        logger.warning("Cannot move DEM subset into place: %s" %e)
+        deleteTempFiles([temp_subset])
+        if not os.path.isfile(subset):
+            return None
+
+    return subset
+
+
+#### Tar member index kept beside each tarball as <tarball>.idx
+tar_index_ext = ".idx"
+tar_index_version = "TARINDEX 2"
+
+
+def GetTarStamp(tar_p):
+    """
+    Return the (size, mtime) of a tarball, which a tar index must match to be used
+    """
+
+    st = os.stat(tar_p)
+    return (st.st_size, st.st_mtime)
+
+
+def ReadTarIndex(index_p, tar_stamp):
+    """
+    Read a tar member index and return a list of (name, data offset, size) tuples, or None if the index is
+    missing, unreadable or was built for a tarball of a different size or modification time.
+    """
+
+    if not os.path.isfile(index_p):
+        return None
+
+    members = []
+    try:
+        f = open(index_p,'r')
+        try:
+            header = f.readline().rstrip("\n").split("\t")
+            if len(header) != 3 or header[0] != tar_index_version or (int(header[1]), float(header[2])) != tar_stamp:
+                return None
+            for line in f:
+                name, offset, size = line.rstrip("\n").rsplit("\t",2)
+                members.append((name, int(offset), int(size)))
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError), e:
+        logger.debug("Cannot read tar index %s: %s" %(index_p,e))
+        return None
+
+    return members
+
+
+def WriteTarIndex(index_p, tar_stamp, members):
+    """
+    Write a tar member index.  The index is written to a temp file and renamed so readers never see a
+    partial index.  Failure to write (e.g. a read-only archive directory) is not an error.
+    """
+
+    temp_p = "%s.%d" %(index_p, os.getpid())
+    try:
+        f = open(temp_p,'w')
+        f.write("%s\t%d\t%r\n" %(tar_index_version, tar_stamp[0], tar_stamp[1]))
+        for name, offset, size in members:
+            f.write("%s\t%d\t%d\n" %(name, offset, size))
+        f.close()
+        os.rename(temp_p, index_p)
+    except (IOError, OSError), e:
+        logger.debug("Cannot write tar index %s: %s" %(index_p,e))
+        if os.path.isfile(temp_p):
+            os.remove(temp_p)
+        return 1
+
+    return 0
+
+
+def GetTarIndex(tar_p, src_tar_p=None):
+    """
+    Return the (name, data offset, size) list of regular file members in a tarball.  The index is loaded
+    from <tarball>.idx if present and current, otherwise the tar headers are scanned once and the index
+    is saved beside the tarball (and beside src_tar_p, the archive copy the tarball came from, if given).
+    """
+
+    tar_stamp = GetTarStamp(tar_p)
+    index_p = tar_p + tar_index_ext
+
+    members = ReadTarIndex(index_p, tar_stamp)
+    if members is not None:
+        return members
+
+    LogMsg("Indexing tar file: %s" %tar_p)
+    tar = tarfile.open(tar_p, 'r')
+    try:
+        members = [(ti.name, ti.offset_data, ti.size) for ti in tar if ti.isfile()]
+    finally:
+        tar.close()
+
+    WriteTarIndex(index_p, tar_stamp, members)
+    #### The archive copy gets the index too if the tarball is an unchanged copy of it (copy2 keeps the mtime)
+    if src_tar_p and os.path.abspath(src_tar_p) != os.path.abspath(tar_p):
+        if os.path.isfile(src_tar_p) and GetTarStamp(src_tar_p) == tar_stamp:
+            WriteTarIndex(src_tar_p + tar_index_ext, tar_stamp, members)
+
+    return members
+
+
+def ReadTarMember(tar_p, offset, size):
+    """
+    Read a member of an uncompressed tarball directly from its data offset.  The member header in front of
+    the data is checked against the expected size before reading.
+    """
+
+    f = open(tar_p,'rb')
+    try:
+        f.seek(offset - tarfile.BLOCKSIZE)
+        ti = tarfile.TarInfo.frombuf(f.read(tarfile.BLOCKSIZE))
+        if ti.size != size:
+            raise tarfile.TarError("Tar index does not match member header at offset %d" %offset)
+        data = f.read(size)
+    finally:
+        f.close()
+
+    if len(data) != size:
+        raise tarfile.TarError("Truncated tar member at offset %d" %offset)
+
+    return data
+
+
+def ExtractRPB(item,rpb_p,src_item=None):
     rc = 0
     tar_p = os.path.splitext(item)[0]+".tar"
+    src_tar_p = os.path.splitext(src_item)[0]+".tar" if src_item else None
     LogMsg(tar_p)
     if os.path.isfile(tar_p):
         try:
-            tar = tarfile.open(tar_p, 'r')
-            tarlist = tar.getnames()
-            for t in tarlist:
+            tarlist = GetTarIndex(tar_p,src_tar_p)
+            for t, offset, size in tarlist:
                 if '.rpb' in string.lower(t) or '_rpc' in string.lower(t): #or '.til' in string.lower(t):
                     print t
-                    tf = tar.extractfile(t)
                     fp = os.path.splitext(rpb_p)[0] + os.path.splitext(t)[1]
+                    tfstr = ReadTarMember(tar_p,offset,size)
                     fpfh = open(fp,"w")
-                    tfstr = tf.read()
                     #print repr(tfstr)
                     fpfh.write(tfstr)
                     fpfh.close()
-                    tf.close()
                     status = 0
         except Exception,e:
             logger.error("Cannot open Tar file: %s" %tar_p)
@@ -1036,15 +1476,7 @@ def ExtractRPB(item,rpb_p):
 
 
 def getXmlHeight(xmlpath):
-    xmldoc = minidom.parse(xmlpath)
-    nodeRPC = xmldoc.getElementsByTagName('RPB')[0]
-
-    # get acquisition IMAGE tags
-    nodeIMAGE = nodeRPC.getElementsByTagName('IMAGE')
-
-    h = nodeIMAGE[0].getElementsByTagName('HEIGHTOFFSET')[0].firstChild.data
-
-    return h
+    return metadata.getMetadata(xmlpath).heightoffset
 
 
 def calcEarthSunDist(t):
@@ -1073,13 +1505,12 @@ def calcEarthSunDist(t):
     return d
 
 
-def getDGXmlData(xmlpath,stretch):
+def getDGXmlData(xmlpath,stretch,table_path=None):
     calibDict = {}
-    xmldoc = minidom.parse(xmlpath)
+    md = scene_table.getSceneAttributes(xmlpath,table_path)
 
-    if len(xmldoc.getElementsByTagName('IMD')) >=1:
+    if len(md.bands) >=1:
 
-        nodeIMD = xmldoc.getElementsByTagName('IMD')[0]
         EsunDict = {  # Spectral Irradiance in W/m2/um
             'QB02_BAND_P':1381.79,
             'QB02_BAND_B':1924.59,
@@ -1122,35 +1553,23 @@ def getDGXmlData(xmlpath,stretch):
             'IK01_BAND_N':1156.9
             }
 
-        # get acquisition IMAGE tags
-        nodeIMAGE = nodeIMD.getElementsByTagName('IMAGE')
-
-        sat = nodeIMAGE[0].getElementsByTagName('SATID')[0].firstChild.data
-        t = nodeIMAGE[0].getElementsByTagName('FIRSTLINETIME')[0].firstChild.data
-
-        if len(nodeIMAGE[0].getElementsByTagName('MEANSUNEL')) >= 1:
-            sunEl = float(nodeIMAGE[0].getElementsByTagName('MEANSUNEL')[0].firstChild.data)
-        elif len(nodeIMAGE[0].getElementsByTagName('SUNEL')) >= 1:
-            sunEl = float(nodeIMAGE[0].getElementsByTagName('SUNEL')[0].firstChild.data)
-        else:
+        # get acquisition IMAGE values
+        sat = md.satid
+        t = md.firstlinetime
+        sunEl = md.sunel
+        if sunEl is None:
             return calibDict
 
-        # get BAND tags
+        # get BAND values
         for band in DGbandList:
-            nodeBAND = nodeIMD.getElementsByTagName(band)
-            #print nodeBAND
-            if not len(nodeBAND) == 0:
+            if band in md.bands:
 
-                temp = nodeBAND[0].getElementsByTagName('ABSCALFACTOR')
-                if not len(temp) == 0:
-                    abscal = float(temp[0].firstChild.data)
-                else:
+                abscal = md.bands[band]["ABSCALFACTOR"]
+                if abscal is None:
                     return calibDict
 
-                temp = nodeBAND[0].getElementsByTagName('EFFECTIVEBANDWIDTH')
-                if not len(temp) == 0:
-                    effbandw = float(temp[0].firstChild.data)
-                else:
+                effbandw = md.bands[band]["EFFECTIVEBANDWIDTH"]
+                if effbandw is None:
                     return calibDict
 
                 sunAngle = 90 - sunEl
@@ -1236,7 +1655,7 @@ def getIKMetadata(fp_mode, metafile):
 		]
 
 
-	metad = getIKMetadataAsXml(metafile)
+	metad = metadata.getMetadata(metafile).tree
 	if metad is not None:
 		metadict = {}
 		search_keys = dict(ik2fp)
@@ -1320,151 +1739,18 @@ def getIKMetadata(fp_mode, metafile):
 	return metadict
 
 
-def getIKMetadataAsXml(metafile):
-	"""
-	Given the text of an IKONOS metadata file, returns all the key/pair values as a
-	searchable XML tree
-	"""
-	if not metafile:
-		return ET.Element("root")  # No metadata provided, return an empty tree
-
-	# If metafile is a file, open it and read from it, otherwise assume a list of strings
-	if os.path.isfile(metafile) and os.path.getsize(metafile) > 0:
-		try:
-			metaf = open(metafile, "r")
-		except IOError, err:
-			print "Could not open metadata file %s because %s" % (metafile, err)
-			raise
-	else:
-		metaf = metafile
-
-	# Patterns to identify tag/value pairs and group tags
-	ikpat1 = re.compile(r"(?P<tag>.+?): (?P<data>.+)?", re.I)
-	ikpat2 = re.compile(r"(?P<tag>[a-zA-Z ()]+)", re.I)
-
-	# Lists of tags known to be at a certain depth of the tree, to be used as
-	# attributes rather than nodes or ignored altogether
-	tags_1L = ["Product_Order_Metadata", "Source_Image_Metadata", "Product_Space_Metadata",
-			   "Product_Component_Metadata"]
-	tags_2L = ["Source_Image_ID", "Component_ID"]
-	tags_coords = ["Latitude", "Longitude", "Map_X_(Easting)", "Map_Y_(Northing)",
-				   "UL_Map_X_(Easting)", "UL_Map_Y_(Northing)"]
-	ignores = ["Company Information", "Address", "GeoEye", "12076 Grant Street",
-			  "Thornton, Colorado 80241", "U.S.A.", "Contact Information",
-			  "On the Web: http://www.geoeye.com", "Customer Service Phone (U.S.A.): 1.800.232.9037",
-			  "Customer Service Phone (World Wide): 1.703.480.5670",
-			  "Customer Service Fax (World Wide): 1.703.450.9570", "Customer Service Email: info@geoeye.com",
-			  "Customer Service Center hours of operation:", "Monday - Friday, 8:00 - 20:00 Eastern Standard Time"
-			  ]
-
-	# Start processing
-	root = ET.Element("root")
-	parent = None
-	current = root
-	node_stack = []
-
-	for line in metaf:
-		item = line.strip()
-		if item in ignores:
-			continue  # Skip this stuff
-
-		# Can't have spaces or slashes in node tags
-		item = item.replace(" ", "_").replace("/", "_")
-
-		# If we've found a top-level group name, handle it here
-		if item in tags_1L:
-			child = ET.SubElement(root, item)
-			node_stack = []  # top-level nodes are children of root so reset
-			parent = root
-			current = child
-
-		# Everything else
-		else:
-			mat1 = ikpat1.search(line)
-			mat2 = ikpat2.search(line) if not mat1 else None
-
-			# Tag/value pair
-			if mat1:
-				tag = mat1.group("tag").strip().replace(" ", "_").replace("/", "_")
-				if mat1.group("data"):
-					data = mat1.group("data").strip()
-				else:
-					data = ""
-
-				# Second-level groups define major blocks
-				if tag in tags_2L:
-					# We may have been working on a different second-level tag, so
-					# reset the stack and pointers as needed
-					while current.tag not in tags_1L and current.tag != "root":
-						current = parent
-						parent = node_stack.pop()
-
-					# Now add the new child node
-					child = ET.SubElement(current, tag)
-					child.set("id", data)  # Currently, all 2L tags are IDs
-					node_stack.append(parent)
-					parent = current
-					current = child
-
-				# Handle 'Coordinate' tags as a special case
-				elif tag == "Coordinate":
-					# If we were working on a Coordinate, back up a level
-					if current.tag == "Coordinate":
-						child = ET.SubElement(parent, tag)
-						child.set("id", data)
-						current = child
-					else:
-						child = ET.SubElement(current, tag)
-						child.set("id", data)
-						node_stack.append(parent)
-						parent = current
-						current = child
-
-				# Vanilla tag/value pair
-				else:
-					# Adjust depth if we just finished a Coordinate block
-					if tag not in tags_coords and current.tag == "Coordinate":
-						while current.tag not in tags_2L and current.tag not in tags_1L and current.tag != "root":
-							current = parent
-							parent = node_stack.pop()
-
-					# Add a standard node
-					child = ET.SubElement(current, tag)
-					child.text = data
-
-			# Handle new group names
-			elif mat2:
-				tag = mat2.group("tag").strip()
-
-				# Except for Coordinates there aren't really any 4th level tags we care about, so we always
-				# back up until current points at a second or top-level node
-				while current.tag not in tags_2L and current.tag not in tags_1L and current.tag != "root":
-					current = parent
-					parent = node_stack.pop()
-
-				# Now add the new group node
-				child = ET.SubElement(current, tag)
-				node_stack.append(parent)
-				parent = current
-				current = child
-
-	return ET.ElementTree(root)
-
-
-def GetGEcalibDict(metafile,stretch):
-    fp_mode = "renamed"
-    metadict = getGEMetadata(fp_mode,metafile)
-    #print metadict
+def GetGEcalibDict(metafile,stretch,table_path=None):
+    md = scene_table.getSceneAttributes(metafile,table_path)
 
     calibDict = {}
     EsunDict = [196.0, 185.3, 150.5, 103.9, 161.7]
 
 
-    for band in metadict["gain"].keys():
-        sunAngle = 90 - float(metadict["firstLineSunElevationAngle"])
-        datestr = metadict["originalFirstLineAcquisitionDateTime"] # 2009-11-01T01:49:33.685421Z
+    for band in md.gains.keys():
+        sunAngle = 90 - md.sunel
+        datestr = md.caltime # 2009-11-01T01:49:33.685421Z
         des = calcEarthSunDist(datetime.strptime(datestr,"%Y-%m-%dT%H:%M:%S.%fZ"))
-        gain = float(metadict["gain"][band])
+        gain = md.gains[band]
         Esun = EsunDict[band-1]
 
         #print sunAngle, des, gain, Esun
@@ -1479,113 +1765,6 @@ def GetGEcalibDict(metafile,stretch):
     return calibDict
 
 
-def getGEMetadata(fp_mode, metafile):
-	metadict = {}
-	metad = getGEMetadataAsXml(metafile)
-	if metad is not None:
-
-            search_keys = ["originalFirstLineAcquisitionDateTime", "firstLineSunElevationAngle"]
-            for key in search_keys:
-                node = metad.find(".//%s" % key)
-                if node is not None:
-                    metadict[key] = node.text
-
-            band_keys = ["gain", "offset"]
-            for key in band_keys:
-                nodes = metad.findall(".//bandSpecificInformation")
-
-                vals = {}
-                for node in nodes:
-                    try:
-                        band = int(node.attrib["bandNumber"])
-                    except Exception, e:
-                        LogMsg("Unable to retrieve band number in GE metadata")
-                    else:
-                        node = node.find(".//%s" % key)
-                        if node is not None:
-                            vals[band] = node.text
-                metadict[key] = vals
-	else:
-            LogMsg("Unable to get metadata from %s" % metafile)
-
-	return metadict
-
-
-def getGEMetadataAsXml(metafile):
-	if os.path.isfile(metafile):
-		try:
-			metaf = open(metafile, "r")
-		except IOError, err:
-			LogMsg("Could not open metadata file %s because %s" % (metafile, err))
-			raise
-	else:
-		LogMsg("Metadata file %s not found" % metafile)
-		return None
-
-	# Patterns to extract tag/value pairs and BEGIN/END group tags
-	gepat1 = re.compile(r'(?P<tag>\w+) = "?(?P<data>.*?)"?;', re.I)
-	gepat2 = re.compile(r"(?P<tag>\w+) = ", re.I)
-
-	# These tags use the following tag/value as an attribute of the group rather than
-	# a standalone node
-	group_tags = {"aoiGeoCoordinate":"coordinateNumber",
-				  "aoiMapCoordinate":"coordinateNumber",
-				  "bandSpecificInformation":"bandNumber"}
-
-	# Start processing
-	root = ET.Element("root")
-	parent = None
-	current = root
-	node_stack = []
-	mlstr = False  # multi-line string flag
-
-	for line in metaf:
-		# mlstr will be true when working on a multi-line string
-		if mlstr:
-			if not line.strip() == ");":
-				data += line.strip()
-			else:
-				data += line.strip()
-				child = ET.SubElement(current, tag)
-				child.text = data
-				mlstr = False
-
-		# Handle tag/value pairs and groups
-		mat1 = gepat1.search(line)
-		if mat1:
-			tag = mat1.group("tag").strip()
-			data = mat1.group("data").strip()
-
-			if tag == "BEGIN_GROUP":
-				if data is None or data == "":
-					child = ET.SubElement(current, "group")
-				else:
-					child = ET.SubElement(current, data)
-				if parent:
-					node_stack.append(parent)
-				parent = current
-				current = child
-			elif tag == "END_GROUP":
-				current = parent if parent else root
-				parent = node_stack.pop() if node_stack else None
-			else:
-				if current.tag in group_tags and tag == group_tags[current.tag]:
-					current.set(tag, data)
-				else:
-					child = ET.SubElement(current, tag)
-					child.text = data
-		else:
-			mat2 = gepat2.search(line)
-			if mat2:
-				tag = mat2.group("tag").strip()
-				data = ""
-				mlstr = True
-
-	metaf.close()
-	#print ET.ElementTree(root)
-	return ET.ElementTree(root)
-
-
 def XmlToJ2w(jp2p):
 
     xmlp = jp2p+".aux.xml"
@@ -1651,6 +1830,27 @@ def getBitdepth(outtype):
     return bitdepth
 
 
+def getImageUnits(srcfp):
+    """
+    Return the size of an image in megapixels times bands (the work units of the job cost model), or None if
+    it cannot be opened.  Ikonos msi names are measured from their single band files.
+    """
+
+    if not os.path.isfile(srcfp) and os.path.isfile(srcfp.replace('msi','blu')):
+        paths = [srcfp.replace('msi',b) for b in ikMsiBands]
+    else:
+        paths = [srcfp]
+
+    units = 0.0
+    for path in paths:
+        ds = gdal.Open(path,gdalconst.GA_ReadOnly)
+        if ds is None:
+            return None
+        units += ds.RasterXSize * ds.RasterYSize * ds.RasterCount / 1e6
+        ds = None
+    return units
+
+
 def getSensor(srcfn):
 
     ### Regex signatures to identify file vendor, mode, kind, and create the name_dict
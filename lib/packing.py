@@ -0,0 +1,183 @@
+"""
+Cost model and work packing for cluster jobs.  The run time of a work item (an image to ortho or pansharpen,
+a mosaic tile) is estimated as a fixed start-up overhead plus a rate times its size in units of megapixels
+times bands.  Rates are kept per cost key, the kind of work plus the options that change its cost (e.g.
+"ortho+dem+rf"), and are fitted from a timings file of past runs, falling back to built-in defaults.  Items
+are then packed into jobs that fill a target walltime, so small items share the per-job scheduling overhead
+and large items run alone.
+"""
+
+import os, bisect, logging
+
+logger = logging.getLogger("logger")
+
+TIMINGS_VERSION = "TIMINGS 1"
+
+#### Default (overhead seconds, seconds per unit) by kind of work, used until a cost key has been calibrated
+DEFAULT_COSTS = {
+    "ortho": (60.0, 0.5),
+    "pansharpen": (120.0, 1.0),
+    "mosaic": (60.0, 0.05),
+}
+DEFAULT_COST = (60.0, 0.5)
+
+#### Cost multipliers of options for uncalibrated cost keys
+OPTION_FACTORS = {
+    "dem": 2.0,
+    "mr": 1.2,
+}
+
+#### Timings needed to fit a cost key
+MIN_SAMPLES = 5
+
+
+def costKey(kind, options):
+    """
+    Return the cost key for a kind of work and a list of options (None and empty options are dropped)
+    """
+    return "+".join([kind] + [str(o) for o in options if o])
+
+
+class CostModel(object):
+    """
+    Run time estimates by cost key.  coeffs holds the fitted (overhead, rate) of each calibrated key.
+    """
+
+    def __init__(self, timings_path=None):
+        self.coeffs = {}
+        if timings_path is not None and os.path.isfile(timings_path):
+            self.calibrate(readTimings(timings_path))
+
+
+    def calibrate(self, records):
+        """
+        Fit the overhead and rate of each cost key with at least MIN_SAMPLES (key, units, seconds) records
+        """
+
+        samples = {}
+        for key, units, seconds in records:
+            samples.setdefault(key, []).append((units, seconds))
+
+        for key, pts in samples.iteritems():
+            if len(pts) >= MIN_SAMPLES:
+                self.coeffs[key] = fitCost(pts, self.getDefault(key)[0])
+                logger.debug("Cost of %s: %.1f s + %.4f s/unit (%i timings)" %(key,self.coeffs[key][0],self.coeffs[key][1],len(pts)))
+
+
+    def getDefault(self, key):
+        parts = key.split("+")
+        overhead, rate = DEFAULT_COSTS.get(parts[0], DEFAULT_COST)
+        for opt in parts[1:]:
+            rate *= OPTION_FACTORS.get(opt, 1.0)
+        return overhead, rate
+
+
+    def estimate(self, key, units):
+        """
+        Return the estimated run time in seconds of an item, or None if its size is unknown
+        """
+
+        if units is None:
+            return None
+        overhead, rate = self.coeffs.get(key) or self.getDefault(key)
+        return overhead + rate * units
+
+
+def fitCost(pts, default_overhead):
+    """
+    Least squares fit of seconds = overhead + rate * units.  If the fit is degenerate or gives a negative
+    term, the overhead is fixed at the default (or zero) and only the rate is fitted.
+    """
+
+    n = float(len(pts))
+    mu = sum([u for u, s in pts]) / n
+    ms = sum([s for u, s in pts]) / n
+    suu = sum([(u - mu) ** 2 for u, s in pts])
+    sus = sum([(u - mu) * (s - ms) for u, s in pts])
+
+    if suu > 0:
+        rate = sus / suu
+        overhead = ms - rate * mu
+        if rate > 0 and overhead >= 0:
+            return overhead, rate
+
+    overhead = min(default_overhead, min([s for u, s in pts]))
+    su = sum([u for u, s in pts])
+    rate = max(0.0, sum([s for u, s in pts]) - overhead * n) / su if su > 0 else 0.0
+    return overhead, rate
+
+
+def readTimings(path):
+    """
+    Return the (key, units, seconds) records of a timings file, skipping malformed lines
+    """
+
+    records = []
+    try:
+        f = open(path, 'r')
+    except IOError, e:
+        logger.warning("Cannot read timings file %s: %s" %(path,e))
+        return records
+
+    header = f.readline().strip()
+    if header != TIMINGS_VERSION:
+        logger.warning("Timings file %s has an unknown format, ignoring it" %path)
+        f.close()
+        return records
+
+    for line in f:
+        parts = line.split()
+        if len(parts) != 3:
+            continue
+        try:
+            records.append((parts[0], float(parts[1]), float(parts[2])))
+        except ValueError:
+            continue
+    f.close()
+    return records
+
+
+def recordTiming(path, key, units, seconds):
+    """
+    Append a timing record to a timings file, creating it if needed.  Jobs on several nodes may append to
+    the same file; each record is one short write.  Failures are logged and otherwise ignored.
+    """
+
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0664)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.write(fd, TIMINGS_VERSION + "\n")
+            os.write(fd, "%s %.3f %.1f\n" %(key, units, seconds))
+        finally:
+            os.close(fd)
+    except OSError, e:
+        logger.debug("Cannot write timing to %s: %s" %(path,e))
+
+
+def packItems(items, target):
+    """
+    Pack (item, estimated seconds) pairs into lists of items with a total estimate of at most target seconds,
+    using best fit decreasing.  Items with an unknown or larger estimate are packed alone.  Returns the list of
+    packs in the order of the items they start with.
+    """
+
+    packs = []
+    #### (remaining seconds, pack index) of the packs that can take more items, sorted by remaining time
+    open_packs = []
+    for n, (item, cost) in sorted(enumerate(items), key=lambda x: -(x[1][1] if x[1][1] is not None else target)):
+        if cost is None or cost >= target:
+            packs.append((n, [item]))
+            continue
+        k = bisect.bisect_left(open_packs, (cost, -1))
+        if k < len(open_packs):
+            remaining, p = open_packs.pop(k)
+            packs[p][1].append(item)
+            remaining -= cost
+        else:
+            p = len(packs)
+            packs.append((n, [item]))
+            remaining = target - cost
+        bisect.insort(open_packs, (remaining, p))
+
+    return [pack for first, pack in sorted(packs)]
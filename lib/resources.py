@@ -0,0 +1,279 @@
+import os, sys, re, time, signal, logging, multiprocessing
+from subprocess import Popen, PIPE
+
+logger = logging.getLogger("logger")
+
+#### Environment variable that overrides the detected core count (set by local process pools)
+THREADS_ENV = "PGC_NUM_THREADS"
+
+#### Seconds before the end of the walltime at which a WalltimeGuard gives up on the work in progress
+WALLTIME_GRACE = 120
+
+#### Time this module was loaded, standing in for the job start when only PBS_WALLTIME is known
+process_start = time.time()
+
+
+def getCgroupCpuLimit():
+    """
+    Return the number of cores allowed by the cgroup CPU quota, or None if unlimited
+    """
+
+    #### cgroup v2
+    try:
+        f = open("/sys/fs/cgroup/cpu.max",'r')
+        quota, period = f.read().split()[:2]
+        f.close()
+    except (IOError, OSError, ValueError):
+        pass
+    else:
+        if quota != "max" and int(period) > 0:
+            return max(1, int(int(quota) / int(period)))
+        return None
+
+    #### cgroup v1
+    try:
+        f = open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us",'r')
+        quota = int(f.read())
+        f.close()
+        f = open("/sys/fs/cgroup/cpu/cpu.cfs_period_us",'r')
+        period = int(f.read())
+        f.close()
+    except (IOError, OSError, ValueError):
+        return None
+
+    if quota > 0 and period > 0:
+        return max(1, int(quota / period))
+    return None
+
+
+def getAvailableCpus():
+    """
+    Return the number of cores this process has been given.  The PGC_NUM_THREADS override is used first,
+    then the PBS allocation (PBS_NUM_PPN), then the cgroup CPU quota, then the machine core count.
+    """
+
+    for var in (THREADS_ENV, "PBS_NUM_PPN"):
+        val = os.environ.get(var)
+        if val:
+            try:
+                return max(1, int(val))
+            except ValueError:
+                logger.warning("Invalid value for %s: %s" %(var,val))
+
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+
+    limit = getCgroupCpuLimit()
+    if limit is not None:
+        cpus = min(cpus, limit)
+
+    return cpus
+
+
+def getCgroupMemoryLimit():
+    """
+    Return the cgroup memory limit in bytes, or None if unlimited
+    """
+
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            f = open(path,'r')
+            val = f.read().strip()
+            f.close()
+        except (IOError, OSError):
+            continue
+        if val == "max":
+            return None
+        try:
+            limit = int(val)
+        except ValueError:
+            return None
+        #### cgroup v1 reports "unlimited" as a huge page-aligned number
+        if limit >= 2**60:
+            return None
+        return limit
+
+    return None
+
+
+def getAvailableMemory():
+    """
+    Return the memory available to this process in bytes: MemAvailable from /proc/meminfo, limited by the
+    cgroup memory limit.  Returns None if it cannot be determined.
+    """
+
+    mem = None
+    try:
+        f = open("/proc/meminfo",'r')
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                mem = int(line.split()[1]) * 1024
+                break
+        f.close()
+    except (IOError, OSError, ValueError):
+        pass
+
+    limit = getCgroupMemoryLimit()
+    if limit is not None:
+        mem = limit if mem is None else min(mem, limit)
+
+    return mem
+
+
+def parseWalltime(val):
+    """
+    Parse a walltime of [D-][[HH:]MM:]SS to seconds
+    """
+
+    days = 0
+    hms = val.strip()
+    if "-" in hms:
+        d, hms = hms.split("-", 1)
+        try:
+            days = int(d)
+        except ValueError:
+            raise ValueError("Cannot parse walltime: %s" %val)
+    try:
+        parts = [int(p) for p in hms.split(":")]
+    except ValueError:
+        raise ValueError("Cannot parse walltime: %s" %val)
+    if len(parts) > 3:
+        raise ValueError("Cannot parse walltime: %s" %val)
+    seconds = 0
+    for p in parts:
+        seconds = seconds * 60 + p
+    return days * 86400 + seconds
+
+
+def getWalltimeRemaining():
+    """
+    Return the seconds of walltime left to the cluster job this process runs in, or None outside a job or if
+    it cannot be determined.  SLURM is asked with squeue, PBS with qstat -f (Walltime.Remaining, or the
+    requested walltime less the walltime used).  If qstat fails, PBS_WALLTIME (set by Torque) is used,
+    assuming the job started with this process.
+    """
+
+    jobid = os.environ.get("SLURM_JOB_ID")
+    if jobid:
+        so = runQuery(["squeue", "-h", "-j", jobid, "-o", "%L"])
+        if so:
+            try:
+                return parseWalltime(so.strip())
+            except ValueError:
+                #### UNLIMITED or NOT_SET
+                return None
+        return None
+
+    jobid = os.environ.get("PBS_JOBID")
+    if not jobid:
+        return None
+
+    so = runQuery(["qstat", "-f", jobid])
+    if so:
+        attribs = dict(re.findall(r"^\s*([\w.]+) = (.*)$", so, re.M))
+        try:
+            if "Walltime.Remaining" in attribs:
+                return int(attribs["Walltime.Remaining"])
+            if "Resource_List.walltime" in attribs:
+                return parseWalltime(attribs["Resource_List.walltime"]) - parseWalltime(attribs.get("resources_used.walltime", "0"))
+        except ValueError:
+            logger.debug("Cannot parse the walltime of job %s" %jobid)
+
+    val = os.environ.get("PBS_WALLTIME")
+    if val:
+        try:
+            return max(0, int(val) - int(time.time() - process_start))
+        except ValueError:
+            logger.warning("Invalid value for PBS_WALLTIME: %s" %val)
+    return None
+
+
+def runQuery(cmd):
+    """
+    Run a scheduler query command and return its output, or None if it failed
+    """
+
+    try:
+        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    except OSError, e:
+        logger.debug("Cannot run %s: %s" %(cmd[0],e))
+        return None
+    (so, se) = p.communicate()
+    if p.returncode != 0:
+        logger.debug("%s failed (return code %i): %s" %(" ".join(cmd),p.returncode,se.strip()))
+        return None
+    return so
+
+
+class WalltimeExpired(BaseException):
+    """
+    Raised in work run by a WalltimeGuard when the job is about to be killed.  It derives from BaseException
+    so the "except Exception" blocks of the processing code let it through to the caller.
+    """
+    pass
+
+
+class WalltimeGuard(object):
+    """
+    Catch the end of a cluster job's walltime.  PBS and SLURM send SIGTERM shortly before killing a job, and
+    if the walltime (seconds from now) is given, an alarm goes off grace seconds before it runs out.  Either
+    marks the guard expired and, if a call made through run() is in progress, raises WalltimeExpired in it so
+    the caller can clean up and requeue its work.  Signals are handled in the main thread between Python
+    statements, so a GDAL call in progress finishes first; subprocesses get SIGTERM from the scheduler too.
+    """
+
+    def __init__(self, walltime=None, grace=WALLTIME_GRACE):
+        self.expired = False
+        self.running = False
+        self.deadline = None
+        signal.signal(signal.SIGTERM, self.onSignal)
+        if walltime is not None and hasattr(signal, "SIGALRM"):
+            self.deadline = time.time() + walltime - grace
+            signal.signal(signal.SIGALRM, self.onSignal)
+            signal.alarm(max(1, int(walltime - grace)))
+
+
+    def remaining(self):
+        """
+        Return the seconds left before the guard expires, or None if there is no known deadline
+        """
+
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+
+    def onSignal(self, signum, frame):
+        self.expired = True
+        if self.running:
+            self.running = False
+            raise WalltimeExpired("Walltime expired (signal %i)" %signum)
+
+
+    def run(self, func, *args):
+        """
+        Call func(*args) and return its result, raising WalltimeExpired if the guard expires before it returns
+        """
+
+        if self.expired:
+            raise WalltimeExpired("Walltime expired")
+        self.running = True
+        try:
+            return func(*args)
+        finally:
+            self.running = False
+
+
+def runGuarded(main):
+    """
+    Run the main() of a job script under a WalltimeGuard.  If it is stopped by SIGTERM, the work in progress
+    cleans up as the exception passes through it and the script exits with status 1.
+    """
+
+    try:
+        WalltimeGuard().run(main)
+    except WalltimeExpired, e:
+        logger.error("%s, job stopped" %e)
+        sys.exit(1)
@@ -0,0 +1,280 @@
+"""
+Archive scene metadata table.  Normalised scene attributes from the metadata sidecars of an image archive
+are stored in an SQLite database so that scoring and calibration can look them up instead of parsing the
+sidecars again.  Rows are keyed by metadata path and carry the file mtime and size; a rebuild only parses
+files that are new or have changed.
+"""
+
+import os, sqlite3, threading, logging
+from multiprocessing.pool import ThreadPool
+
+from lib import metadata, resources
+
+logger = logging.getLogger("logger")
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS scenes (
+        path TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        mtime REAL NOT NULL,
+        size INTEGER NOT NULL,
+        sensor TEXT,
+        catid TEXT,
+        acqdate TEXT,
+        firstlinetime TEXT,
+        caltime TEXT,
+        cc REAL,
+        sunel REAL,
+        ona REAL,
+        tdi TEXT,
+        heightoffset TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS bands (
+        path TEXT NOT NULL,
+        band TEXT NOT NULL,
+        abscalfactor REAL,
+        effectivebandwidth REAL,
+        gain REAL,
+        offset REAL,
+        PRIMARY KEY (path, band)
+    )""",
+    "CREATE INDEX IF NOT EXISTS scenes_name ON scenes (name, size)",
+]
+
+#### Number of parsed scenes written per transaction
+COMMIT_INTERVAL = 500
+
+#### Tolerance when matching file mtimes (copies may round sub-second times)
+MTIME_TOLERANCE = 0.001
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+class SceneTable(object):
+    """
+    Connection to a scene metadata table.  A single connection is shared by all threads of a process and
+    guarded by a lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=300, check_same_thread=False)
+        self.conn.text_factory = str
+
+        #### Tables from before the caltime column hold the wrong GeoEye first line times; rebuild them
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(scenes)").fetchall()]
+        if columns and "caltime" not in columns:
+            logger.warning("Scene table %s is from an older version and will be rebuilt" %path)
+            self.conn.execute("DROP TABLE scenes")
+            self.conn.execute("DROP TABLE IF EXISTS bands")
+
+        for stmt in SCHEMA:
+            self.conn.execute(stmt)
+        self.conn.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+    def getStamps(self):
+        """
+        Return a dict of metadata path -> (mtime, size) for all rows
+        """
+        with self.lock:
+            rows = self.conn.execute("SELECT path, mtime, size FROM scenes").fetchall()
+        return dict((path, (mtime, size)) for path, mtime, size in rows)
+
+
+    def lookup(self, metapath):
+        """
+        Return a SceneMetadata record for a metadata file, or None if the table has no current row for it.
+        Rows are matched on file name, size and mtime so that copies of the sidecar (e.g. in a working
+        directory) are found as well as the archived original.
+        """
+
+        try:
+            st = os.stat(metapath)
+        except OSError:
+            return None
+
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, sensor, catid, firstlinetime, caltime, cc, sunel, ona, tdi, heightoffset FROM scenes "
+                "WHERE name = ? AND size = ? AND abs(mtime - ?) < ?",
+                (os.path.basename(metapath), st.st_size, st.st_mtime, MTIME_TOLERANCE)
+                ).fetchone()
+            if row is None:
+                return None
+            bands = self.conn.execute(
+                "SELECT band, abscalfactor, effectivebandwidth, gain, offset FROM bands WHERE path = ?",
+                (row[0],)
+                ).fetchall()
+
+        md = metadata.SceneMetadata(metapath)
+        path, md.satid, md.catid, md.firstlinetime, md.caltime, md.cc, md.sunel, md.ona, tdi, md.heightoffset = row
+        md.tdi = [float(t) for t in tdi.split(",")] if tdi else []
+
+        for band, abscal, effbw, gain, offset in bands:
+            if abscal is not None or effbw is not None:
+                md.bands[band] = {"ABSCALFACTOR":abscal, "EFFECTIVEBANDWIDTH":effbw}
+            if gain is not None:
+                md.gains[int(band)] = gain
+            if offset is not None:
+                md.offsets[int(band)] = offset
+
+        return md
+
+
+    def update(self, scenes):
+        """
+        Insert or replace rows for a list of (metadata path, mtime, size, SceneMetadata) tuples
+        """
+
+        with self.lock:
+            for metapath, mtime, size, md in scenes:
+                sensor = md.satid or getSensorFromName(metapath)
+                acqdate = md.firstlinetime[:10] if md.firstlinetime else None
+                tdi = ",".join([str(t) for t in md.tdi])
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO scenes VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                    (metapath, os.path.basename(metapath), mtime, size, sensor, md.catid, acqdate,
+                     md.firstlinetime, md.caltime, md.cc, md.sunel, md.ona, tdi, md.heightoffset)
+                    )
+
+                self.conn.execute("DELETE FROM bands WHERE path = ?", (metapath,))
+                for band, vals in md.bands.iteritems():
+                    self.conn.execute("INSERT INTO bands VALUES (?,?,?,?,NULL,NULL)",
+                                      (metapath, band, vals["ABSCALFACTOR"], vals["EFFECTIVEBANDWIDTH"]))
+                for band in sorted(set(md.gains.keys()) | set(md.offsets.keys())):
+                    self.conn.execute("INSERT INTO bands VALUES (?,?,NULL,NULL,?,?)",
+                                      (metapath, str(band), md.gains.get(band), md.offsets.get(band)))
+            self.conn.commit()
+
+
+    def remove(self, paths):
+        with self.lock:
+            for path in paths:
+                self.conn.execute("DELETE FROM scenes WHERE path = ?", (path,))
+                self.conn.execute("DELETE FROM bands WHERE path = ?", (path,))
+            self.conn.commit()
+
+
+def getSensorFromName(metapath):
+    name = os.path.basename(metapath)
+    if len(name) > 4 and name[4] == "_" and name[:2].isalpha() and name[2:4].isdigit():
+        return name[:4].upper()
+    return None
+
+
+def readScene(metapath):
+    """
+    Parse one metadata file.  Returns (metapath, mtime, size, SceneMetadata), with None in place of the
+    record if the file cannot be parsed.
+    """
+
+    try:
+        st = os.stat(metapath)
+        md = metadata.getMetadata(metapath)
+    except Exception, e:
+        logger.warning("Cannot read metadata %s: %s" %(metapath,e))
+        return (metapath, None, None, None)
+
+    return (metapath, st.st_mtime, st.st_size, md)
+
+
+def buildSceneTable(table_path, metapaths, threads=None, prune=False):
+    """
+    Add or refresh table rows for a list of metadata files.  Unchanged files are skipped, and the others are
+    parsed with a thread pool.  If prune is True, rows for files that no longer exist are removed.
+    Returns the counts of (updated, unchanged, failed) files.
+    """
+
+    if threads is None:
+        threads = resources.getAvailableCpus()
+
+    table = SceneTable(table_path)
+    stamps = table.getStamps()
+
+    todo = []
+    unchanged = 0
+    for metapath in metapaths:
+        metapath = os.path.abspath(metapath)
+        try:
+            st = os.stat(metapath)
+        except OSError:
+            continue
+        if metapath in stamps and stamps[metapath] == (st.st_mtime, st.st_size):
+            unchanged += 1
+        else:
+            todo.append(metapath)
+
+    logger.info("Scenes to parse: %i, unchanged: %i" %(len(todo),unchanged))
+
+    updated = 0
+    failed = 0
+    batch = []
+    pool = ThreadPool(max(1, threads))
+    try:
+        for metapath, mtime, size, md in pool.imap_unordered(readScene, todo, 16):
+            if md is None:
+                failed += 1
+                continue
+            batch.append((metapath, mtime, size, md))
+            if len(batch) >= COMMIT_INTERVAL:
+                table.update(batch)
+                updated += len(batch)
+                batch = []
+                logger.info("Scenes written: %i of %i" %(updated,len(todo)))
+    finally:
+        pool.close()
+        pool.join()
+
+    if batch:
+        table.update(batch)
+        updated += len(batch)
+
+    if prune:
+        missing = [path for path in stamps if not os.path.isfile(path)]
+        if missing:
+            logger.info("Removing %i scenes with missing metadata files" %len(missing))
+            table.remove(missing)
+
+    table.close()
+    metadata.clearCache()
+    return updated, unchanged, failed
+
+
+def openSceneTable(table_path):
+    """
+    Return a shared SceneTable connection for a table path
+    """
+
+    with _tables_lock:
+        table = _tables.get(table_path)
+        if table is None:
+            table = SceneTable(table_path)
+            _tables[table_path] = table
+    return table
+
+
+def getSceneAttributes(metapath, table_path=None):
+    """
+    Return the SceneMetadata record for a metadata file.  If a scene table is given and has a current row for
+    the file it is used, otherwise the file is parsed.
+    """
+
+    if table_path:
+        try:
+            md = openSceneTable(table_path).lookup(metapath)
+        except sqlite3.Error, e:
+            logger.warning("Cannot read scene table %s: %s" %(table_path,e))
+        else:
+            if md is not None:
+                return md
+            logger.debug("Scene not in table, parsing metadata: %s" %metapath)
+
+    return metadata.getMetadata(metapath)
@@ -0,0 +1,874 @@
+"""
+Job submission backends for the *_parallel scripts.  A job is described by a JobSpec (name, script and
+arguments, optional output and log paths) and submitted to a Scheduler: PBS/Torque (qsub), SLURM (sbatch),
+a local process pool, or a dry run that only logs the jobs.  Resource requests are held in a typed Resources
+object that is parsed from the PBS -l syntax and translated for each backend.
+
+The cluster backends submit queued jobs as job arrays, with an index file mapping each array task to a job
+command line, so a campaign of thousands of images needs a handful of submit commands.  Jobs carrying a cost
+estimate can also be packed several to an array task to fill a target walltime (see lib/packing.py).
+Alternatively, jobs can be added to a shared queue (lib/job_queue.py) and run by long-lived pgc_worker.py
+jobs, which pay the interpreter and GDAL start-up once per worker instead of once per job.
+
+The cluster backends run the scheduler commands found on the PATH, so a stand-in qsub or sbatch script can
+be used to exercise the submission logic without a cluster.
+"""
+
+import os, sys, re, json, math, signal, logging
+from datetime import datetime
+from subprocess import Popen, PIPE, STDOUT
+from multiprocessing.pool import ThreadPool
+
+from lib import resources, packing, job_queue
+
+logger = logging.getLogger("logger")
+
+SCHEDULERS = ["pbs","slurm","local","dryrun"]
+
+#### Option names added by addSchedulerArguments, which must not be passed on to the job scripts
+SCHEDULER_ARG_KEYS = ('scheduler','processes','array_size','batch_size','pack_walltime','timings','queue','workers')
+
+#### Maximum tasks per job array (Torque and SLURM both default to about 1000), and jobs per batched
+#### submission when arrays cannot be used
+ARRAY_SIZE = 1000
+BATCH_SIZE = 10
+
+#### Script that runs the tasks of a job array, and the variables holding the array task index
+ARRAY_TASK_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pgc_array_task.py")
+ARRAY_INDEX_VARS = ["PBS_ARRAYID","PBS_ARRAY_INDEX","SLURM_ARRAY_TASK_ID"]
+
+#### Exit code of an array task that left jobs unfinished at its walltime without resubmitting them
+UNFINISHED_EXIT_CODE = 3
+
+#### Worker script for --queue, and the number of queued jobs per cluster worker when --workers is not given
+WORKER_SCRIPT = os.path.join(os.path.dirname(ARRAY_TASK_SCRIPT), "pgc_worker.py")
+JOBS_PER_WORKER = 50
+
+MEMORY_UNITS = {"b":1.0/1024**2, "kb":1.0/1024, "mb":1, "gb":1024, "tb":1024**2}
+
+
+class Resources(object):
+    """
+    Resources requested for a job.  nodes and ppn (cores per node) are ints, mem is in megabytes and
+    walltime in seconds; any of them may be None to use the scheduler or submit script default.  extra holds
+    PBS resources that have no typed equivalent.
+    """
+
+    def __init__(self, nodes=None, ppn=None, mem=None, walltime=None, extra=None):
+        self.nodes = nodes
+        self.ppn = ppn
+        self.mem = mem
+        self.walltime = walltime
+        self.extra = extra if extra is not None else []
+
+
+    @classmethod
+    def fromPbs(cls, spec):
+        """
+        Parse a PBS resource list such as "walltime=20:00:00,nodes=1:ppn=2,mem=8gb".  Raises ValueError if a
+        typed resource cannot be parsed.
+        """
+
+        res = cls()
+        if not spec:
+            return res
+
+        for item in spec.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            key, sep, val = item.partition("=")
+            key = key.lower()
+            if key == "nodes":
+                parts = val.split(":")
+                if not parts[0].isdigit():
+                    res.extra.append(item)
+                    continue
+                res.nodes = int(parts[0])
+                props = []
+                for part in parts[1:]:
+                    if part.startswith("ppn="):
+                        res.ppn = int(part[4:])
+                    else:
+                        props.append(part)
+                if props:
+                    res.extra.append("nodeprops=%s" %":".join(props))
+            elif key == "ppn":
+                res.ppn = int(val)
+            elif key == "mem":
+                res.mem = parseMemory(val)
+            elif key == "walltime":
+                res.walltime = resources.parseWalltime(val)
+            else:
+                res.extra.append(item)
+
+        return res
+
+
+    def toPbs(self):
+        """
+        Return the qsub arguments requesting these resources
+        """
+
+        items = []
+        if self.nodes is not None or self.ppn is not None:
+            nodespec = "nodes=%i" %(self.nodes if self.nodes is not None else 1)
+            if self.ppn is not None:
+                nodespec += ":ppn=%i" %self.ppn
+            for item in self.extra:
+                if item.startswith("nodeprops="):
+                    nodespec += ":" + item[10:]
+            items.append(nodespec)
+        if self.walltime is not None:
+            items.append("walltime=%s" %formatWalltime(self.walltime))
+        if self.mem is not None:
+            items.append("mem=%imb" %self.mem)
+        items.extend([item for item in self.extra if not item.startswith("nodeprops=")])
+
+        return ["-l", ",".join(items)] if items else []
+
+
+    def toSlurm(self):
+        """
+        Return the sbatch arguments requesting these resources
+        """
+
+        args = []
+        if self.nodes is not None:
+            args.append("--nodes=%i" %self.nodes)
+        if self.ppn is not None:
+            args.append("--cpus-per-task=%i" %self.ppn)
+        if self.mem is not None:
+            args.append("--mem=%iM" %self.mem)
+        if self.walltime is not None:
+            args.append("--time=%s" %formatWalltime(self.walltime))
+        if self.extra:
+            logger.warning("Resources not supported by SLURM are ignored: %s" %",".join(self.extra))
+        return args
+
+
+def parseMemory(val):
+    m = re.match(r"^(\d+(?:\.\d+)?)([kmgt]?b?)$", val.strip().lower())
+    if m is None:
+        raise ValueError("Cannot parse memory request: %s" %val)
+    unit = m.group(2) or "b"
+    if not unit.endswith("b"):
+        unit += "b"
+    return int(float(m.group(1)) * MEMORY_UNITS[unit] + 0.5)
+
+
+def formatWalltime(seconds):
+    return "%i:%02i:%02i" %(seconds / 3600, (seconds / 60) % 60, seconds % 60)
+
+
+class JobSpec(object):
+    """
+    A job running a python script.
+
+    name:       job name
+    script:     path of the python script
+    args:       list of arguments (pre-formatted option strings are allowed and empty items are dropped)
+    output:     file the job creates; a local job that exits without creating it has failed
+    log:        file for the output of a local job (cluster jobs write output as set in the submit script)
+    resources:  Resources for this job, overriding the scheduler default
+    env:        dict of extra environment variables
+    cost_key:   packing.costKey of the work, for packing jobs and recording their timings
+    units:      size of the work in the units of the cost model (megapixels times bands), None if unknown
+    """
+
+    def __init__(self, name, script, args=None, output=None, log=None, resources=None, env=None, cost_key=None, units=None):
+        self.name = name
+        self.script = script
+        self.args = [str(a) for a in (args or []) if a is not None and str(a) != ""]
+        self.output = output
+        self.log = log
+        self.resources = resources
+        self.env = env if env is not None else {}
+        self.cost_key = cost_key
+        self.units = units
+
+
+    def commandLine(self):
+        """
+        Return the script and arguments as one string, as passed to the submit scripts in p1
+        """
+        return " ".join([self.script] + self.args)
+
+
+class Scheduler(object):
+    """
+    Base class of the scheduler backends.  submit() hands a job to the scheduler, and wait() submits or runs
+    any queued jobs, blocks until the jobs that run on this machine are done, and returns the number that
+    failed.
+    """
+
+    name = None
+
+    def __init__(self, submit_script=None, resources=None):
+        self.submit_script = submit_script
+        self.resources = resources if resources is not None else Resources()
+
+
+    def submit(self, job):
+        raise NotImplementedError
+
+
+    def wait(self):
+        return 0
+
+
+    def getResources(self, job):
+        return job.resources if job.resources is not None else self.resources
+
+
+class ClusterScheduler(Scheduler):
+    """
+    Base class of the cluster backends.  Jobs are queued by submit() and sent by wait() as job arrays of up to
+    array_size tasks, so a large campaign needs one submit command per array instead of one per job.  The
+    command lines of an array are written to an index file and each array task runs one line of it with
+    pgc_array_task.py.  If an array cannot be submitted, its jobs and those of later arrays are submitted in
+    batches of batch_size lines per job instead.  With array_size 0 (or None) every job is submitted on its own.
+    wait() returns the number of jobs whose submission failed.
+
+    If pack_walltime (seconds) is set, the jobs are first packed into lines of several jobs whose estimated run
+    times add up to about pack_walltime, using a packing.CostModel calibrated from the timings file.  If a
+    timings file is given, the array tasks append the run time of each job to it.
+    """
+
+    def __init__(self, submit_script=None, resources=None, array_size=ARRAY_SIZE, batch_size=BATCH_SIZE,
+                 pack_walltime=None, timings=None):
+        Scheduler.__init__(self, submit_script, resources)
+        self.array_size = array_size
+        self.batch_size = max(1, batch_size or 1)
+        self.use_arrays = bool(array_size)
+        self.pack_walltime = pack_walltime
+        self.timings = timings
+        self.cost_model = packing.CostModel(timings) if pack_walltime else None
+        self.queue = []
+        self.failed = 0
+
+
+    def submit(self, job):
+        if not self.array_size and not self.pack_walltime:
+            jobid = self.trySubmitJob(job)
+            if jobid is None:
+                self.failed += 1
+            return jobid
+        self.queue.append(job)
+        return None
+
+
+    def wait(self):
+        jobs, self.queue = self.queue, []
+        failed, self.failed = self.failed, 0
+
+        #### Jobs can share an array only if they have the same resources and environment
+        groups = {}
+        keys = []
+        for job in jobs:
+            key = (tuple(self.getResources(job).toPbs()), tuple(sorted(job.env.items())))
+            if key not in groups:
+                groups[key] = []
+                keys.append(key)
+            groups[key].append(job)
+
+        for key in keys:
+            packs = self.packJobs(groups[key])
+            size = self.array_size or ARRAY_SIZE
+            for k in range(0, len(packs), size):
+                failed += self.submitArray(packs[k:k+size], k)
+
+        if failed > 0:
+            logger.error("%i jobs were not submitted" %failed)
+        return failed
+
+
+    def packJobs(self, jobs):
+        """
+        Return the jobs as a list of packs, one job per pack unless packing is enabled
+        """
+
+        if not self.pack_walltime:
+            return [[job] for job in jobs]
+
+        items = [(job, self.cost_model.estimate(job.cost_key, job.units)) for job in jobs]
+        packs = packing.packItems(items, self.pack_walltime)
+        logger.info("Packed %i jobs into %i jobs of up to %s estimated run time" %(len(jobs),len(packs),formatWalltime(self.pack_walltime)))
+        return packs
+
+
+    def submitArray(self, packs, offset=0):
+        """
+        Submit packs as a job array, or in batches if arrays are rejected, and return the number of jobs that
+        were not submitted
+        """
+
+        if len(packs) == 1 and len(packs[0]) == 1:
+            return 1 if self.trySubmitJob(packs[0][0]) is None else 0
+
+        template = packs[0][0]
+        name = getArrayName(template)
+        indexpath = writeIndexFile(name, packs)
+        task_args = [indexpath, "--timings %s" %self.timings if self.timings else None, self.getResubmitArgs(template, name)]
+        if self.use_arrays:
+            job = JobSpec(name, ARRAY_TASK_SCRIPT, task_args, resources=template.resources, env=template.env)
+            try:
+                jobid = self.submitJob(job, len(packs))
+            except SubmitError, e:
+                #### The submit command cannot be run at all, so batches would fail too
+                logger.error(str(e))
+                return countJobs(packs)
+            if jobid is not None:
+                logger.info("Submitted %i jobs as array %s (index %s)" %(len(packs),name,indexpath))
+                return 0
+            logger.warning("Cannot submit job arrays, submitting in batches of %i jobs" %self.batch_size)
+            self.use_arrays = False
+
+        #### Batch job names are numbered by the position of their first line in the group
+        batch_size = self.batch_size if self.array_size else 1
+        failed = 0
+        for k in range(0, len(packs), batch_size):
+            last = min(k + batch_size, len(packs)) - 1
+            job = JobSpec("%s%04i" %(name,offset+k), ARRAY_TASK_SCRIPT, task_args + ["--first %i --last %i" %(k,last)],
+                          resources=template.resources, env=template.env)
+            try:
+                jobid = self.submitJob(job)
+            except SubmitError, e:
+                logger.error(str(e))
+                return failed + countJobs(packs[k:])
+            if jobid is None:
+                failed += countJobs(packs[k:last+1])
+        return failed
+
+
+    def getResubmitArgs(self, template, name):
+        """
+        Return the pgc_array_task.py options that let its tasks resubmit the jobs they cannot finish in time
+        through this backend
+        """
+
+        if self.submit_script is None:
+            return None
+        args = "--resubmit %s --qsubscript %s --name %s" %(self.name, os.path.abspath(self.submit_script), name)
+        res = self.getResources(template).toPbs()
+        if res:
+            args += " -l %s" %res[1]
+        return args
+
+
+    def trySubmitJob(self, job):
+        """
+        Submit one job and return its job id, or None if it failed or the submit command cannot be run
+        """
+
+        try:
+            return self.submitJob(job)
+        except SubmitError, e:
+            logger.error(str(e))
+            return None
+
+
+    def submitJob(self, job, array_tasks=None):
+        """
+        Submit one job, or a job array of array_tasks tasks, and return its job id or None if it was rejected.
+        Raises SubmitError if the submit command cannot be run.
+        """
+        raise NotImplementedError
+
+
+class PbsScheduler(ClusterScheduler):
+    """
+    Submit jobs with qsub.  The command line is passed to the submit script in the p1 variable, and arrays use
+    the Torque -t option.
+    """
+
+    name = "pbs"
+    command = "qsub"
+
+    def submitJob(self, job, array_tasks=None):
+        cmd = [self.command] + self.getResources(job).toPbs()
+        if array_tasks is not None:
+            cmd += ["-t", "0-%i" %(array_tasks - 1)]
+        cmd += ["-N", job.name, "-v", "p1=%s" %job.commandLine(), self.submit_script]
+        return runSubmitCommand(cmd, job)
+
+
+class SlurmScheduler(ClusterScheduler):
+    """
+    Submit jobs with sbatch.  The command line is passed to the submit script in the p1 environment variable,
+    and PBS_O_WORKDIR is set so the PBS submit scripts can be used unchanged.
+    """
+
+    name = "slurm"
+    command = "sbatch"
+
+    def submitJob(self, job, array_tasks=None):
+        cmd = [self.command] + self.getResources(job).toSlurm()
+        if array_tasks is not None:
+            cmd.append("--array=0-%i" %(array_tasks - 1))
+        cmd += ["--job-name=%s" %job.name, "--export=ALL", self.submit_script]
+        env = dict(os.environ)
+        env.update(job.env)
+        env["p1"] = job.commandLine()
+        env["PBS_O_WORKDIR"] = os.getcwd()
+        return runSubmitCommand(cmd, job, env)
+
+
+class SubmitError(Exception):
+    """
+    Raised when a cluster submit command cannot be run (as opposed to a job being rejected)
+    """
+    pass
+
+
+def countJobs(packs):
+    return sum(len(pack) for pack in packs)
+
+
+def getArrayName(job):
+    #### Name an array after its first job, without the job number
+    return re.sub(r"\d+$", "", job.name) or job.name
+
+
+def writeIndexFile(name, packs):
+    """
+    Write an index file next to the output of the first job (or in the current directory) and return its
+    path.  Each line holds the jobs of one array task as a JSON list of {"cmd", "output", "key", "units"}
+    objects.
+    """
+
+    first = packs[0][0]
+    if first.output:
+        indexdir = os.path.dirname(os.path.abspath(first.output))
+    else:
+        indexdir = os.getcwd()
+    indexpath = os.path.join(indexdir, "%s_%s_%i.jobs" %(name, datetime.today().strftime("%Y%m%d%H%M%S"), os.getpid()))
+    n = 1
+    while os.path.isfile(indexpath):
+        indexpath = os.path.join(indexdir, "%s_%s_%i_%i.jobs" %(name, datetime.today().strftime("%Y%m%d%H%M%S"), os.getpid(), n))
+        n += 1
+
+    f = open(indexpath, 'w')
+    for pack in packs:
+        tasks = []
+        for job in pack:
+            task = {"cmd": job.commandLine()}
+            if job.output:
+                task["output"] = job.output
+            if job.cost_key is not None and job.units is not None:
+                task["key"] = job.cost_key
+                task["units"] = job.units
+            tasks.append(task)
+        f.write(json.dumps(tasks) + "\n")
+    f.close()
+    return indexpath
+
+
+def getArrayIndex():
+    """
+    Return the array task index of the current job, or None if it is not an array task
+    """
+
+    for var in ARRAY_INDEX_VARS:
+        val = os.environ.get(var)
+        if val:
+            return int(val)
+    return None
+
+
+def runArrayTasks(indexpath, first, last, timings=None, guard=None):
+    """
+    Run the jobs on lines first to last (0-based, inclusive) of an index file in turn.  Returns the number that
+    failed, the number that ran, and the jobs left over as a list of index lines (lists of jobs).  If a timings
+    file is given, the run time of each successful job with a cost key is appended to it.
+
+    With a resources.WalltimeGuard, a job whose calibrated estimate exceeds the walltime left is not started,
+    and a job still running when the guard expires is stopped and its partial output removed.  These jobs and
+    the ones after them are left over (see resubmitTasks).
+    """
+
+    f = open(indexpath, 'r')
+    lines = [line for line in f]
+    f.close()
+
+    tasks = []
+    for i in range(first, min(last, len(lines) - 1) + 1):
+        tasks.extend([(i, task) for task in json.loads(lines[i])])
+
+    costs = packing.CostModel(timings) if guard is not None and guard.deadline is not None else None
+
+    failed = 0
+    for n, (i, task) in enumerate(tasks):
+        if guard is not None:
+            remaining = guard.remaining()
+            estimate = None
+            if costs is not None and task.get("key") in costs.coeffs:
+                estimate = costs.estimate(task["key"], task["units"])
+            if guard.expired or (estimate is not None and estimate > remaining):
+                logger.warning("Not enough walltime left to run the remaining %i jobs" %(len(tasks) - n))
+                return failed, n, groupTasks(tasks[n:])
+
+        logger.info("Running task %i of %s: %s" %(i,indexpath,task["cmd"]))
+        cmd = '"%s" %s' %(sys.executable,task["cmd"])
+        start = datetime.today()
+        p = startProcess(cmd)
+        try:
+            rc = guard.run(waitForProcess, p) if guard is not None else p.wait()
+        except resources.WalltimeExpired:
+            logger.warning("Walltime is running out, stopped task %i: %s" %(i,task["cmd"]))
+            removePartialOutput(task.get("output"))
+            logger.warning("%i jobs were not finished" %(len(tasks) - n))
+            return failed, n, groupTasks(tasks[n:])
+        elapsed = datetime.today() - start
+        if rc != 0:
+            failed += 1
+            logger.error("Task %i failed (return code %i): %s" %(i,rc,task["cmd"]))
+        elif timings and "key" in task:
+            packing.recordTiming(timings, task["key"], task["units"], getSeconds(elapsed))
+
+    return failed, len(tasks), []
+
+
+def groupTasks(tasks):
+    #### (line, job) pairs back to lists of jobs by index line
+    lines = []
+    for n, (i, task) in enumerate(tasks):
+        if n == 0 or i != tasks[n-1][0]:
+            lines.append([])
+        lines[-1].append(task)
+    return lines
+
+
+def resubmitTasks(sched, name, lines):
+    """
+    Submit index lines of jobs (as returned by runArrayTasks) as a new job array through a cluster scheduler
+    and return the number of jobs that were not submitted
+    """
+
+    packs = [[JobSpec(name, task["cmd"], output=task.get("output"), cost_key=task.get("key"), units=task.get("units"))
+              for task in line] for line in lines]
+    failed = sched.submitArray(packs)
+    if failed == 0:
+        logger.info("Resubmitted %i unfinished jobs" %countJobs(packs))
+    return failed
+
+
+def startProcess(cmd, **kwargs):
+    """
+    Start a shell command for waitForProcess.  On POSIX it gets its own process group, so the shell and the
+    processes it starts can be stopped together.
+    """
+
+    if hasattr(os, "setpgrp"):
+        kwargs["preexec_fn"] = os.setpgrp
+    return Popen(cmd, shell=True, **kwargs)
+
+
+def waitForProcess(p):
+    """
+    Wait for a process from startProcess and return its exit code.  If the wait is interrupted (by
+    WalltimeExpired or KeyboardInterrupt), the process group is sent SIGTERM before the exception is passed
+    on, giving the job a chance to clean up.
+    """
+
+    try:
+        return p.wait()
+    except BaseException:
+        if p.poll() is None:
+            if hasattr(os, "killpg"):
+                try:
+                    os.killpg(p.pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            else:
+                p.terminate()
+            p.wait()
+        raise
+
+
+def removePartialOutput(path):
+    """
+    Remove the output of a job that was stopped before it finished
+    """
+
+    if path and os.path.isfile(path):
+        logger.info("Removing partial output %s" %path)
+        try:
+            os.remove(path)
+        except OSError, e:
+            logger.error("Cannot remove %s: %s" %(path,e))
+
+
+def getSeconds(td):
+    return td.days * 86400 + td.seconds + td.microseconds / 1e6
+
+
+def runSubmitCommand(cmd, job, env=None):
+    """
+    Run a cluster submit command and return the job id it prints, or None if submission failed.  Raises
+    SubmitError if the command cannot be run.
+    """
+
+    logger.debug(" ".join(cmd))
+    try:
+        p = Popen(cmd, stdout=PIPE, stderr=STDOUT, env=env)
+    except OSError, e:
+        raise SubmitError("Cannot run %s: %s" %(cmd[0],e))
+    (so, se) = p.communicate()
+    if p.returncode != 0:
+        logger.error("Submission of job %s failed (return code %i): %s" %(job.name,p.returncode,so.strip()))
+        return None
+    jobid = so.strip().split()[-1] if so.strip() else None
+    logger.debug("Submitted job %s: %s" %(job.name,jobid))
+    return jobid
+
+
+class LocalScheduler(Scheduler):
+    """
+    Run jobs on this machine.  Submitted jobs are queued and run by wait() in a pool of subprocesses.  The
+    pool size defaults to the available cores, limited by the available memory if job_memory (bytes per
+    job) is given, and the cores are shared among the processes through PGC_NUM_THREADS.
+    """
+
+    name = "local"
+
+    def __init__(self, processes=None, job_memory=None, timings=None):
+        Scheduler.__init__(self)
+        self.processes = processes
+        self.job_memory = job_memory
+        self.timings = timings
+        self.queue = []
+
+
+    def submit(self, job):
+        self.queue.append(job)
+        return None
+
+
+    def wait(self):
+        jobs, self.queue = self.queue, []
+        if len(jobs) == 0:
+            return 0
+
+        cpus = resources.getAvailableCpus()
+        processes = getLocalProcesses(len(jobs), self.processes, self.job_memory)
+        threads = str(max(1, cpus / processes))
+
+        logger.info("Running %i jobs with %i local processes" %(len(jobs),processes))
+
+        done = 0
+        failed = 0
+        pool = ThreadPool(processes)
+        try:
+            for job, rc, elapsed in pool.imap_unordered(runLocalJob, [(job, threads) for job in jobs]):
+                done += 1
+                if rc == 0 and (job.output is None or os.path.isfile(job.output)):
+                    logger.info("Job %i of %i finished in %s: %s" %(done,len(jobs),elapsed,job.name))
+                    if self.timings and job.cost_key is not None and job.units is not None:
+                        packing.recordTiming(self.timings, job.cost_key, job.units, getSeconds(elapsed))
+                else:
+                    failed += 1
+                    logger.error("Job %i of %i failed (return code %i): %s" %(done,len(jobs),rc,job.name))
+            pool.close()
+        finally:
+            pool.join()
+
+        return failed
+
+
+def getLocalProcesses(num_jobs, processes=None, job_memory=None):
+    """
+    Return the local pool size for num_jobs jobs
+    """
+
+    if processes is None:
+        processes = resources.getAvailableCpus()
+        if job_memory:
+            mem = resources.getAvailableMemory()
+            if mem is not None:
+                processes = min(processes, max(1, int(mem // job_memory)))
+    return max(1, min(processes, num_jobs))
+
+
+def runLocalJob(task):
+    job, threads = task
+
+    env = dict(os.environ)
+    env.update(job.env)
+    env[resources.THREADS_ENV] = threads
+    cmd = '"%s" %s' %(sys.executable,job.commandLine())
+    logger.debug(cmd)
+
+    start = datetime.today()
+    f = open(job.log, 'w') if job.log else None
+    try:
+        p = Popen(cmd, shell=True, stdout=f, stderr=STDOUT if f else None, env=env)
+        rc = p.wait()
+    finally:
+        if f:
+            f.close()
+
+    return job, rc, datetime.today() - start
+
+
+class QueueScheduler(Scheduler):
+    """
+    Add jobs to a job queue and start pgc_worker.py jobs with another backend to run them.  The number of
+    workers defaults to the local pool size for the local backend and to one per JOBS_PER_WORKER pending jobs
+    on a cluster.  Workers are told the requested walltime so they stop taking jobs before it runs out.
+
+    With the local backend wait() returns once the workers exit, counting the jobs that failed or were left
+    unfinished in the queue.  Cluster workers run after wait() returns, which counts rejected submissions.
+    """
+
+    name = "queue"
+
+    def __init__(self, queue_path, backend, workers=None, timings=None):
+        Scheduler.__init__(self)
+        self.queue_path = queue_path
+        self.backend = backend
+        self.workers = workers
+        self.timings = timings
+        self.jobs = []
+
+
+    def submit(self, job):
+        self.jobs.append(job)
+        return None
+
+
+    def wait(self):
+        jobs, self.jobs = self.jobs, []
+        if len(jobs) == 0:
+            return 0
+
+        queue = job_queue.JobQueue(self.queue_path)
+        failed_before = queue.counts().get(job_queue.FAILED, 0)
+        added = queue.add(jobs)
+        pending = queue.counts().get(job_queue.PENDING, 0)
+        logger.info("Added %i jobs to queue %s (%i pending)" %(added,self.queue_path,pending))
+        if pending == 0:
+            queue.close()
+            return 0
+
+        workers = self.workers
+        if workers is None:
+            if isinstance(self.backend, LocalScheduler):
+                workers = getLocalProcesses(pending, self.backend.processes, self.backend.job_memory)
+            else:
+                workers = int(math.ceil(pending / float(JOBS_PER_WORKER)))
+        workers = max(1, min(workers, pending))
+
+        args = [self.queue_path]
+        if self.timings:
+            args.append("--timings %s" %self.timings)
+        if self.backend.resources.walltime is not None:
+            args.append("--walltime %s" %formatWalltime(self.backend.resources.walltime))
+
+        logbase = os.path.splitext(self.queue_path)[0]
+        for k in range(workers):
+            self.backend.submit(JobSpec("Worker%04i" %k, WORKER_SCRIPT, args, log="%s_worker%04i.log" %(logbase,k)))
+        failed = self.backend.wait()
+
+        if isinstance(self.backend, LocalScheduler):
+            counts = queue.counts()
+            unfinished = counts.get(job_queue.PENDING, 0) + counts.get(job_queue.RUNNING, 0)
+            failed = counts.get(job_queue.FAILED, 0) - failed_before + unfinished
+            logger.info("Queue %s: %i jobs done, %i failed, %i unfinished" %(
+                self.queue_path,counts.get(job_queue.DONE, 0),counts.get(job_queue.FAILED, 0),unfinished))
+        queue.close()
+        return failed
+
+
+class DryRunScheduler(Scheduler):
+    """
+    Log the jobs that would be submitted without running them
+    """
+
+    name = "dryrun"
+
+    def __init__(self):
+        Scheduler.__init__(self)
+        self.count = 0
+
+
+    def submit(self, job):
+        self.count += 1
+        logger.info("Job %i (%s): %s" %(self.count,job.name,job.commandLine()))
+        return None
+
+
+def addSchedulerArguments(parser):
+    """
+    Add the scheduler options to an argument parser
+    """
+
+    parser.add_argument("--scheduler", choices=SCHEDULERS, default="pbs",
+                        help="run jobs with PBS (qsub), SLURM (sbatch), a local process pool, or only log them (dryrun) (default=pbs)")
+    parser.add_argument("--processes", type=int,
+                        help="number of jobs to run at once with --scheduler local (default is set by the available cores and memory)")
+    parser.add_argument("--array_size", type=int, default=ARRAY_SIZE,
+                        help="maximum tasks per job array with --scheduler pbs or slurm, 0 to submit one job per item (default=%i)" %ARRAY_SIZE)
+    parser.add_argument("--batch_size", type=int, default=BATCH_SIZE,
+                        help="items per job if a job array cannot be submitted (default=%i)" %BATCH_SIZE)
+    parser.add_argument("--pack_walltime",
+                        help="pack items into cluster jobs of about this estimated run time ([[HH:]MM:]SS) instead of one item per job")
+    parser.add_argument("--timings",
+                        help="file of job run times: calibrates the cost estimates of --pack_walltime and is appended to by the jobs")
+    parser.add_argument("--queue",
+                        help="add the jobs to this job queue (SQLite) and run them with pgc_worker.py jobs instead of one job per item")
+    parser.add_argument("--workers", type=int,
+                        help="number of worker jobs to start with --queue (default is set by the number of jobs and the scheduler)")
+
+
+def getScheduler(name, submit_script=None, pbs_resources=None, processes=None, job_memory=None,
+                 array_size=ARRAY_SIZE, batch_size=BATCH_SIZE, pack_walltime=None, timings=None,
+                 queue_path=None, workers=None):
+    """
+    Return a scheduler backend by name.  pbs_resources is the default resource request in PBS -l syntax and
+    pack_walltime a walltime string.  If queue_path is given the backend is used to start workers for a job
+    queue (except for a dry run).  Raises ValueError for an unknown scheduler or invalid settings.
+    """
+
+    res = Resources.fromPbs(pbs_resources)
+    if array_size is not None and array_size < 0:
+        raise ValueError("--array_size must not be negative")
+    if batch_size is not None and batch_size < 1:
+        raise ValueError("--batch_size must be at least 1")
+    if pack_walltime is not None:
+        pack_walltime = resources.parseWalltime(pack_walltime)
+        if pack_walltime <= 0:
+            raise ValueError("--pack_walltime must be positive")
+        if res.walltime is not None and pack_walltime > res.walltime:
+            raise ValueError("--pack_walltime is longer than the requested walltime")
+    if timings is not None:
+        timings = os.path.abspath(timings)
+    if workers is not None and workers < 1:
+        raise ValueError("--workers must be at least 1")
+
+    if name == "pbs":
+        sched = PbsScheduler(submit_script, res, array_size, batch_size, pack_walltime, timings)
+    elif name == "slurm":
+        sched = SlurmScheduler(submit_script, res, array_size, batch_size, pack_walltime, timings)
+    elif name == "local":
+        if processes is not None and processes < 1:
+            raise ValueError("--processes must be at least 1")
+        sched = LocalScheduler(processes, job_memory, timings)
+    elif name == "dryrun":
+        return DryRunScheduler()
+    else:
+        raise ValueError("Unknown scheduler: %s" %name)
+
+    if queue_path is not None:
+        return QueueScheduler(os.path.abspath(queue_path), sched, workers, timings)
+    return sched
+
+
+def getSchedulerFromArgs(args, submit_script=None, job_memory=None):
+    """
+    Return the scheduler selected by the options of addSchedulerArguments and the -l option of a script
+    """
+
+    return getScheduler(args.scheduler, submit_script, getattr(args, "l", None), args.processes, job_memory,
+                        args.array_size, args.batch_size, args.pack_walltime, args.timings,
+                        args.queue, args.workers)
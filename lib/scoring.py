@@ -0,0 +1,202 @@
+"""
+Batch image suitability scoring for the mosaic scripts.  Scene attributes (cloud cover, sun elevation,
+off-nadir angle, acquisition time, TDI) of many images are held in arrays and scored in one vectorised call,
+which returns the scores together with the per-factor components and the reasons images were rejected.
+"""
+
+import numpy
+
+#### Factor weights.  "default" is used without a target day, "tday" when a target day is given.
+WEIGHT_SETS = {
+    "default": {"cc":48, "sunel":28, "ona":24, "datediff":0},
+    "tday": {"cc":30, "sunel":10, "ona":5, "datediff":55},
+}
+FACTORS = ["cc","sunel","ona","datediff"]
+
+#### Exposure (tdi * sun elevation) thresholds by sensor for pan and multispectral mosaics
+PAN_EXPOSURE_THRESHOLDS = {
+    "WV01":1400,
+    "WV02":1400,
+    "QB02":500,
+}
+MULTI_EXPOSURE_THRESHOLDS = {
+    "WV02":400,
+    "GE01":170,
+    "QB02":25,
+}
+
+#### Cloud cover limit and the value substituted for nonsense or nodata cloud cover
+MAX_CLOUDCOVER = 0.5
+NODATA_CLOUDCOVER = 0.5
+
+#### Days from the target day at which the date factor reaches zero
+DATEDIFF_RANGE = 183.0
+
+#### Rejection reason flags
+REJECT_MISSING = 1
+REJECT_OVEREXPOSED = 2
+REJECT_CLOUDY = 4
+
+US_PER_DAY = 86400 * 1000000
+
+
+class SceneArrays(object):
+    """
+    Scoring attributes of N scenes.  Numeric attributes are float arrays (NaN if unknown), date is a
+    datetime64[us] array, and missing is True for scenes lacking any required value.
+    """
+
+    def __init__(self, attribs, sensors, bands):
+        """
+        attribs: list of dicts with cc, sunel, ona, date (first line time string) and tdi
+        sensors: list of sensor names
+        bands: list of image band counts
+        """
+
+        n = len(attribs)
+        self.cc = numpy.array([_toFloat(a["cc"]) for a in attribs], dtype=numpy.float64).reshape(n)
+        self.sunel = numpy.array([_toFloat(a["sunel"]) for a in attribs], dtype=numpy.float64).reshape(n)
+        self.ona = numpy.array([_toFloat(a["ona"]) for a in attribs], dtype=numpy.float64).reshape(n)
+        self.tdi = numpy.array([_toFloat(a["tdi"]) for a in attribs], dtype=numpy.float64).reshape(n)
+        self.date, bad_dates = parseDates([a["date"] for a in attribs])
+        self.sensors = list(sensors)
+        self.bands = numpy.array(bands, dtype=numpy.int32).reshape(n)
+        self.missing = numpy.array([any(a[k] is None for k in ("cc","sunel","ona","date","tdi")) for a in attribs],
+                                   dtype=bool).reshape(n)
+        self.missing |= numpy.isnan(self.cc) | numpy.isnan(self.sunel) | numpy.isnan(self.ona) | numpy.isnan(self.tdi)
+        self.missing |= bad_dates
+
+
+    def __len__(self):
+        return len(self.sensors)
+
+
+def _toFloat(val):
+    if val is None:
+        return numpy.nan
+    try:
+        return float(val)
+    except ValueError:
+        return numpy.nan
+
+
+def parseDates(datestrs):
+    """
+    Convert first line time strings (2012-01-06T22:17:48.123456Z) to a datetime64[us] array.  Missing or
+    unparsable values become the epoch.  Returns the dates and a bool array that is True where a value could
+    not be parsed, which SceneArrays flags as missing.
+    """
+
+    vals = []
+    failed = []
+    for s in datestrs:
+        if s:
+            s = s.rstrip("Z")
+            try:
+                vals.append(numpy.datetime64(s, "us"))
+                failed.append(False)
+                continue
+            except ValueError:
+                pass
+        vals.append(numpy.datetime64(0, "us"))
+        failed.append(True)
+    n = len(vals)
+    return numpy.array(vals, dtype="datetime64[us]").reshape(n), numpy.array(failed, dtype=bool).reshape(n)
+
+
+def getDateDiff(dates, m, d):
+    """
+    Return the number of days between each date and the nearest occurrence of month m, day d
+    """
+
+    years = dates.astype("datetime64[Y]")
+    diffs = []
+    for offset in (-1, 0, 1):
+        target = (years + offset).astype("datetime64[M]") + (m - 1)
+        target = (target.astype("datetime64[D]") + (d - 1)).astype("datetime64[us]")
+        #### whole days, rounded down as timedelta.days does
+        days = (target - dates).astype(numpy.int64) // US_PER_DAY
+        diffs.append(numpy.abs(days))
+    return numpy.min(diffs, axis=0)
+
+
+def getWeights(params, m=None):
+    """
+    Return the weight dict for a set of mosaic parameters.  params.score_weights, if set, overrides the
+    built-in weight sets.
+    """
+
+    weights = getattr(params, "score_weights", None)
+    if weights is not None:
+        return weights
+    if m is None:
+        m = params.m
+    return WEIGHT_SETS["tday" if m != 0 else "default"]
+
+
+def scoreScenes(scenes, params, m=None, d=None):
+    """
+    Score a SceneArrays object.  The target day is taken from params unless m and d are given, so the same
+    scenes can be re-ranked for several target days.
+
+    Returns a dict of arrays:
+        score:     suitability score, -1 for rejected scenes
+        reject:    bit flags of REJECT_MISSING, REJECT_OVEREXPOSED and REJECT_CLOUDY
+        cc:        cloud cover with nodata values replaced
+        datediff:  days from the target day (-9999 with no target day)
+        exfact:    exposure factor (tdi * sun elevation)
+        panfact:   pan image factor
+        <factor>_score for each of FACTORS:  weighted factor components before the pan factor
+    """
+
+    if m is None:
+        m = params.m
+        d = params.d
+    weights = getWeights(params, m)
+    n = len(scenes)
+
+    #### Pan images in a multispectral mosaic are down-weighted
+    panfact = numpy.ones(n)
+    if params.force_pan_to_multi is True:
+        panfact[scenes.bands == 1] = 0.5
+
+    if m != 0:
+        datediff = getDateDiff(scenes.date, m, d).astype(numpy.float64)
+    else:
+        datediff = numpy.empty(n)
+        datediff.fill(-9999)
+
+    #### Unknown values are NaN and compare False; they are rejected as missing
+    errstate = numpy.seterr(invalid="ignore")
+    reject = numpy.where(scenes.missing, REJECT_MISSING, 0).astype(numpy.int32)
+
+    #### Remove images with high exposure settings (tdi_pan (or tdi_grn) * sunel)
+    exfact = scenes.tdi * scenes.sunel
+    if params.useExposure is True:
+        thresholds = PAN_EXPOSURE_THRESHOLDS if params.bands == 1 else MULTI_EXPOSURE_THRESHOLDS
+        limits = numpy.array([thresholds.get(s, numpy.inf) for s in scenes.sensors], dtype=numpy.float64).reshape(n)
+        reject |= numpy.where(exfact > limits, REJECT_OVEREXPOSED, 0).astype(numpy.int32)
+
+    #### Handle nonesense or nodata cloud cover values
+    cc = numpy.where((scenes.cc < 0) | (scenes.cc > 1), NODATA_CLOUDCOVER, scenes.cc)
+    reject |= numpy.where(cc > MAX_CLOUDCOVER, REJECT_CLOUDY, 0).astype(numpy.int32)
+
+    result = {
+        "cc_score": weights["cc"] * (1 - cc),
+        "sunel_score": weights["sunel"] * (scenes.sunel / 90),
+        "ona_score": weights["ona"] * ((90 - scenes.ona) / 90.0),
+        "datediff_score": weights["datediff"] * ((DATEDIFF_RANGE - datediff) / DATEDIFF_RANGE) if m != 0 else numpy.zeros(n),
+    }
+    rawscore = result["cc_score"] + result["sunel_score"] + result["ona_score"] + result["datediff_score"]
+    score = numpy.where(reject == 0, rawscore * panfact, -1)
+    numpy.seterr(**errstate)
+
+    result.update({
+        "score": score,
+        "reject": reject,
+        "cc": cc,
+        "datediff": datediff,
+        "exfact": exfact,
+        "panfact": panfact,
+    })
+    return result
@@ -0,0 +1,79 @@
+import os, sys, logging, argparse
+
+from lib import scheduler, resources
+
+#### Create Loggers
+logger = logging.getLogger("logger")
+logger.setLevel(logging.DEBUG)
+
+
+def main():
+
+    #### Set Up Arguments
+    parser = argparse.ArgumentParser(
+        description="Run the tasks of a job array (or a batch of them) from an index file written by the parallel scripts"
+        )
+
+    parser.add_argument("index", help="index file of job command lines, one per line")
+    parser.add_argument("--first", type=int,
+                        help="first line to run, counting from 0 (default is the array index of this job)")
+    parser.add_argument("--last", type=int,
+                        help="last line to run (default is --first)")
+    parser.add_argument("--timings",
+                        help="file to append the run time of each job to")
+    parser.add_argument("--grace", type=int, default=resources.WALLTIME_GRACE,
+                        help="stop the running job this many seconds before the walltime of the cluster job runs out (default=%i)" %resources.WALLTIME_GRACE)
+    parser.add_argument("--resubmit", choices=["pbs","slurm"],
+                        help="submit the jobs left unfinished at the walltime as a new job array with this scheduler")
+    parser.add_argument("--qsubscript",
+                        help="submit script for --resubmit")
+    parser.add_argument("-l",
+                        help="PBS resources requested for --resubmit")
+    parser.add_argument("--name", default="Resubmit",
+                        help="job name for --resubmit (default=Resubmit)")
+
+    #### Parse Arguments
+    args = parser.parse_args()
+    index = os.path.abspath(args.index)
+
+    if not os.path.isfile(index):
+        parser.error("Index file does not exist: %s" %index)
+
+    first = args.first
+    if first is None:
+        first = scheduler.getArrayIndex()
+        if first is None:
+            parser.error("--first is required outside of a job array")
+    last = args.last if args.last is not None else first
+
+    #### Set Up Logging Handlers
+    lso = logging.StreamHandler()
+    lso.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s- %(message)s','%m-%d-%Y %H:%M:%S')
+    lso.setFormatter(formatter)
+    logger.addHandler(lso)
+
+    #### Stop short of the walltime so the running job can clean up before it is killed
+    guard = resources.WalltimeGuard(resources.getWalltimeRemaining(), args.grace)
+
+    failed, ran, leftover = scheduler.runArrayTasks(index,first,last,args.timings,guard)
+
+    #### Resubmit unfinished jobs, unless none ran (a new job would not get further)
+    if len(leftover) > 0:
+        unfinished = sum(len(line) for line in leftover)
+        if args.resubmit is not None and args.qsubscript is not None and ran > 0:
+            sched = scheduler.getScheduler(args.resubmit, args.qsubscript, args.l, timings=args.timings)
+            unfinished = scheduler.resubmitTasks(sched, args.name, leftover)
+        elif args.resubmit is not None:
+            logger.error("No job finished within the walltime, not resubmitting")
+        if unfinished > 0:
+            logger.error("%i jobs were not finished or resubmitted.  Rerun the parallel script to run them" %unfinished)
+            if failed == 0:
+                sys.exit(scheduler.UNFINISHED_EXIT_CODE)
+
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
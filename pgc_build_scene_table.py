@@ -0,0 +1,87 @@
+import os, sys, logging, argparse
+from datetime import datetime
+
+from lib import metadata, scene_table, resources
+
+#### Create Loggers
+logger = logging.getLogger("logger")
+logger.setLevel(logging.DEBUG)
+
+#### Image extensions whose metadata sidecars are indexed
+exts = ['.ntf','.tif']
+
+
+def main():
+
+    #### Set Up Arguments
+    parser = argparse.ArgumentParser(
+        description="Build or update a table of scene metadata for an image archive"
+        )
+
+    parser.add_argument("src", help="source image directory or text file of image paths")
+    parser.add_argument("table", help="scene table (SQLite) to create or update")
+    parser.add_argument("--threads", type=int, default=resources.getAvailableCpus(),
+                        help="number of threads reading metadata files (default is the number of available cores)")
+    parser.add_argument("--prune", action="store_true", default=False,
+                        help="remove rows for metadata files that no longer exist")
+    parser.add_argument("--log", help="file to log progress (default is to write to stdout only)")
+
+    #### Parse Arguments
+    args = parser.parse_args()
+    src = os.path.abspath(args.src)
+    table = os.path.abspath(args.table)
+
+    if not os.path.isdir(src) and not (os.path.isfile(src) and os.path.splitext(src)[1].lower() == '.txt'):
+        parser.error("Source is not a directory or text file: %s" %src)
+
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+
+    #### Set Up Logging Handlers
+    lso = logging.StreamHandler()
+    lso.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s- %(message)s','%m-%d-%Y %H:%M:%S')
+    lso.setFormatter(formatter)
+    logger.addHandler(lso)
+
+    if args.log is not None:
+        lfh = logging.FileHandler(args.log)
+        lfh.setLevel(logging.DEBUG)
+        lfh.setFormatter(formatter)
+        logger.addHandler(lfh)
+
+    #### Find images
+    image_list = []
+    if os.path.isdir(src):
+        for root,dirs,files in os.walk(src):
+            for f in files:
+                if os.path.splitext(f)[1].lower() in exts:
+                    image_list.append(os.path.join(root,f))
+    else:
+        t = open(src,'r')
+        for line in t.readlines():
+            image_list.append(line.rstrip())
+        t.close()
+
+    #### Find metadata sidecars
+    metapaths = set()
+    for image in image_list:
+        metapath = metadata.getMetadataPath(image)
+        if metapath is not None:
+            metapaths.add(metapath)
+        else:
+            logger.warning("No metadata file found for %s" %image)
+
+    logger.info("Images found: %i, metadata files: %i" %(len(image_list),len(metapaths)))
+
+    starttime = datetime.today()
+    updated, unchanged, failed = scene_table.buildSceneTable(table,sorted(metapaths),args.threads,args.prune)
+    logger.info("Scenes updated: %i, unchanged: %i, failed: %i" %(updated,unchanged,failed))
+    logger.info("Total Processing Time: %s" %(datetime.today() - starttime))
+
+    if failed > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,7 @@ from math import *
 from xml.etree import cElementTree as ET
 
 from lib.mosaic import *
+from lib import footprint_cache
 import gdal, ogr,osr,gdalconst
 
 logger = logging.getLogger("logger")
@@ -24,7 +25,7 @@ def main():
 	)
     
     parser.add_argument("shp", help="output shapefile name")
-    parser.add_argument("src", help="textfile or directory of input rasters (tif only)")
+    parser.add_argument("src", help="textfile of input rasters (tif only) or tile intersects json file")
     
     parser.add_argument("--cutline_step", type=int, default=2,
                        help="cutline calculator pixel skip interval (default=2)")
@@ -74,13 +75,11 @@ def main():
     else:
     
         intersects = []
-        t = open(inpath,'r')
-        for line in t.readlines():
-            if os.path.isfile(line.rstrip('\n').rstrip('\r')):
-                intersects.append(line.rstrip('\n').rstrip('\r'))
+        for image in readIntersectsFile(inpath):
+            if os.path.isfile(image):
+                intersects.append(image)
             else:
-                logger.warning("Imagepath in intersects textfile does not exist: %s" %line.rstrip('\n').rstrip('\r'))
-        t.close()
+                logger.warning("Imagepath in intersects file does not exist: %s" %image)
         
         if len(intersects) == 0:
             logger.error("No images found: %s" %inpath)
@@ -91,7 +90,8 @@ def main():
         
         #### gather image info list
         logger.info("Gathering image info")
-        imginfo_list = [ImageInfo(image,"warped",logger) for image in intersects]
+        cache = footprint_cache.openFootprintCache(args.footprint_cache)
+        imginfo_list = buildImageInfoList(intersects,"warped",logger,cache)
         
         #### Get mosaic parameters
         logger.info("Getting mosaic parameters")
@@ -105,8 +105,11 @@ def main():
         
         imginfo_list2 =[]
         for iinfo in imginfo_list:
-            simplify_tolerance = 2.0 * ((params.xres + params.yres) / 2.0) ## 2 * avg(xres, yres), should be 1 for panchromatic mosaics where res = 0.5m
-            geom,xs1,ys1 = GetExactTrimmedGeom(iinfo.srcfp,step=args.cutline_step,tolerance=simplify_tolerance)
+            simplify_tolerance = getFootprintTolerance(params)
+            if args.footprint_mode == "polygonize":
+                geom,xs1,ys1 = GetPolygonizedGeom(iinfo.srcfp,tolerance=simplify_tolerance,overview=args.footprint_overview)
+            else:
+                geom,xs1,ys1 = GetExactTrimmedGeom(iinfo.srcfp,step=args.cutline_step,tolerance=simplify_tolerance,cache=cache,overview=args.footprint_overview)
                 
             if geom is None:
                 logger.info("%s: geometry could not be determined" %iinfo.srcfn)
@@ -119,9 +122,12 @@ def main():
                 centroid = geom.Centroid()
                 logger.info("%s: geometry acquired - centroid: %f, %f" %(iinfo.srcfn, centroid.GetX(), centroid.GetY()))
         
+        if cache is not None:
+            cache.close()
+        
         logger.info("Calculating image scores")
+        scoreImages(imginfo_list2,params,logger)
         for iinfo in imginfo_list2:
-            iinfo.score,iinfo.attribs = iinfo.getScore(params,logger)
             logger.info("%s: %s" %(iinfo.srcfn,iinfo.score))
                
         ####  Overlay geoms and remove non-contributors
@@ -131,35 +137,9 @@ def main():
         else:
             
             logger.info("Overlaying images to determine contributors")
-            contribs = []
-            
-            for i in xrange(0,len(imginfo_list2)):
-                iinfo = imginfo_list2[i]
-                basegeom = iinfo.geom
-            
-                for j in range(i+1,len(imginfo_list2)):
-                    iinfo2 = imginfo_list2[j]
-                    geom2 = iinfo2.geom
-                    
-                    if basegeom.Intersects(geom2):
-                        basegeom = basegeom.Difference(geom2)
-                        if basegeom is None or basegeom.IsEmpty():
-                            break
-                            
-                if basegeom is None:
-                    logger.info("Function Error: %s" %iinfo.srcfp)
-                elif basegeom.IsEmpty():
-                    logger.info("Removing non-contributing image: %s" %iinfo.srcfp)
-                else:
-                    basegeom = basegeom.Intersection(extent_geom)
-                    if basegeom is None:
-                        logger.info("Function Error: %s" %iinfo.srcfp)
-                    elif basegeom.IsEmpty():
-                        logger.info("Removing non-contributing image: %s" %iinfo.srcfp)
-                    else:
-                        contribs.append((iinfo,basegeom))
-                        tm = datetime.today()    
-                        logger.info("Image: %s" %(os.path.basename(image)))
+            contribs = overlayImages(imginfo_list2,extent_geom,logger)
+            for iinfo,geom in contribs:
+                logger.info("Image: %s" %(iinfo.srcfn))
         
         logger.info("Number of contributors: %d" %len(contribs))
         
@@ -168,7 +148,7 @@ def main():
    
         logger.info("Creating shapefile of image boundaries: %s" %shp)
     
-        fields = [("IMAGENAME", ogr.OFTString, 100),
+        fields = [("IMAGENAME", ogr.OFTString, 254),
             ("SENSOR", ogr.OFTString, 10),
             ("ACQDATE", ogr.OFTString, 10),
             ("CAT_ID", ogr.OFTString, 30),
@@ -184,16 +164,18 @@ def main():
             logger.info("OGR: Driver %s is not available" % OGR_DRIVER)
             sys.exit(-1)
         
-        if os.path.isfile(shp):
-            ogrDriver.DeleteDataSource(shp)
-        vds = ogrDriver.CreateDataSource(shp)
+        shpd, shpn = os.path.split(shp)
+        shpbn, shpe = os.path.splitext(shpn)
+        
+        #### Write under a temporary name so tile jobs never see a partial shapefile
+        tmp_shp = os.path.join(shpd,"%s_tmp%i%s" %(shpbn,os.getpid(),shpe))
+        if os.path.isfile(tmp_shp):
+            ogrDriver.DeleteDataSource(tmp_shp)
+        vds = ogrDriver.CreateDataSource(tmp_shp)
         if vds is None:
             logger.info("Could not create shp")
             sys.exit(-1)
         
-        shpd, shpn = os.path.split(shp)
-        shpbn, shpe = os.path.splitext(shpn)
-        
         rp = osr.SpatialReference()
         rp.ImportFromWkt(params.proj)
         
@@ -251,6 +233,14 @@ def main():
                 logger.info("Created feature for image: %s" %image)
                 
             feat.Destroy()
+        
+        #### Close the shapefile and move its parts into place, the .shp last
+        vds = None
+        tmp_base = os.path.splitext(tmp_shp)[0]
+        parts = glob.glob(tmp_base + ".*")
+        parts.sort(key=lambda part: os.path.splitext(part)[1].lower() == shpe.lower())
+        for part in parts:
+            os.rename(part, os.path.join(shpd, shpbn + os.path.splitext(part)[1]))
             
             
     etm = datetime.today()
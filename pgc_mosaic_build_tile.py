@@ -1,4 +1,4 @@
-import os, string, sys, shutil, glob, re, tarfile, logging
+import os, string, sys, shutil, glob, re, tarfile, logging, argparse
 from datetime import datetime, timedelta
 
 from subprocess import *
@@ -6,6 +6,7 @@ from math import *
 from xml.etree import cElementTree as ET
 
 from lib.mosaic import *
+from lib import resources
 
 import gdal, ogr,osr, gdalconst
     
@@ -17,42 +18,250 @@ import numpy
 
     
     
+#### Tile pixels composited per block (a multiple of the 256 pixel GTiff tiles)
+COMPOSITE_BLOCK_SIZE = 1024
+
+
+class TileSource(object):
+    """
+    A source image of a tile with its extent in tile pixel coordinates, optionally limited to a clip geometry
+    such as the image cutline.  The dataset is opened on first read.
+    """
+    
+    def __init__(self,path,extent,xres,yres,clip=None):
+        self.path = path
+        self.ds = None
+        self.extent = extent
+        self.xres = xres
+        self.yres = yres
+        
+        ds = gdal.Open(path)
+        self.gtf = ds.GetGeoTransform()
+        self.xsize = ds.RasterXSize
+        self.ysize = ds.RasterYSize
+        self.bands = ds.RasterCount
+        self.datatype = ds.GetRasterBand(1).DataType
+        self.proj = ds.GetProjectionRef()
+        ds = None
+        
+        #### Source extent in tile pixels, and source pixels per tile pixel
+        self.rx = xres / self.gtf[1]
+        self.ry = yres / -self.gtf[5]
+        self.x0 = (self.gtf[0] - extent[0]) / xres
+        self.y0 = (extent[3] - self.gtf[3]) / yres
+        self.x1 = self.x0 + self.xsize / self.rx
+        self.y1 = self.y0 + self.ysize / self.ry
+        
+        #### Limit reads to the tile pixels covering the envelope of a clip geometry.  The source extent is
+        #### kept as is since it places the image on the tile grid.
+        self.cx0, self.cy0, self.cx1, self.cy1 = self.x0, self.y0, self.x1, self.y1
+        if clip is not None:
+            cminx, cmaxx, cminy, cmaxy = clip.GetEnvelope()
+            self.cx0 = max(self.x0, floor((cminx - extent[0]) / xres))
+            self.cx1 = min(self.x1, ceil((cmaxx - extent[0]) / xres))
+            self.cy0 = max(self.y0, floor((extent[3] - cmaxy) / yres))
+            self.cy1 = min(self.y1, ceil((extent[3] - cminy) / yres))
+    
+    
+    def window(self,bx0,by0,bx1,by1):
+        
+        #### Tile pixels of a block whose centers fall inside the source
+        dx0 = max(bx0, int(ceil(self.cx0 - 0.5)))
+        dy0 = max(by0, int(ceil(self.cy0 - 0.5)))
+        dx1 = min(bx1, int(ceil(self.cx1 - 0.5)))
+        dy1 = min(by1, int(ceil(self.cy1 - 0.5)))
+        if dx0 >= dx1 or dy0 >= dy1:
+            return None
+        return dx0, dy0, dx1, dy1
+    
+    
+    def read(self,dx0,dy0,dx1,dy1):
+        
+        #### Read a window of tile pixels.  The source is warped (nearest) onto the tile grid in memory, as
+        #### gdalwarp would, so sources whose pixels do not line up with the tile are placed and scaled exactly.
+        if self.ds is None:
+            self.ds = gdal.Open(self.path)
+        
+        mem = gdal.GetDriverByName("MEM").Create("", dx1 - dx0, dy1 - dy0, self.bands, self.datatype)
+        mem.SetGeoTransform((self.extent[0] + dx0 * self.xres, self.xres, 0,
+                             self.extent[3] - dy0 * self.yres, 0, -self.yres))
+        mem.SetProjection(self.proj)
+        gdal.ReprojectImage(self.ds, mem, None, None, gdalconst.GRA_NearestNeighbour)
+        
+        data = mem.ReadAsArray()
+        mem = None
+        return data.reshape((-1, dy1 - dy0, dx1 - dx0))
+    
+    
+    def close(self):
+        self.ds = None
+
+
+def ReadCutlines(shp,tile_geom):
+    """
+    Return a dict of image name -> cutline geometry clipped to the tile, for the cutlines that intersect the
+    tile, or None if the shapefile cannot be read.
+    """
+    
+    ds = ogr.Open(shp)
+    if ds is None:
+        return None
+    
+    lyr = ds.GetLayer()
+    lyr.SetSpatialFilter(tile_geom)
+    
+    cutlines = {}
+    feat = lyr.GetNextFeature()
+    while feat:
+        geom = feat.GetGeometryRef()
+        if geom is not None:
+            geom = geom.Intersection(tile_geom)
+            if geom is not None and not geom.IsEmpty():
+                cutlines[feat.GetField("IMAGENAME")] = geom
+        feat = lyr.GetNextFeature()
+    
+    ds = None
+    return cutlines
+
+
+def WriteTile(sources,tile,extent,xres,yres,bands,gtiff_compression,threads,clips=None):
+    """
+    Composite sources into a compressed, tiled GTiff front to back.  sources are in score order (the last is
+    drawn on top), so each block of the tile is filled from the highest scoring source down; a source window
+    is read only while the block still has empty (nodata) pixels, and the block is done once it is full.
+    If clips is given, each source is read only within the envelope of its clip geometry.  Statistics and
+    overviews are then built in place.  Returns 0 on success.
+    """
+    
+    if gtiff_compression == 'lzw':
+        compress_options = ["COMPRESS=LZW"]
+    elif gtiff_compression == 'jpeg95':
+        compress_options = ["COMPRESS=JPEG","JPEG_QUALITY=95"]
+    creation_options = compress_options + ["PHOTOMETRIC=MINISBLACK","TILED=YES","BIGTIFF=IF_SAFER","NUM_THREADS=%d" %threads]
+    
+    gdal.SetConfigOption("GDAL_CACHEMAX","2048")
+    gdal.SetConfigOption("GDAL_NUM_THREADS",str(threads))
+    
+    #### Output grid, data type and projection
+    txsize = int(round((extent[2] - extent[0]) / xres))
+    tysize = int(round((extent[3] - extent[1]) / yres))
+    
+    ds = gdal.Open(sources[0])
+    datatype = ds.GetRasterBand(1).DataType
+    dtype = ds.GetRasterBand(1).ReadAsArray(0,0,1,1).dtype
+    proj = ds.GetProjectionRef()
+    ds = None
+    
+    ds = gdal.GetDriverByName("GTiff").Create(tile,txsize,tysize,bands,datatype,creation_options)
+    if ds is None:
+        print "Cannot create tile: %s" %gdal.GetLastErrorMsg()
+        return 1
+    ds.SetGeoTransform((extent[0],xres,0,extent[3],0,-yres))
+    ds.SetProjection(proj)
+    for i in range(1,bands+1):
+        ds.GetRasterBand(i).SetNoDataValue(0)
+    
+    #### Highest priority first
+    if clips is None:
+        clips = [None] * len(sources)
+    tsources = [TileSource(src,extent,xres,yres,clip) for src,clip in reversed(zip(sources,clips))]
+    reads = 0
+    
+    for by0 in xrange(0, tysize, COMPOSITE_BLOCK_SIZE):
+        by1 = min(tysize, by0 + COMPOSITE_BLOCK_SIZE)
+        for bx0 in xrange(0, txsize, COMPOSITE_BLOCK_SIZE):
+            bx1 = min(txsize, bx0 + COMPOSITE_BLOCK_SIZE)
+            
+            block = numpy.zeros((bands, by1 - by0, bx1 - bx0), dtype=dtype)
+            filled = numpy.zeros((by1 - by0, bx1 - bx0), dtype=bool)
+            empty = filled.size
+            
+            for src in tsources:
+                win = src.window(bx0,by0,bx1,by1)
+                if win is None:
+                    continue
+                dx0, dy0, dx1, dy1 = win
+                
+                #### Skip sources whose window is already filled
+                sub = filled[dy0-by0:dy1-by0, dx0-bx0:dx1-bx0]
+                if sub.all():
+                    continue
+                
+                data = src.read(dx0,dy0,dx1,dy1)
+                reads += 1
+                #### A 1 band source broadcasts to all bands
+                need = (data[:bands] != 0).any(axis=0) & ~sub
+                block[:, dy0-by0:dy1-by0, dx0-bx0:dx1-bx0][:, need] = data[:bands, need]
+                sub |= need
+                
+                empty -= need.sum()
+                if empty == 0:
+                    break
+            
+            for i in range(bands):
+                ds.GetRasterBand(i+1).WriteArray(block[i], bx0, by0)
+    
+    for src in tsources:
+        src.close()
+    print "Source windows read: %i" %reads
+    
+    for i in range(1,ds.RasterCount+1):
+        ds.GetRasterBand(i).ComputeStatistics(False)
+    ds.BuildOverviews("NEAREST",[2,4,8,16,30])
+    ds = None
+    
+    return 0
+
+    
 def main():
     
     status = 0
+    #### Set Up Arguments
+    parser = argparse.ArgumentParser(
+        description="Build one mosaic tile from the images that intersect it"
+        )
+    
+    parser.add_argument("bands", type=int, help="number of output bands")
+    parser.add_argument("src", help="textfile or tile intersects json file of input images, in score order")
+    parser.add_argument("tile", help="output tile")
+    parser.add_argument("force_pan_to_multi", type=int, choices=[0,1], help="use 1 band images in a multiband tile (0 or 1)")
+    parser.add_argument("ref_xres", help="output x resolution")
+    parser.add_argument("ref_yres", help="output y resolution")
+    parser.add_argument("minx", help="tile minimum x")
+    parser.add_argument("miny", help="tile minimum y")
+    parser.add_argument("maxx", help="tile maximum x")
+    parser.add_argument("maxy", help="tile maximum y")
+    parser.add_argument("gtiff_compression", help="GTiff compression type (lzw or jpeg95)")
+    parser.add_argument("--wd", default=localpath,
+                        help="local working directory (default is %s)" %localpath)
+    parser.add_argument("--cutlines",
+                        help="cutline shapefile from pgc_mosaic_build_cutlines.py.  Only the part of each image inside its cutline is read.  Images without a cutline in the tile are read in full")
+    
     #### Parse Arguments
-    if len(sys.argv) != 12:
-        print("incorrect number of arguments: 12 required, %i found \n%s" %(len(sys.argv),str(sys.argv)))
-        sys.exit(1)
-        
-    bands = int(sys.argv[1])
-    inpath = sys.argv[2]
-    tile = sys.argv[3]
-    force_pan_to_multi = bool(sys.argv[4])
-    ref_xres = sys.argv[5]
-    ref_yres = sys.argv[6]
-    minx = sys.argv[7]
-    miny = sys.argv[8]
-    maxx = sys.argv[9]
-    maxy = sys.argv[10]
-    gtiff_compression = sys.argv[11]
+    args = parser.parse_args()
+    bands = args.bands
+    inpath = args.src
+    tile = args.tile
+    force_pan_to_multi = bool(args.force_pan_to_multi)
+    ref_xres = args.ref_xres
+    ref_yres = args.ref_yres
+    minx = args.minx
+    miny = args.miny
+    maxx = args.maxx
+    maxy = args.maxy
+    gtiff_compression = args.gtiff_compression
     
     dims = "-tr %s %s -te %s %s %s %s" %(ref_xres,ref_yres,minx,miny,maxx,maxy)
     
-    intersects = []
-    t = open(inpath,'r')
-    for line in t.readlines():
-        intersects.append(line.rstrip('\n').rstrip('\r'))
-    t.close()
+    intersects = readIntersectsFile(inpath,tile)
     
     print (tile)
     #print (str(intersects))
     
-    wd = os.path.join(localpath,os.path.splitext(os.path.basename(tile))[0])
+    wd = os.path.join(args.wd,os.path.splitext(os.path.basename(tile))[0])
     if not os.path.isdir(wd):
         os.makedirs(wd)
     localtile2 = os.path.join(wd,os.path.basename(tile)) 
-    localtile1 = localtile2.replace(".tif","_temp.tif")
     
     del_images = []
     final_intersects = []
@@ -86,69 +295,64 @@ def main():
     poly_wkt = 'POLYGON (( %s %s, %s %s, %s %s, %s %s, %s %s ))' %(minx,miny,minx,maxy,maxx,maxy,maxx,miny,minx,miny)
     tile_geom = ogr.CreateGeometryFromWkt(poly_wkt)
     
+    #### Visible part of each image in the tile
+    cutlines = None
+    if args.cutlines is not None:
+        cutlines = ReadCutlines(args.cutlines,tile_geom)
+        if cutlines is None:
+            print "Cannot read cutlines, reading whole images: %s" %args.cutlines
+        else:
+            clipped = [image for image in final_intersects if os.path.basename(image) in cutlines]
+            print "Images with a cutline in the tile: %i of %i" %(len(clipped),len(final_intersects))
+            for image in final_intersects:
+                if os.path.basename(image) not in cutlines:
+                    print "No cutline for image in the tile, reading the whole image: %s" %image
     
     
-    c = 0
-    for img in final_intersects:
-            
-        #### Check if bands number is correct
-        mergefile = img
-        
-        if force_pan_to_multi is True and bands > 1:
-            srcbands = images[img]
-            if srcbands == 1:
-                tm = datetime.today()
-                print tm.strftime("%d-%b-%Y %H:%M:%S"),
-                mergefile = os.path.join(wd,os.path.basename(img)[:-4])+"_merge.tif"
-                cmd = 'gdal_merge.py -ps %s %s -separate -o "%s" "%s"' %(xsize, ysize, mergefile, string.join(([img] * bands),'" "'))
-                ExecCmd(cmd)
-        srcnodata = string.join((['0'] * bands)," ")
-        
-        tm = datetime.today()
-        print tm.strftime("%d-%b-%Y %H:%M:%S"),
     
-        if c == 0:
-            if os.path.isfile(localtile1):
-                print "localtile1 already exists.  Run this again later when there is no conflicting job on this node"
-                status = 1
-                break
-            cmd = 'gdalwarp %s -srcnodata "%s" -dstnodata "%s" "%s" "%s"' %(dims,srcnodata,srcnodata,mergefile,localtile1)
-            ExecCmd(cmd)
-            
+    #### Use all the cores allocated to the job
+    threads = resources.getAvailableCpus()
+    print "Threads: %i" %threads
+    
+    if os.path.isfile(localtile2):
+        print "localtile2 already exists.  Run this again later when there is no conflicting job on this node"
+        status = 1
+    
+    #### Check if bands number is correct.  1 band images are replicated to all bands by the compositor.
+    sources = []
+    clips = []
+    for img in final_intersects:
+        srcbands = images[img]
+        if srcbands >= bands or (srcbands == 1 and force_pan_to_multi is True):
+            sources.append(img)
+            if cutlines is not None:
+                clips.append(cutlines.get(os.path.basename(img)))
         else:
-            cmd = 'gdalwarp -srcnodata "%s" "%s" "%s"' %(srcnodata,mergefile,localtile1)
-            ExecCmd(cmd)
-            
-        c += 1
-        
-        if not mergefile == img:
-            del_images.append(mergefile)
+            print "Image has %i bands, %i required: %s" %(srcbands,bands,img)
     
-    if status == 0:
-        ####  Write to Compressed file
-        if os.path.isfile(localtile1):
-            if gtiff_compression == 'lzw':
-                compress_option = '-co "compress=lzw"'
-            elif gtiff_compression == 'jpeg95':
-                compress_option =  '-co "compress=jpeg" -co "jpeg_quality=95"'
-                
-            cmd = 'gdal_translate -stats -of GTiff %s -co "PHOTOMETRIC=MINISBLACK" -co "TILED=YES" -co "BIGTIFF=IF_SAFER" "%s" "%s"' %(compress_option,localtile1,localtile2)
-            ExecCmd(cmd)
+    if status == 0 and len(sources) > 0:
+        extent = (float(minx),float(miny),float(maxx),float(maxy))
         
-        ####  Build Pyramids
+        ####  Composite all sources in one pass and write the compressed, tiled tile with pyramids
         tm = datetime.today()
         print tm.strftime("%d-%b-%Y %H:%M:%S"),
+        print "Compositing %i images" %len(sources)
         
-        if os.path.isfile(localtile2):
-            cmd = 'gdaladdo "%s" 2 4 8 16 30' %(localtile2)
-            ExecCmd(cmd)
-        
+        if cutlines is None:
+            clips = None
+        try:
+            status = WriteTile(sources,localtile2,extent,float(ref_xres),float(ref_yres),bands,gtiff_compression,threads,clips)
+        except resources.WalltimeExpired:
+            print "Walltime expired, removing partial tile"
+            deleteTempFiles([localtile2])
+            shutil.rmtree(wd, ignore_errors=True)
+            raise
+    
+    if status == 0:
         #### Copy tile to destination
         if os.path.isfile(localtile2):
             print "Copying output files to destination dir"
             copyall(localtile2,os.path.dirname(tile))
-            #copyall(localtile1,os.path.dirname(tile))
-        del_images.append(localtile1)
         del_images.append(localtile2)
     
     #### Delete temp files
@@ -157,4 +361,5 @@ def main():
    
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    #### Clean up the work in progress if the job is killed at its walltime
+    resources.runGuarded(main)
\ No newline at end of file
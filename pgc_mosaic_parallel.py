@@ -6,6 +6,7 @@ from math import *
 from xml.etree import cElementTree as ET
 
 from lib.mosaic import *
+from lib import footprint_cache, scheduler, packing
 import gdal, ogr, osr, gdalconst
 import numpy
 
@@ -16,6 +17,9 @@ logger.setLevel(logging.DEBUG)
 default_qsub_script = "qsub_mosaic.sh"
 default_logfile = "mosaic.log"
 
+#### Memory needed by one local tile build (GDAL block cache plus compositor buffers)
+TILE_BUILD_MEMORY = 3 * 1024**3
+
 
 def main():
     
@@ -46,6 +50,11 @@ def main():
                         help="create shp of all componenet images")
     parser.add_argument("--gtiff_compression", choices=GTIFF_COMPRESSIONS, default="lzw",
                         help="GTiff compression type. Default=lzw (%s)"%string.join(GTIFF_COMPRESSIONS,','))
+    scheduler.addSchedulerArguments(parser)
+    parser.add_argument("--local", dest="scheduler", action="store_const", const="local",
+                        help="build cutlines and tiles on this machine (same as --scheduler local)")
+    parser.add_argument("--wd",
+                        help="local working directory for tile builds (default is /local)")
         
     
     #### Parse Arguments
@@ -61,9 +70,14 @@ def main():
     else:
         qsubpath = os.path.abspath(args.qsubscript)
         
-    if not os.path.isfile(qsubpath):
+    if args.scheduler in ("pbs","slurm") and not os.path.isfile(qsubpath):
         parser.error("qsub script path is not valid: %s" %qsubpath)
     
+    try:
+        sched = scheduler.getSchedulerFromArgs(args,qsubpath,TILE_BUILD_MEMORY)
+    except ValueError, e:
+        parser.error(e)
+    
     cutline_builder_script = os.path.join(os.path.dirname(scriptpath),'pgc_mosaic_build_cutlines.py')
     tile_builder_script = os.path.join(os.path.dirname(scriptpath),'pgc_mosaic_build_tile.py')
     
@@ -77,8 +91,6 @@ def main():
         
     if not os.path.isdir(mosaic_dir):
         os.makedirs(mosaic_dir)
-    if not os.path.isfile(qsubpath):
-        parser.error("Arg3 is not a valid file path: %s" %qsubpath)
         
     
     #### Validate target day option
@@ -96,12 +108,9 @@ def main():
         d = 0
     
     #### build args list to pass to builder scripts
-    #### Get -l args and make a var
-    l = ("-l %s" %args.l) if args.l is not None else ""
-
     args_dict = vars(args)
     arg_list = []
-    arg_keys_to_remove = ('l','qsubscript','log','gtiff_compression','mode')
+    arg_keys_to_remove = ('l','qsubscript','log','gtiff_compression','mode','wd') + scheduler.SCHEDULER_ARG_KEYS
     
     ## Add optional args to arg_list
     for k,v in args_dict.iteritems():
@@ -154,7 +163,8 @@ def main():
         logger.info("%i existing images found" %len(image_list))
     
     #### gather image info list
-    imginfo_list = [ImageInfo(image,"warped",logger) for image in image_list]
+    cache = footprint_cache.openFootprintCache(args.footprint_cache)
+    imginfo_list = buildImageInfoList(image_list,"warped",logger,cache)
     
     #### Get mosaic parameters
     params = getMosaicParameters(imginfo_list[0],args)
@@ -173,7 +183,10 @@ def main():
     
     imginfo_list3 = []
     for iinfo in imginfo_list2:
-        iinfo.geom, xs1, ys1 = getGeom(iinfo.srcfp)
+        if args.footprint_mode == "polygonize":
+            iinfo.geom, xs1, ys1 = GetPolygonizedGeom(iinfo.srcfp,tolerance=getFootprintTolerance(params),overview=args.footprint_overview)
+        else:
+            iinfo.geom, xs1, ys1 = iinfo.getBBox(cache)
         if iinfo.geom is not None:
             xs = xs + xs1
             ys = ys + ys1
@@ -181,6 +194,9 @@ def main():
         else: # remove from list if no geom
             logger.warning("Cannot get geometry for image: %s" %iinfo.srcfp)
     
+    if cache is not None:
+        cache.close()
+    
     #### set extent if not already set
     if args.extent is None:
         params.xmin = min(xs)
@@ -209,8 +225,7 @@ def main():
     
     logger.info("Reading image metadata and determining sort order")
          
-    for iinfo in imginfo_list3:
-        iinfo.score, iinfo.attribs = iinfo.getScore(params,logger)
+    scoreImages(imginfo_list3,params,logger)
             
     ####  Sort by score
     if not args.nosort:
@@ -277,6 +292,13 @@ def main():
     i = 1
     j = 0
     
+    #### Find the images in each tile and save the mapping for the tile and cutline builders
+    logger.info("Running intersect with imagery")
+    tile_intersects = getTileIntersects(tiles,intersects_all)
+    
+    titpath = mosaic+"_tile_intersects.json"
+    writeTileIntersects(titpath,intersects_all,tiles,tile_intersects)
+    
     
     #################################################
     ####  Write shapefile of tiles
@@ -368,13 +390,12 @@ def main():
             logger.info("Creating shapefile of components: %s" %comp_shp)
         
             if args.extent:
-                 cmd = r'qsub -N Cutlines -v p1="%s --cutline-step=512 %s %s %s" "%s"' %(cutline_builder_script,arg_str,comp_shp,aitpath,qsubpath)
+                job_args = ["--cutline_step=512",arg_str,comp_shp,titpath]
             else:
-                cmd = r'qsub -N Cutlines -v p1="%s --cutline-step=512 %s -e %f %f %f %f %s %s" "%s"' %(cutline_builder_script,arg_str,params.xmin,params.xmax,params.ymin,params.ymax,comp_shp,aitpath,qsubpath)
-            logger.debug(cmd)
+                job_args = ["--cutline_step=512",arg_str,"-e %f %f %f %f" %(params.xmin,params.xmax,params.ymin,params.ymax),comp_shp,titpath]
             if args.mode == "ALL" or args.mode == "SHP":
-                p = Popen(cmd,shell=True)
-                p.wait()  
+                sched.submit(scheduler.JobSpec("Cutlines",cutline_builder_script,job_args,output=comp_shp))
+                sched.wait()
     
     
     ###############################################   
@@ -382,62 +403,56 @@ def main():
     ###############################################
     shp = mosaic + "_cutlines.shp"
     
-    if os.path.isfile(shp):
+    #### Cutlines older than the tile intersects file are from a different set of images
+    if IsNewer(shp,titpath):
         logger.info("Cutlines shapefile already exists: %s" %shp)
     else:
         logger.info("Creating shapefile of cutlines: %s" %shp)
         
         arg_str2 = arg_str.replace("--component_shp","")
         if args.extent:
-            cmd = r'qsub -N Cutlines -v p1="%s %s %s %s" "%s"' %(cutline_builder_script,arg_str2,shp,aitpath,qsubpath)
+            job_args = [arg_str2,shp,titpath]
         else:
-            cmd = r'qsub -N Cutlines -v p1="%s %s -e %f %f %f %f %s %s" "%s"' %(cutline_builder_script,arg_str2,params.xmin,params.xmax,params.ymin,params.ymax,shp,aitpath,qsubpath)
-        logger.debug(cmd)
+            job_args = [arg_str2,"-e %f %f %f %f" %(params.xmin,params.xmax,params.ymin,params.ymax),shp,titpath]
         if args.mode == "ALL" or args.mode == "SHP":
-            p = Popen(cmd,shell=True)
-            p.wait()
+            #### Wait for local cutlines so the tile builds can use them
+            sched.submit(scheduler.JobSpec("Cutlines",cutline_builder_script,job_args,output=shp))
+            sched.wait()
       
       
     ################################################
     ####  For each tile set up mosaic call to qsub
     ################################################
     
-    for t in tiles:
+    #### Restrict tile reads to the image cutlines if they have already been built for these images
+    tile_args = []
+    if IsNewer(shp,titpath):
+        tile_args.append('--cutlines %s' %shp)
+    if args.wd is not None:
+        tile_args.append('--wd %s' %os.path.abspath(args.wd))
+    
+    num_jobs = 0
+    
+    for t, intersects in zip(tiles,tile_intersects):
         logger.info("Processing tile %d of %d: %s" %(i,num_tiles,t.name))
         
-        ####    determine which images in each tile - create geom and query image geoms
-        logger.info("Running intersect with imagery")       
-        
-        intersects = []
-        for iinfo in intersects_all:
-            if t.geom.Intersect(iinfo.geom) is True:
-                if iinfo.score > 0:
-                    logger.info("intersects! %s - score %f" %(iinfo.srcfn,iinfo.score))
-                    intersects.append(iinfo.srcfp)
-                elif args.nosort:
-                    logger.info("intersects! %s - score %f" %(iinfo.srcfn,iinfo.score))
-                    intersects.append(iinfo.srcfp)
-                else:
-                    logger.warning("Image has an invalid score: %s --> %i" %(iinfo.srcfp, iinfo.score))
+        for iinfo in intersects:
+            logger.info("intersects! %s - score %f" %(iinfo.srcfn,iinfo.score))
         
         ####  If any images are in the tile, mosaic them        
         if len(intersects) > 0:
             
-            tile_basename = os.path.basename(os.path.splitext(t.name)[0])                                    
-            itpath = os.path.join(mosaic_dir,tile_basename+"_intersects.txt")
-            it = open(itpath,"w")
-            it.write(string.join(intersects,"\n"))
-            it.close()
-            
-            #### Submit QSUB job
+            #### Submit tile job
             logger.info("Submitting mosaicking job for tile: %s" %os.path.basename(t.name))
             if os.path.isfile(t.name) is False:
                                 
-                cmd = r'qsub -N Mosaic%04i -v p1="%s %s %s %s %s %f %f %f %f %f %f %s" "%s"' %(i,tile_builder_script,params.bands,itpath,t.name,int(params.force_pan_to_multi),params.xres,params.yres,t.minx,t.miny,t.maxx,t.maxy,args.gtiff_compression,qsubpath)
-                logger.debug(cmd)
+                job_args = [params.bands,titpath,t.name,int(params.force_pan_to_multi),"%f %f %f %f %f %f" %(params.xres,params.yres,t.minx,t.miny,t.maxx,t.maxy),args.gtiff_compression] + tile_args
+                #### Tile cost: output pixels times bands times the number of images that may be read
+                units = (t.maxx - t.minx) / params.xres * (t.maxy - t.miny) / params.yres * params.bands * len(intersects) / 1e6
                 if args.mode == "ALL" or args.mode == "MOSAIC":
-                    p = Popen(cmd,shell=True)
-                    p.wait()
+                    sched.submit(scheduler.JobSpec("Mosaic%04i" %i,tile_builder_script,job_args,output=t.name,log=os.path.splitext(t.name)[0]+".log",
+                                                   cost_key=packing.costKey("mosaic",[args.gtiff_compression]),units=units))
+                    num_jobs += 1
                 
             else:
                 logger.info("Tile already exists: %s" %t.name)
@@ -446,6 +461,19 @@ def main():
         
         i += 1
     
+    failed = sched.wait()
+    if failed > 0:
+        logger.error("%i of %i tiles failed" %(failed,num_jobs))
+        sys.exit(1)
+    
+
+def IsNewer(path,ref):
+    """
+    Return True if path exists and was modified no earlier than ref
+    """
+    
+    return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(ref)
+
 
 def FindImages(inpath,bTextfile,exclude_list):
     
@@ -4,7 +4,7 @@ from datetime import datetime
 import gdal, ogr,osr, gdalconst
 
 from lib.mosaic import *
-from lib import ortho_utils
+from lib import ortho_utils, footprint_cache
 
 
 ### Create Logger
@@ -107,6 +107,9 @@ def main():
                 tiles[name] = t
     csv.close()
     
+    #### Footprint cache shared by all tiles (None if not requested)
+    cache = footprint_cache.openFootprintCache(args.footprint_cache)
+    
     if args.ttile is not None:
         if "," in args.ttile:
             ttiles = args.ttile.split(",")
@@ -123,7 +126,7 @@ def main():
                     logger.error("Tile status indicates it should not be created: %s, %s" %(ttile,t.status))
                     print "Tile status indicates it should not be created: %s, %s" %(ttile,t.status)
                 else:
-                    HandleTile(t,shp,dstdir,csvpath,args,exclude_list)
+                    HandleTile(t,shp,dstdir,csvpath,args,exclude_list,cache)
     
     else:
         keys = tiles.keys()
@@ -131,10 +134,13 @@ def main():
         for tile in keys:
             t = tiles[tile]
             if t.status == "1":
-                HandleTile(t,shp,dstdir,csvpath,args,exclude_list)   
+                HandleTile(t,shp,dstdir,csvpath,args,exclude_list,cache)
+    
+    if cache is not None:
+        cache.close()   
         
         
-def HandleTile(t,shp,dstdir,csvpath,args,exclude_list):
+def HandleTile(t,shp,dstdir,csvpath,args,exclude_list,cache=None):
     
     
     otxtpath = os.path.join(dstdir,"%s_%s_orig.txt" %(os.path.basename(csvpath)[:-4],t.name))
@@ -237,7 +243,7 @@ def HandleTile(t,shp,dstdir,csvpath,args,exclude_list):
                 
                     #### gather image info list
                     logger.info("Gathering image info")
-                    imginfo_list1 = [ImageInfo(image,"raw",logger) for image in image_list]
+                    imginfo_list1 = buildImageInfoList(image_list,"raw",logger,cache)
                     
                      #### Get mosaic parameters
                     logger.info("Getting mosaic parameters")
@@ -255,7 +261,7 @@ def HandleTile(t,shp,dstdir,csvpath,args,exclude_list):
                     
                     imginfo_list3 = []
                     for iinfo in imginfo_list2:
-                        geom = getRpcGeom(iinfo,args.dem,t_srs)
+                        geom = getRpcGeom(iinfo,args.dem,t_srs,cache,args.footprint_mode,args.footprint_overview)
                         if geom is not None:
                             logger.info("%s geom: %s" %(iinfo.srcfn,str(geom)))
                             iinfo.geom = geom
@@ -266,12 +272,8 @@ def HandleTile(t,shp,dstdir,csvpath,args,exclude_list):
                     #### Sort by quality
                     logger.info("Sorting images by quality")
                     
-                    imginfo_list4 = []
-                    for iinfo in imginfo_list3:
-                        
-                        iinfo.score,iinfo.factors = iinfo.getScore(params,logger)
-                        if iinfo.score > 0:
-                            imginfo_list4.append(iinfo)
+                    scoreImages(imginfo_list3,params,logger)
+                    imginfo_list4 = [iinfo for iinfo in imginfo_list3 if iinfo.score > 0]
                     
                     imginfo_list4.sort(key=lambda x: x.score)
                     
@@ -337,34 +339,7 @@ def HandleTile(t,shp,dstdir,csvpath,args,exclude_list):
                     
                     ####  Overlay geoms and remove non-contributors
                     logger.info("Overlaying images to determine contributors")
-                    contribs = []
-                    
-                    for i in xrange(0,len(imginfo_list4)):
-                        iinfo = imginfo_list4[i]
-                        basegeom = iinfo.geom
-    
-                        for j in range(i+1,len(imginfo_list4)):
-                            iinfo2 = imginfo_list4[j]
-                            geom2 = iinfo2.geom
-                            
-                            if basegeom.Intersects(geom2):
-                                basegeom = basegeom.Difference(geom2)
-                                if basegeom is None or basegeom.IsEmpty():
-                                    #logger.info("Broke after %i comparisons" %j)
-                                    break
-                                    
-                        if basegeom is None:
-                            logger.info("Function Error: %s" %iinfo.srcfp)
-                        elif basegeom.IsEmpty():
-                            logger.info("Removing non-contributing image: %s" %iinfo.srcfp)
-                        else:
-                            basegeom = basegeom.Intersection(t.geom)
-                            if basegeom is None:
-                                logger.info("Function Error: %s" %iinfo.srcfp)
-                            elif basegeom.IsEmpty():
-                                logger.info("Removing non-contributing image: %s" %iinfo.srcfp)
-                            else:
-                                contribs.append(iinfo.srcfp)
+                    contribs = [iinfo.srcfp for iinfo,geom in overlayImages(imginfo_list4,t.geom,logger)]
                                                 
                 elif args.nosort is True:
                     contribs = image_list
@@ -1,4 +1,4 @@
-import os, string, sys, shutil, math, glob, re, tarfile, logging, shlex, argparse
+import os, string, sys, shutil, math, glob, re, tarfile, logging, shlex, argparse, multiprocessing
 from datetime import datetime, timedelta
 
 from subprocess import *
@@ -8,6 +8,7 @@ from xml.etree import cElementTree as ET
 import gdal, ogr,osr, gdalconst
 
 from lib.ortho_utils import *
+from lib import resources
 
 #### Create Loggers
 logger = logging.getLogger("logger")
@@ -17,8 +18,56 @@ logger.setLevel(logging.DEBUG)
 rc_dict = {}
 
 
+class RecordCollector(logging.Handler):
+    """
+    Log handler that holds the records of one image so a pool worker can hand them back as a block
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        #### Render the message now so the record can be pickled back to the parent
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+
+def initPoolWorker(processes):
+
+    #### Share the cores among the workers so GDAL does not oversubscribe the machine
+    os.environ[resources.THREADS_ENV] = str(max(1, resources.getAvailableCpus() / processes))
+
+
+def processImageInPool(task):
+
+    srcfp, dstfp, opt = task
+    srcfn = os.path.basename(srcfp)
+
+    #### Collect this image's log output instead of writing it as it happens
+    collector = RecordCollector()
+    handlers = logger.handlers[:]
+    logger.handlers = [collector]
+    try:
+        rc = processImage(srcfp,dstfp,opt)
+    except Exception, e:
+        logger.exception("Unhandled error processing %s: %s" %(srcfn,e))
+        rc = 1
+    finally:
+        logger.handlers = handlers
+
+    return srcfn, rc, collector.records
+
+
 def main():
 
+    #### Module state is kept between runs when pgc_worker.py runs jobs in process
+    rc_dict.clear()
+
     #########################################################
     ####  Handle Options
     #########################################################
@@ -31,6 +80,8 @@ def main():
 	)
 
     parser.add_argument("--log", help="file to log progress.  Defaults to <output dir>\process.log")
+    parser.add_argument("--threads", "--processes", dest="threads", type=int, default=1,
+                        help="number of images to process at once in a local process pool (default=1)")
         
     
     #### Parse Arguments
@@ -53,9 +104,12 @@ def main():
     if not os.path.isdir(dstdir):
         parser.error("Error arg2 is not a valid file path: %s" %dstdir)
 
+    if opt.threads < 1:
+        parser.error("--threads must be at least 1")
+
     #### Verify EPSG
     try:
-        spatial_ref = SpatialRef(opt.epsg)
+        spatial_ref = GetSpatialRef(opt.epsg)
     except RuntimeError, e:
 	parser.error(e)
 
@@ -120,6 +174,7 @@ def main():
     image_list3 = list(set(image_list2))
 
     #### Iterate Through Found Images
+    task_list = []
     if image_list3 <> []:
         for srcfp in image_list3:
 
@@ -141,7 +196,33 @@ def main():
             done = os.path.isfile(dstfp)
 
             if done is False:
-                rc_dict[srcfn] = processImage(srcfp,dstfp,opt)
+                task_list.append((srcfp,dstfp,opt))
+
+    #### DEM subsets are shared by the images of this run and removed at the end
+    StartDemSubsets(opt, opt.wd if opt.wd is not None else dstdir)
+    try:
+        #### Process images in a local pool, writing each image's log output as one block
+        if opt.threads > 1 and len(task_list) > 1:
+            processes = min(opt.threads,len(task_list))
+            LogMsg("Processing %i images with %i processes" %(len(task_list),processes))
+            pool = multiprocessing.Pool(processes,initPoolWorker,(processes,))
+            try:
+                for srcfn, rc, records in pool.imap_unordered(processImageInPool,task_list):
+                    for record in records:
+                        logger.handle(record)
+                    rc_dict[srcfn] = rc
+                pool.close()
+            except (KeyboardInterrupt, resources.WalltimeExpired):
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        else:
+            for srcfp, dstfp, opt in task_list:
+                rc_dict[os.path.basename(srcfp)] = processImage(srcfp,dstfp,opt)
+    finally:
+        EndDemSubsets(opt)
 
 
     #### Print Images with Errors
@@ -152,4 +233,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    #### Clean up the work in progress if the job is killed at its walltime
+    resources.runGuarded(main)
@@ -8,6 +8,7 @@ from xml.etree import cElementTree as ET
 import gdal, ogr,osr, gdalconst
 
 from lib.ortho_utils import *
+from lib import scheduler, packing, resources
 
 #### Create Loggers
 logger = logging.getLogger("logger")
@@ -31,6 +32,7 @@ def main():
                       help="qsub script to use in cluster job submission (default is qsub_ortho.sh in script root folder)")
     parser.add_argument("-l",
                       help="PBS resources requested (mimicks qsub syntax)")
+    scheduler.addSchedulerArguments(parser)
     
     
     #### Parse Arguments
@@ -62,9 +64,14 @@ def main():
     else:
         qsubpath = os.path.abspath(opt.qsubscript)
         
-    if not os.path.isfile(qsubpath):
+    if opt.scheduler in ("pbs","slurm") and not os.path.isfile(qsubpath):
         parser.error("qsub script path is not valid: %s" %qsubpath)
     
+    try:
+        sched = scheduler.getSchedulerFromArgs(opt,qsubpath)
+    except ValueError, e:
+        parser.error(e)
+    
     
     #### Verify EPSG
     try:
@@ -98,12 +105,9 @@ def main():
     if srctype in ['dir','textfile']:
         
         #### Get args ready to pass through
-        #### Get -l args and make a var
-        l = ("-l %s" %opt.l) if opt.l is not None else ""
-    
         args_dict = vars(opt)
         arg_list = []
-        arg_keys_to_remove = ('l','qsubscript')
+        arg_keys_to_remove = ('l','qsubscript') + scheduler.SCHEDULER_ARG_KEYS
         
         ## Add optional args to arg_list
         for k,v in args_dict.iteritems():
@@ -152,6 +156,10 @@ def main():
         print 'Number of src images: %i' %len(image_list3)
         i = 0
         
+        #### Image sizes are only read if the jobs are packed or timed
+        cost_key = packing.costKey("ortho",["dem" if opt.dem else None,opt.stretch])
+        measure = opt.pack_walltime is not None or opt.timings is not None
+        
         for srcfp in image_list3:
             
             srcdir, srcfn = os.path.split(srcfp)
@@ -169,14 +177,20 @@ def main():
             if done is False:
                 #print dstfp
                 
-                cmd = r'qsub %s -N Ortho%04i -v p1="%s %s %s %s" "%s"' %(l,i,scriptpath,arg_str,srcfp,dstdir,qsubpath)
-		p = Popen(cmd,shell=True)
-                p.wait()
+                units = getImageUnits(srcfp) if measure else None
+                job = scheduler.JobSpec("Ortho%04i" %i,scriptpath,[arg_str,srcfp,dstdir],output=dstfp,log=os.path.splitext(dstfp)[0]+".log",
+                                        cost_key=cost_key,units=units)
+                sched.submit(job)
                 i+=1
             #else:
                 #print dstfp, "exists"
                 
         print "Number of images to process: %i" %i
+        
+        failed = sched.wait()
+        if failed > 0:
+            LogMsg("ERROR: %i of %i images failed" %(failed,i))
+            sys.exit(1)
     
     
     ###############################
@@ -203,5 +217,6 @@ def main():
    
 
 if __name__ == "__main__":
-    main()
+    #### Clean up the work in progress if the job is killed at its walltime
+    resources.runGuarded(main)
 
@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 
 from subprocess import *
 from lib.ortho_utils import *
+from lib import resources, scheduler, packing
 
 import gdal, ogr,osr, gdalconst
 
@@ -63,8 +64,9 @@ def main():
     parser.add_argument("-l", help="PBS resources requested (mimicks qsub syntax)")
     parser.add_argument("--qsubscript",
                       help="qsub script to use in cluster job submission (default is qsub_pansharpen.sh in script root folder)")
-    parser.add_argument("--dryrun", action="store_true", default=False,
-                    help="print actions without executing")
+    scheduler.addSchedulerArguments(parser)
+    parser.add_argument("--dryrun", dest="scheduler", action="store_const", const="dryrun",
+                    help="print actions without executing (same as --scheduler dryrun)")
     
     #### Parse Arguments
     opt = parser.parse_args()
@@ -93,9 +95,14 @@ def main():
     else:
         qsubpath = os.path.abspath(opt.qsubscript)
         
-    if not os.path.isfile(qsubpath):
+    if opt.scheduler in ("pbs","slurm") and not os.path.isfile(qsubpath):
         parser.error("qsub script path is not valid: %s" %qsubpath)
     
+    try:
+        sched = scheduler.getSchedulerFromArgs(opt,qsubpath)
+    except ValueError, e:
+        parser.error(e)
+    
     #### Verify EPSG
     try:
         spatial_ref = SpatialRef(opt.epsg)
@@ -117,12 +124,9 @@ def main():
     
     
         #### Get args ready to pass through
-        #### Get -l args and make a var
-        l = ("-l %s" %opt.l) if opt.l is not None else ""
-    
         args_dict = vars(opt)
         arg_list = []
-        arg_keys_to_remove = ('l','qsubscript')
+        arg_keys_to_remove = ('l','qsubscript') + scheduler.SCHEDULER_ARG_KEYS
         
         ## Add optional args to arg_list
         for k,v in args_dict.iteritems():
@@ -155,6 +159,10 @@ def main():
         
         #### Loop over images
         i = 0
+        
+        #### Image sizes are only read if the jobs are packed or timed
+        cost_key = packing.costKey("pansharpen",["dem" if opt.dem else None,opt.stretch])
+        measure = opt.pack_walltime is not None or opt.timings is not None
         for image in image_list:
     
             #print  image
@@ -188,15 +196,24 @@ def main():
                 if os.path.isfile(mulp):
                     if not os.path.isfile(panshp):
                         
-                        cmd = r'qsub %s -N Pansh%04i -v p1="%s %s %s %s" "%s"' %(l,i,scriptpath,arg_str,image,dstdir,qsubpath)
-                        print i, cmd
-                        if not opt.dryrun:
-                            p = Popen(cmd,shell=True)
-                            p.wait()
+                        units = None
+                        if measure:
+                            pan_units = getImageUnits(image)
+                            mul_units = getImageUnits(mulp)
+                            if pan_units is not None and mul_units is not None:
+                                units = pan_units + mul_units
+                        job = scheduler.JobSpec("Pansh%04i" %i,scriptpath,[arg_str,image,dstdir],output=panshp,log=os.path.splitext(panshp)[0]+".log",
+                                                cost_key=cost_key,units=units)
+                        sched.submit(job)
                         i+=1
                     
                 else:
                     print "Error: Multispectral image not found: %s" %(mulp)
+        
+        failed = sched.wait()
+        if failed > 0:
+            print "Error: %i of %i images failed" %(failed,i)
+            sys.exit(1)
                     
     
     ###############################
@@ -262,7 +279,7 @@ def main():
                 panshp = os.path.join(dstdir,"%s%s_%s%s%s_pansh.tif"%(dem_str,p,bittype,opt.stretch,opt.epsg))    
                 
                 #### Check if pansh is already present
-                if not os.path.isfile(panshp) and not opt.dryrun:
+                if not os.path.isfile(panshp) and opt.scheduler != "dryrun":
                     
                     if not os.path.isdir(wd):
                         os.makedirs(wd)
@@ -292,13 +309,14 @@ def main():
                         print "Pan or Multi warped image does not exist\n\t%s\n\t%s" %(panolp,mulolp)
                     
                     #### Compress
+                    threads = resources.getAvailableCpus()
                     if os.path.isfile(panshtp) and not os.path.isfile(panshlp):
-                        cmd = 'gdal_translate -stats -co BIGTIFF=IF_SAFER -co COMPRESS=LZW -co TILED=YES "%s" "%s"' %(panshtp,panshlp)
+                        cmd = 'gdal_translate -stats -co BIGTIFF=IF_SAFER -co COMPRESS=LZW -co TILED=YES -co NUM_THREADS=%d "%s" "%s"' %(threads,panshtp,panshlp)
                         ExecCmd(cmd)
                     
                     #### Make pyramids
                     if os.path.isfile(panshlp):
-                       cmd = 'gdaladdo "%s" 2 4 8 16' %(panshlp)
+                       cmd = 'gdaladdo --config GDAL_NUM_THREADS %d "%s" 2 4 8 16' %(threads,panshlp)
                        ExecCmd(cmd)
                     
                     #### Copy pansharpened output
@@ -333,4 +351,5 @@ def main():
 
     
 if __name__ == '__main__':
-    main()
+    #### Clean up the work in progress if the job is killed at its walltime
+    resources.runGuarded(main)
@@ -0,0 +1,235 @@
+import os, sys, re, imp, shlex, time, logging, argparse
+from datetime import datetime
+from subprocess import STDOUT
+
+from lib import scheduler, job_queue, packing, resources
+
+import gdal
+
+#### Create Loggers
+logger = logging.getLogger("logger")
+logger.setLevel(logging.DEBUG)
+
+#### Seconds of walltime kept in reserve when deciding whether to start another job
+WALLTIME_MARGIN = 600
+
+#### Job scripts loaded by RunInProcess, keyed by script path
+task_modules = {}
+
+#### GDAL config options the job scripts set, restored after each job run in process
+JOB_CONFIG_OPTIONS = ("GDAL_CACHEMAX","GDAL_NUM_THREADS","CENTER_LONG")
+
+
+def main():
+
+    #### Set Up Arguments
+    parser = argparse.ArgumentParser(
+        description="Run jobs from a job queue written by the parallel scripts until the queue is empty or the walltime runs out"
+        )
+
+    parser.add_argument("queue", help="job queue database")
+    parser.add_argument("--walltime",
+                        help="walltime of this worker (HH:MM:SS or seconds, default is the walltime left to the cluster job, or unlimited outside one)")
+    parser.add_argument("--margin", type=int, default=WALLTIME_MARGIN,
+                        help="do not start a job with less than this many seconds of walltime left (default=%i)" %WALLTIME_MARGIN)
+    parser.add_argument("--grace", type=int, default=resources.WALLTIME_GRACE,
+                        help="stop the running job and return it to the queue this many seconds before the walltime runs out (default=%i)" %resources.WALLTIME_GRACE)
+    parser.add_argument("--timings",
+                        help="file to append the run time of each job to")
+    parser.add_argument("--isolate", action="store_true", default=False,
+                        help="run each job in a subprocess instead of in this process")
+    parser.add_argument("--log",
+                        help="file to log progress to (default is stdout only)")
+
+    #### Parse Arguments
+    args = parser.parse_args()
+    queue_path = os.path.abspath(args.queue)
+
+    if not os.path.isfile(queue_path):
+        parser.error("Job queue does not exist: %s" %queue_path)
+
+    if args.walltime is not None:
+        try:
+            walltime = resources.parseWalltime(args.walltime)
+        except ValueError, e:
+            parser.error(e)
+    else:
+        walltime = resources.getWalltimeRemaining()
+
+    #### Set Up Logging Handlers
+    lso = logging.StreamHandler()
+    lso.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s- %(message)s','%m-%d-%Y %H:%M:%S')
+    lso.setFormatter(formatter)
+    logger.addHandler(lso)
+
+    if args.log is not None:
+        lfh = logging.FileHandler(args.log)
+        lfh.setLevel(logging.DEBUG)
+        lfh.setFormatter(formatter)
+        logger.addHandler(lfh)
+
+    queue = job_queue.JobQueue(queue_path)
+    costs = packing.CostModel(args.timings)
+    worker = job_queue.getWorkerName()
+    heartbeat = job_queue.Heartbeat(queue, worker)
+    heartbeat.start()
+    guard = resources.WalltimeGuard(walltime, args.grace)
+    end = time.time() + walltime if walltime is not None else None
+    done = 0
+    failed = 0
+    released = 0
+
+    if walltime is not None:
+        logger.info("Worker %s started on queue %s with %s of walltime" %(worker,queue_path,scheduler.formatWalltime(walltime)))
+    else:
+        logger.info("Worker %s started on queue %s" %(worker,queue_path))
+
+    while not guard.expired:
+        remaining = guard.remaining()
+        if remaining is not None and remaining < args.margin:
+            logger.info("Less than %i seconds of walltime left, stopping" %args.margin)
+            break
+
+        job = queue.claim(worker, end)
+        if job is None:
+            logger.info("Queue is empty")
+            break
+
+        #### Leave a job that would not finish in time for a worker with more walltime
+        if remaining is not None and job.cost_key in costs.coeffs:
+            estimate = costs.estimate(job.cost_key, job.units)
+            if estimate is not None and estimate > remaining:
+                logger.info("%s is estimated at %i seconds, more than the %i seconds left, stopping" %(job.name,estimate,remaining))
+                queue.release(job)
+                released += 1
+                break
+
+        logger.info("Running %s: %s" %(job.name,job.commandLine()))
+        job_start = datetime.today()
+        try:
+            if args.isolate:
+                rc = guard.run(RunSubprocess, job)
+            else:
+                rc = guard.run(RunInProcess, job)
+        except resources.WalltimeExpired:
+            rc = None
+        seconds = scheduler.getSeconds(datetime.today() - job_start)
+
+        success = rc == 0 and (job.output is None or os.path.isfile(job.output))
+
+        #### A job cut short by the end of the walltime goes back to the queue without its partial output
+        if not success and guard.expired:
+            logger.warning("Walltime is running out, returning %s to the queue" %job.name)
+            scheduler.removePartialOutput(job.output)
+            queue.release(job)
+            released += 1
+            break
+
+        queue.finish(job, rc, seconds, success)
+        if success:
+            done += 1
+            logger.info("%s finished in %.1f seconds" %(job.name,seconds))
+            if args.timings and job.cost_key is not None and job.units is not None:
+                packing.recordTiming(args.timings, job.cost_key, job.units, seconds)
+        else:
+            failed += 1
+            logger.error("%s failed (return code %i)" %(job.name,rc))
+
+    heartbeat.stop()
+    queue.close()
+    logger.info("Worker %s finished: %i jobs done, %i failed, %i returned to the queue" %(worker,done,failed,released))
+    if failed > 0:
+        sys.exit(1)
+
+
+def RunInProcess(job):
+    """
+    Run a job by calling the main() of its script in this process, so GDAL's block cache, open DEMs and the
+    caches of the lib modules stay warm from one job to the next.  The scripts reset their own per-run state in
+    main(), and the GDAL config options in JOB_CONFIG_OPTIONS and the cache size are restored after each job.
+    Returns the exit code of the job.
+    """
+
+    module = task_modules.get(job.script)
+    if module is None:
+        name = "pgc_task_%s" %re.sub(r'\W', '_', os.path.splitext(os.path.basename(job.script))[0])
+        module = imp.load_source(name, job.script)
+        task_modules[job.script] = module
+
+    argv = sys.argv
+    cwd = os.getcwd()
+    saved_env = dict((k, os.environ.get(k)) for k in job.env)
+    saved_config = dict((k, gdal.GetConfigOption(k)) for k in JOB_CONFIG_OPTIONS)
+    saved_cachemax = gdal.GetCacheMax()
+
+    #### Send the job's log messages to its own log instead of the worker's handlers
+    worker_handlers = logger.handlers[:]
+    for handler in worker_handlers:
+        logger.removeHandler(handler)
+    if job.log:
+        jfh = logging.FileHandler(job.log)
+        jfh.setLevel(logging.DEBUG)
+        jfh.setFormatter(logging.Formatter('%(asctime)s %(levelname)s- %(message)s','%m-%d-%Y %H:%M:%S'))
+        logger.addHandler(jfh)
+
+    sys.argv = [job.script] + shlex.split(job.args)
+    os.environ.update(job.env)
+    try:
+        module.main()
+        rc = 0
+    except SystemExit, e:
+        if e.code is None:
+            rc = 0
+        elif isinstance(e.code, int):
+            rc = e.code
+        else:
+            logger.error(e.code)
+            rc = 1
+    except Exception, e:
+        logger.exception("Job %s raised an exception" %job.name)
+        rc = 1
+    finally:
+        sys.argv = argv
+        os.chdir(cwd)
+        for k, val in saved_env.iteritems():
+            if val is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = val
+        for k, val in saved_config.iteritems():
+            gdal.SetConfigOption(k, val)
+        gdal.SetCacheMax(saved_cachemax)
+
+        #### Drop the handlers the job added and restore the worker's
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+            handler.close()
+        for handler in worker_handlers:
+            logger.addHandler(handler)
+
+    return rc
+
+
+def RunSubprocess(job):
+    """
+    Run a job in a subprocess, as the local scheduler does.  Returns the exit code of the job.
+    """
+
+    env = dict(os.environ)
+    env.update(job.env)
+    cmd = '"%s" %s' %(sys.executable,job.commandLine())
+    logger.debug(cmd)
+
+    f = open(job.log, 'w') if job.log else None
+    try:
+        p = scheduler.startProcess(cmd, stdout=f, stderr=STDOUT if f else None, env=env)
+        rc = scheduler.waitForProcess(p)
+    finally:
+        if f:
+            f.close()
+    return rc
+
+
+if __name__ == '__main__':
+    main()